@@ -0,0 +1,162 @@
+# JSON read API for the mobile client and sync jobs - the /api/ routes in main.py
+# recipes are sent as JSON objects holding only the fields asked for (?fields=id,name,time, all of them by default).
+# a list is sent a page at a time like the HTML pages ({"recipes": [...], "next": cursor, "prev": cursor}), or with
+# ?format=ndjson (or Accept: application/x-ndjson) as one object per line, every recipe from ?after= on in a single
+# streamed response. the stream reads STREAM_BATCH rows at a time and writes each batch out as soon as it has been
+# read, so a long export holds one batch in memory and its first bytes are sent straight away
+import json
+from sqlite3 import Error
+
+from flask import jsonify, request, stream_with_context
+
+import cooktime
+import logs
+from assets import asset_url
+
+log = logs.get_logger('api')
+
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+FORMATS = {'json': JSON_MIMETYPE, 'ndjson': NDJSON_MIMETYPE}
+# most recipes on one page of JSON (?limit=)
+MAX_PAGE_SIZE = 100
+# rows read per query while streaming - each batch is its own short read, so a slow client does not hold a
+# read transaction open (and the WAL checkpoints back) for the whole download
+STREAM_BATCH = 500
+
+# field name in the API -> attribute of the Recipe or SearchResult record it comes from
+FIELDS = {
+    'id': 'id',
+    'username': 'username',
+    'name': 'name',
+    'info': 'info',
+    'time': 'time',
+    # only on search results
+    'minutes': 'minutes',
+    # URL of the image, null without one
+    'image': 'image_path',
+    # in lists only the start of the steps is sent and steps_truncated tells whether there is more,
+    # /api/recipes/<id> has them in full
+    'steps': 'steps',
+    'steps_truncated': 'steps_truncated',
+    # BM25 score of a keyword search, lower is a better match
+    'score': 'score',
+}
+
+
+# Raised for a request the API cannot answer, sent back as {"error": message} with status
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+# Fields of the API that a record (Recipe or SearchResult) has, in the order they are sent
+def available_fields(record):
+    return [name for name, attribute in FIELDS.items() if attribute in record._fields]
+
+
+# The fields asked for with ?fields=, all the record has if none were
+def requested_fields(record):
+    available = available_fields(record)
+    text = request.args.get('fields')
+    if not text:
+        return available
+    fields = [name.strip() for name in text.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in available]
+    if unknown or not fields:
+        raise ApiError("Unknown field %s, expected some of %s." % (', '.join(unknown) or "''", ', '.join(available)))
+    return fields
+
+
+# True if the list was asked for as NDJSON, with ?format= or the Accept header
+def wants_stream():
+    fmt = request.args.get('format')
+    if fmt is None:
+        return request.accept_mimetypes.best_match([JSON_MIMETYPE, NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+    if fmt not in FORMATS:
+        raise ApiError("Unknown format %r, expected one of %s." % (fmt, ', '.join(FORMATS)))
+    return fmt == 'ndjson'
+
+
+# Recipes on one page of JSON, from ?limit= (at most MAX_PAGE_SIZE) or default
+def page_size(default):
+    limit = request.args.get('limit')
+    if limit is None:
+        return default
+    try:
+        size = int(limit)
+    except ValueError:
+        size = 0
+    if not 0 < size <= MAX_PAGE_SIZE:
+        raise ApiError("limit must be a whole number from 1 to %d." % MAX_PAGE_SIZE)
+    return size
+
+
+# A limit in whole minutes from the query string (see cooktime.parse_limit), None if it is not there
+def minutes_limit(name):
+    value = request.args.get(name) or None
+    if value is None:
+        return None
+    minutes = cooktime.parse_limit(value)
+    if minutes is None:
+        raise ApiError("%s must be a whole number." % name)
+    return minutes
+
+
+# The fields of a recipe record as a dict ready for JSON
+def recipe_dict(row, fields):
+    result = {}
+    for name in fields:
+        value = getattr(row, FIELDS[name])
+        if name == 'image':
+            value = asset_url(value) if value else None
+        elif name == 'steps_truncated':
+            value = bool(value)
+        result[name] = value
+    return result
+
+
+def recipe_response(row, fields):
+    return jsonify(recipe_dict(row, fields))
+
+
+# One page of recipes as JSON, with the cursors of the pages either side of it (null at either end)
+def page_response(page, fields):
+    return jsonify(recipes=[recipe_dict(row, fields) for row in page.rows], next=page.next_cursor,
+                   prev=page.prev_cursor)
+
+
+# Every recipe from page on as NDJSON, streamed - fetch(cursor) returns the page after cursor
+# the request context lasts until the last line is sent, so fetch borrows a connection for each page rather than using
+# the request's own, and offloads its query itself (see main.read_batch).
+# the first page is read before the response starts, so a request that fails straight away still gets its error
+# status. after that the status has been sent, and a database error ends the stream with an {"error": ...} line
+def stream_response(response_class, page, fetch, fields):
+    return response_class(stream_with_context(_lines(page, fetch, fields)), mimetype=NDJSON_MIMETYPE)
+
+
+def _lines(page, fetch, fields):
+    while True:
+        if page.rows:
+            yield ''.join(_json_line(recipe_dict(row, fields)) for row in page.rows)
+        if page.next_cursor is None:
+            return
+        try:
+            page = fetch(page.next_cursor)
+        except Error:
+            log.exception("Database error")
+            yield _json_line({'error': "Database error."})
+            return
+
+
+def _json_line(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+
+# Answer an ApiError raised by any route of app with its message as JSON
+def init_app(app):
+    @app.errorhandler(ApiError)
+    def api_error(e):
+        return jsonify(error=e.message), e.status
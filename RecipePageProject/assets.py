@@ -0,0 +1,146 @@
+# serving of static files (stylesheet and uploaded images) so browsers can cache them for good
+# every URL built with asset_url() carries a hash of the file (?v=...). When the file changes the URL changes,
+# so a URL can be cached forever (Cache-Control: immutable) and repeat page views download nothing.
+# the stylesheet is also stored gzip and brotli compressed ahead of time and sent compressed when the browser accepts it
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import current_app, request, send_file, url_for
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, without it only gzip copies are made
+    brotli = None
+
+# file types that are worth compressing ahead of time - images are already compressed
+COMPRESSIBLE = ('.css', '.js', '.svg')
+# content coding -> (file suffix, compress function), in order of preference
+ENCODINGS = [('gzip', '.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', '.br', lambda data: brotli.compress(data, quality=11)))
+
+# one year - the longest lifetime browsers take notice of
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+CHUNK_SIZE = 64 * 1024
+
+# path -> (modified time, size, hash), so each file is only hashed again when it changes
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+# Hash of a file's contents, used both in the URL and as its strong ETag
+def fingerprint(path):
+    stat = os.stat(path)
+    with _fingerprints_lock:
+        cached = _fingerprints.get(path)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    value = digest.hexdigest()[:16]
+    with _fingerprints_lock:
+        _fingerprints[path] = (stat.st_mtime_ns, stat.st_size, value)
+    return value
+
+
+# Turn a file name under static/ (or a stored path such as 'static/uploads\\cake.jpg') into its static file name
+def static_filename(path):
+    path = path.replace('\\', '/').lstrip('/')
+    if path.startswith('static/'):
+        path = path[len('static/'):]
+    return path
+
+
+# URL of a static file with its fingerprint, for use in templates: {{ asset_url('CSS/StyleSheet.css') }}
+def asset_url(path):
+    if not path:
+        return ''
+    filename = static_filename(path)
+    full_path = safe_join(current_app.static_folder, filename)
+    if full_path is None or not os.path.isfile(full_path):
+        # a missing file gets a plain URL, the request for it will 404 as before
+        return url_for('static', filename=filename)
+    return url_for('static', filename=filename, v=fingerprint(full_path))
+
+
+# Write .gz (and .br) copies next to each compressible file in folder that has none or an old one
+# the uploads folder only holds images, so it is not searched
+def precompress(folder, skip=('uploads',)):
+    written = 0
+    for root, folders, files in os.walk(folder):
+        folders[:] = [name for name in folders if name not in skip]
+        for name in files:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(root, name)
+            data = None
+            for _, suffix, compress in ENCODINGS:
+                target = path + suffix
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+                if data is None:
+                    with open(path, 'rb') as handle:
+                        data = handle.read()
+                with open(target + '.part', 'wb') as handle:
+                    handle.write(compress(data))
+                os.replace(target + '.part', target)
+                written += 1
+    return written
+
+
+# Replacement for Flask's static view
+def serve_static(filename):
+    path = safe_join(current_app.static_folder, filename)
+    if path is None or not os.path.isfile(path) or path.endswith(('.gz', '.br', '.part')):
+        raise NotFound()
+
+    etag = fingerprint(path)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    send_path = path
+    encoding = None
+
+    # send a compressed copy if the browser accepts it and it is up to date
+    if path.endswith(COMPRESSIBLE):
+        for name, suffix, _ in ENCODINGS:
+            if name in request.accept_encodings and os.path.isfile(path + suffix) \
+                    and os.path.getmtime(path + suffix) >= os.path.getmtime(path):
+                send_path = path + suffix
+                encoding = name
+                # each encoding of the file is a different set of bytes, so it needs its own ETag
+                etag = etag + '-' + name
+                break
+
+    # send_file answers If-None-Match with 304 and Range requests with 206
+    response = send_file(send_path, mimetype=mimetype, conditional=True, etag=etag)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if path.endswith(COMPRESSIBLE):
+        response.vary.add('Accept-Encoding')
+
+    if request.args.get('v') == fingerprint(path):
+        # the URL names this exact version of the file, so it never needs checking again
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # unversioned URL - cache, but check the ETag with the server before each use
+        response.cache_control.public = True
+        response.cache_control.max_age = 0
+        response.cache_control.no_cache = True
+    return response
+
+
+# Use serve_static for /static/ and make asset_url available to the templates
+def init_app(app):
+    app.view_functions['static'] = serve_static
+    app.jinja_env.globals['asset_url'] = asset_url
+    precompress(app.static_folder)
@@ -0,0 +1,134 @@
+# Concurrency check and benchmark: hundreds of recipes added at the same time through the production server
+# Run from the RecipePageProject folder: python benchmarks/bench_add_recipe.py [--adds 400] [--names 100]
+# needs gunicorn installed. Several worker processes write to a temporary copy of the database. every name is
+# submitted several times at once with a different image each time, so requests race to add the same recipe.
+# afterwards the database and the upload folder are checked, and the script exits with status 1 if:
+# - a name was added more than once, or not at all
+# - the number of "added" answers is not the number of names
+# - an uploaded image is left on disk that no recipe uses
+# - the search index or the change counter missed an insert
+import argparse
+import http.client
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from harness import BOUNDARY, PROJECT_DIR, gunicorn_server, login, make_image, multipart_body, percentile, seed_recipes
+
+
+# Submit one recipe and return (where the response redirects to, seconds taken)
+def add(port, cookie, name, image):
+    body = multipart_body({'recipeName': name, 'info': 'info', 'time': '5 minutes', 'steps': 'steps'}, image)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    start = time.perf_counter()
+    try:
+        connection.request('POST', '/addRecipeAction', body=body, headers={
+            'Content-Type': 'multipart/form-data; boundary=%s' % BOUNDARY, 'Cookie': cookie})
+        response = connection.getresponse()
+        response.read()
+        location = response.getheader('Location', '') if response.status in (302, 303) else str(response.status)
+    except (OSError, http.client.HTTPException) as e:
+        location = type(e).__name__
+    finally:
+        connection.close()
+    return location, time.perf_counter() - start
+
+
+# Return a list of the invariants that do not hold
+def check(db_dir, names, added, version_before):
+    problems = []
+    conn = sqlite3.connect(os.path.join(db_dir, 'mySQLite.db'))
+    counts = dict(conn.execute("SELECT RecipeName, COUNT(*) FROM RECIPE WHERE Username = 'bench' GROUP BY RecipeName"))
+    duplicated = [name for name in names if counts.get(name, 0) > 1]
+    missing = [name for name in names if counts.get(name, 0) == 0]
+    if duplicated:
+        problems.append("%d names added more than once, e.g. %s" % (len(duplicated), duplicated[0]))
+    if missing:
+        problems.append("%d names never added, e.g. %s" % (len(missing), missing[0]))
+    if added != len(names):
+        problems.append("%d requests answered 'added' for %d names" % (added, len(names)))
+
+    used = {row[0] for row in conn.execute("SELECT ImagePath FROM RECIPE WHERE ImagePath IS NOT NULL")}
+    upload_folder = os.path.join(db_dir, 'static', 'uploads')
+    left = []
+    for folder, _, files in os.walk(upload_folder):
+        for file in files:
+            path = os.path.relpath(os.path.join(folder, file), db_dir).replace(os.sep, '/')
+            # renditions are named <hash>-<size>.jpg, partial uploads end in .part
+            if '-' not in file and path not in used:
+                left.append(path)
+    if left:
+        problems.append("%d uploaded files not used by any recipe, e.g. %s" % (len(left), left[0]))
+
+    recipes = conn.execute("SELECT COUNT(*) FROM RECIPE").fetchone()[0]
+    indexed = conn.execute("SELECT COUNT(*) FROM RECIPE_FTS_docsize").fetchone()[0]
+    if indexed != recipes:
+        problems.append("search index holds %d recipes, RECIPE has %d" % (indexed, recipes))
+    version = conn.execute("SELECT Version FROM CHANGE_COUNTER WHERE TableName = 'RECIPE'").fetchone()[0]
+    if version < version_before + len(names):
+        problems.append("change counter went up by %d for %d inserts" % (version - version_before, len(names)))
+    conn.close()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add recipes concurrently and check nothing was lost or doubled.")
+    parser.add_argument('--adds', type=int, default=400, help="recipes submitted in total")
+    parser.add_argument('--names', type=int, default=100, help="distinct names, so each is submitted adds/names times")
+    parser.add_argument('--clients', type=int, default=64, help="requests in flight at once")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    names = ["Race recipe %d" % i for i in range(args.names)]
+    submissions = [(names[i % args.names], make_image(rng)) for i in range(args.adds)]
+    rng.shuffle(submissions)
+
+    db_dir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(db_dir, 'mySQLite.db')
+        shutil.copy(os.path.join(PROJECT_DIR, 'mySQLite.db'), db_file)
+        # creates the bench user and brings the schema up to date
+        seed_recipes(db_file, 0, rng)
+        conn = sqlite3.connect(db_file)
+        version_before = conn.execute("SELECT Version FROM CHANGE_COUNTER WHERE TableName = 'RECIPE'").fetchone()[0]
+        conn.close()
+
+        with gunicorn_server(db_dir, WORKERS=args.workers, THREADS=args.threads) as (port, server):
+            cookie = login(port)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clients) as executor:
+                results = list(executor.map(lambda submission: add(port, cookie, *submission), submissions))
+            elapsed = time.perf_counter() - start
+
+        outcomes = {}
+        for location, _ in results:
+            outcomes[location] = outcomes.get(location, 0) + 1
+        latencies = [seconds for _, seconds in results]
+        print("%d adds of %d names, %d clients, %d workers x %d threads"
+              % (args.adds, args.names, args.clients, args.workers, args.threads))
+        print("%.1f adds/s, p50 %.1f ms, p99 %.1f ms" % (args.adds / elapsed, percentile(latencies, 50) * 1000,
+                                                         percentile(latencies, 99) * 1000))
+        for location, count in sorted(outcomes.items()):
+            print("  %5d -> %s" % (count, location))
+
+        added = sum(count for location, count in outcomes.items() if location.endswith('/profile'))
+        problems = check(db_dir, names, added, version_before)
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+    for problem in problems:
+        print("FAIL " + problem)
+    if problems:
+        sys.exit(1)
+    print("ok - every name added exactly once, no files left behind")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# Benchmark: exporting a large portfolio through the JSON API - streamed NDJSON against JSON pages
+# Run from the RecipePageProject folder: python benchmarks/bench_api.py [--recipes 50000] [--runs 3]
+# for each way the table shows the time to the first byte of the body, the time to read all of it, the bytes read
+# and the peak memory allocated by Python while it ran (tracemalloc). 'one list' is the old way of building
+# a response - every row fetched into one list and turned into one JSON document - for comparison
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+from harness import logged_in_client, seed_recipes, temp_app
+
+USER = 'bench'
+
+
+# Read a response body chunk by chunk and return (seconds to the first chunk, seconds in all, bytes)
+def read_streamed(client, path, **kwargs):
+    start = time.perf_counter()
+    response = client.get(path, buffered=False, **kwargs)
+    assert response.status_code == 200, (path, response.status_code)
+    first = None
+    size = 0
+    for chunk in response.response:
+        if first is None:
+            first = time.perf_counter() - start
+        size += len(chunk)
+    response.close()
+    return first, time.perf_counter() - start, size
+
+
+# Walk every page of JSON through the next cursors
+def read_pages(client, path):
+    start = time.perf_counter()
+    first = None
+    size = 0
+    after = None
+    while True:
+        response = client.get(path, query_string={'limit': 100, 'after': after} if after else {'limit': 100})
+        assert response.status_code == 200, (path, response.status_code)
+        if first is None:
+            first = time.perf_counter() - start
+        size += len(response.get_data())
+        after = response.get_json()['next']
+        if after is None:
+            return first, time.perf_counter() - start, size
+
+
+def read_one_list(app_module, count):
+    start = time.perf_counter()
+    with app_module.app.test_request_context():
+        page = app_module.repository.user_recipes_page(app_module.get_db(), USER, page_size=count)
+        body = json.dumps([app_module.api.recipe_dict(row, app_module.api.available_fields(app_module.repository.Recipe))
+                           for row in page.rows]).encode('utf-8')
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed, len(body)
+
+
+def measure(fn, runs):
+    results = []
+    peaks = []
+    for _ in range(runs):
+        tracemalloc.start()
+        results.append(fn())
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    best = min(results, key=lambda result: result[1])
+    return best + (max(peaks),)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare streamed NDJSON with paged JSON for a large portfolio.")
+    parser.add_argument('--recipes', type=int, default=50000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    with temp_app() as app_module:
+        app = app_module.app
+        seed_recipes(app.config['DATABASE'], args.recipes, random.Random(1))
+        client = logged_in_client(app, USER)
+        path = '/api/users/%s/recipes' % USER
+        ways = [
+            ('ndjson', lambda: read_streamed(client, path + '?format=ndjson')),
+            ('ndjson gzip', lambda: read_streamed(client, path + '?format=ndjson', headers={'Accept-Encoding': 'gzip'})),
+            ('ndjson br', lambda: read_streamed(client, path + '?format=ndjson', headers={'Accept-Encoding': 'br'})),
+            ('json pages of 100', lambda: read_pages(client, path)),
+            ('one list', lambda: read_one_list(app_module, args.recipes)),
+        ]
+        print("%d recipes" % args.recipes)
+        print("%-18s %14s %10s %12s %14s" % ("way", "first byte ms", "total s", "bytes", "peak memory MB"))
+        for name, fn in ways:
+            first, total, size, peak = measure(fn, args.runs)
+            print("%-18s %14.1f %10.2f %12d %14.1f" % (name, first * 1000, total, size, peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# Benchmark: tail latency of the read routes at 500 concurrent connections, sync mode (gthread) versus async (gevent)
+# Run from the RecipePageProject folder: python benchmarks/bench_async.py [--connections 500] [--seconds 15]
+# needs gunicorn and gevent installed. Both modes run one worker process against a temporary copy of the database,
+# with the result cache turned off. Each client pauses between requests like a person reading a page, so the server
+# is not flat out and latency shows how requests are scheduled rather than a queue for the CPU. A share of the
+# clients are slow - they send half of each request, wait, then send the rest - which ties up a thread in the sync mode
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from harness import PROJECT_DIR, WORDS, gunicorn_server, login, percentile, seed_recipes
+
+# the server closes connections idle for longer than this (keepalive in gunicorn.conf.py)
+KEEPALIVE = 5
+
+MODES = {
+    'sync': {'WORKER_CLASS': 'gthread', 'THREADS': 8},
+    'async': {'WORKER_CLASS': 'gevent', 'WORKER_CONNECTIONS': 2000},
+}
+
+
+def random_path(rng):
+    choice = rng.random()
+    if choice < 0.4:
+        return '/searchRecipeAction?' + urlencode({'keyword': rng.choice(WORDS)})
+    if choice < 0.6:
+        return '/searchPortfolioAction?user=bench'
+    if choice < 0.8:
+        return '/userRecipes'
+    return '/profile'
+
+
+# Read one response and return its status
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return int(status_line.split()[1])
+
+
+# One connection sending requests one after another until the time is up
+# after a pause longer than KEEPALIVE the client opens a new connection, as a browser would
+async def connection(port, cookie, measure_from, end, slow, slow_delay, think, rng, latencies, counts):
+    writer = None
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        while time.monotonic() < end:
+            request = ('GET %s HTTP/1.1\r\nHost: localhost\r\nCookie: %s\r\n\r\n'
+                       % (random_path(rng), cookie)).encode('latin-1')
+            start = time.perf_counter()
+            if slow:
+                half = len(request) // 2
+                writer.write(request[:half])
+                await writer.drain()
+                await asyncio.sleep(slow_delay)
+                writer.write(request[half:])
+            else:
+                writer.write(request)
+            await writer.drain()
+            status = await read_response(reader)
+            if status != 200:
+                counts['errors'] += 1
+            if time.monotonic() >= measure_from:
+                counts['requests'] += 1
+                if not slow:
+                    latencies.append(time.perf_counter() - start)
+            pause = rng.uniform(0, 2 * think)
+            await asyncio.sleep(pause)
+            if pause >= KEEPALIVE - 1:
+                writer.close()
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+        counts['errors'] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def load(port, cookie, args):
+    rng = random.Random(42)
+    latencies = []
+    counts = {'requests': 0, 'errors': 0}
+    # the first requests of all the clients arrive together, the warm up keeps that burst out of the results
+    measure_from = time.monotonic() + args.warmup
+    end = measure_from + args.seconds
+    slow_count = int(args.connections * args.slow)
+    tasks = [connection(port, cookie, measure_from, end, i < slow_count, args.slow_delay, args.think, random.Random(rng.random()),
+                        latencies, counts) for i in range(args.connections)]
+    await asyncio.gather(*tasks)
+    return latencies, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare tail latency of the sync and async server modes.")
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--seconds', type=int, default=15)
+    parser.add_argument('--warmup', type=int, default=5, help="seconds before latencies are recorded")
+    parser.add_argument('--slow', type=float, default=0.1, help="share of connections that are slow clients")
+    parser.add_argument('--slow-delay', type=float, default=1.0, help="seconds a slow client pauses mid-request")
+    parser.add_argument('--think', type=float, default=2.0, help="average seconds a client waits between requests")
+    parser.add_argument('--recipes', type=int, default=2000)
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(PROJECT_DIR, 'mySQLite.db'), db_dir)
+        seed_recipes(os.path.join(db_dir, 'mySQLite.db'), args.recipes, random.Random(42))
+        print("%d connections, %.1fs between requests, %d%% slow clients pausing %.1fs, latency of the other clients"
+              % (args.connections, args.think, args.slow * 100, args.slow_delay))
+        print("%6s %12s %10s %10s %10s %10s %8s" % ("mode", "requests/s", "p50 ms", "p99 ms", "p99.9 ms", "max ms",
+                                                   "errors"))
+        for mode in args.modes:
+            with gunicorn_server(db_dir, WORKERS=1, RESULT_CACHE_BYTES=0, **MODES[mode]) as (port, server):
+                cookie = login(port)
+                latencies, counts = asyncio.run(load(port, cookie, args))
+            print("%6s %12.1f %10.2f %10.2f %10.2f %10.2f %8d" % (
+                mode, counts['requests'] / args.seconds, percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000, percentile(latencies, 99.9) * 1000,
+                max(latencies, default=0) * 1000, counts['errors']))
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
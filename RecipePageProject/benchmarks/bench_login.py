@@ -0,0 +1,51 @@
+# Benchmark: password checks per second by bcrypt work factor and number of hashing processes
+# workers 0 is the old behaviour - hashing on the request threads themselves
+# Run from the RecipePageProject folder: python benchmarks/bench_login.py [--rounds 8 10 12] [--workers 0 1 2 4]
+import argparse
+import threading
+import time
+
+import harness  # puts the project folder on the import path
+from passwords import PasswordHasher
+
+
+def throughput(hasher, hashed, threads, checks):
+    per_thread = max(1, checks // threads)
+
+    def worker():
+        for _ in range(per_thread):
+            assert hasher.check('correct horse', hashed)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return per_thread * threads / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure login password check throughput.")
+    parser.add_argument('--rounds', type=int, nargs='+', default=[8, 10, 12])
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--threads', type=int, default=16, help="concurrent request threads")
+    parser.add_argument('--seconds', type=float, default=2.0, help="rough time spent per measurement")
+    args = parser.parse_args()
+
+    print("%8s %8s %12s" % ("rounds", "workers", "logins/s"))
+    for rounds in args.rounds:
+        for workers in args.workers:
+            hasher = PasswordHasher(rounds=rounds, workers=workers, max_pending=args.threads)
+            hashed = hasher.hash('correct horse')
+            # size the run from one timed check so every configuration takes about the same time
+            single = time.perf_counter()
+            hasher.check('correct horse', hashed)
+            single = time.perf_counter() - single
+            checks = max(args.threads, int(args.seconds / single * max(1, workers)))
+            print("%8d %8d %12.1f" % (rounds, workers, throughput(hasher, hashed, args.threads, checks)))
+            hasher.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Benchmark: render time and bytes on the wire of each page, by content coding, and template start up time
+# Run from the RecipePageProject folder: python benchmarks/bench_pages.py [--runs 50]
+# every page is requested with Accept-Encoding identity, gzip and br. for each the table shows the p50 time of the
+# whole request, the time spent rendering templates (from /metrics) and the size of the body that was sent.
+# the start up part compiles every template in a new Jinja environment, as a new worker process does - without a
+# bytecode cache, and again with a bytecode cache filled by an earlier run
+import argparse
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+from harness import PROJECT_DIR, logged_in_client, percentile, temp_app, timed
+
+USER = 'bench'
+FAVOURITES = 20
+ENCODINGS = ('identity', 'gzip', 'br')
+TEMPLATE_DIR = os.path.join(PROJECT_DIR, 'templates')
+
+
+def seed(conn):
+    conn.execute("INSERT INTO USER (Username, Password, Email) VALUES (?, 'x', 'bench@example.com')", (USER,))
+    ids = []
+    for i in range(FAVOURITES):
+        cursor = conn.execute(
+            "INSERT INTO RECIPE (Username, RecipeName, Info, Time, ImagePath, Steps) VALUES (?, ?, ?, ?, NULL, ?)",
+            (USER, "Bench cake %d" % i, "butter sugar flour " * 10, "20 minutes",
+             "Beat the butter and sugar together until fluffy. " * 20))
+        conn.execute("INSERT INTO FAVOURITE (Username, RecipeID) VALUES (?, ?)", (USER, cursor.lastrowid))
+        ids.append(cursor.lastrowid)
+    conn.commit()
+    return ids
+
+
+def template_seconds(client):
+    text = client.get('/metrics').get_data(as_text=True)
+    return {endpoint: float(value) for endpoint, value in
+            re.findall(r'^recipe_request_template_seconds_total\{endpoint="([^"]+)"\} (\S+)$', text, re.M)}
+
+
+# Seconds to compile every template in a new environment
+def compile_all(bytecode_cache=None):
+    env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), bytecode_cache=bytecode_cache)
+    start = time.perf_counter()
+    for name in env.list_templates():
+        env.get_template(name)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time page rendering and measure response sizes by encoding.")
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    with temp_app() as app_module:
+        app = app_module.app
+        with app.app_context():
+            recipe_ids = seed(app_module.get_db())
+        client = logged_in_client(app, USER)
+        pages = [('login', '/login', False), ('signup', '/signup', False), ('profile', '/profile', True),
+                 ('userRecipes', '/userRecipes', True), ('recipe', '/recipe/%d' % recipe_ids[0], True),
+                 ('searchRecipe', '/searchRecipe', True),
+                 ('searchRecipeAction', '/searchRecipeAction?keyword=butter', True),
+                 ('searchPortfolioAction', '/searchPortfolioAction?user=%s' % USER, True)]
+
+        print("%-22s %-9s %10s %12s %10s" % ("page", "encoding", "p50 ms", "template ms", "bytes"))
+        for endpoint, path, logged_in in pages:
+            page_client = client if logged_in else app.test_client()
+            for encoding in ENCODINGS:
+                headers = {'Accept-Encoding': encoding}
+
+                def request():
+                    response = page_client.get(path, headers=headers)
+                    assert response.status_code == 200, (path, response.status_code)
+                    return response
+
+                size = len(request().get_data())
+                before = template_seconds(client).get(endpoint, 0.0)
+                times = timed(request, args.runs)
+                rendering = (template_seconds(client).get(endpoint, 0.0) - before) / args.runs
+                print("%-22s %-9s %10.2f %12.3f %10d" % (endpoint, encoding, percentile(times, 50) * 1000,
+                                                        rendering * 1000, size))
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cold = [compile_all() for _ in range(5)]
+        compile_all(FileSystemBytecodeCache(cache_dir))
+        warm = [compile_all(FileSystemBytecodeCache(cache_dir)) for _ in range(5)]
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    print()
+    print("compiling all templates: %.1f ms without a bytecode cache, %.1f ms from a filled one"
+          % (min(cold) * 1000, min(warm) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Benchmark: connect-per-request versus the pooled connections in database.py
+# Each simulated request runs the same queries as the profile page against a copy of mySQLite.db
+# Run from the RecipePageProject folder: python benchmarks/bench_pool.py [--threads 8] [--requests 2000]
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import database
+
+
+# the queries one profile page view makes
+def profile_request(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT Email, First_Name, Last_Name, FavouriteRecipes FROM USER WHERE Username=?", ('Cian',))
+    cursor.fetchone()
+    cursor.execute("SELECT * FROM RECIPE WHERE Username=?", ('Cian',))
+    cursor.fetchall()
+
+
+def connect_per_request(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        profile_request(conn)
+    finally:
+        conn.close()
+
+
+def pooled(pool):
+    conn = pool.acquire()
+    try:
+        profile_request(conn)
+    finally:
+        pool.release(conn)
+
+
+# run `requests` calls of fn spread over `threads` threads and return requests per second
+def run(fn, threads, requests):
+    per_thread = requests // threads
+
+    def worker():
+        for _ in range(per_thread):
+            fn()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return per_thread * threads / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare connect-per-request with pooled connections.")
+    parser.add_argument('--db', default='mySQLite.db')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    # work on a copy so the shipped database is never touched
+    tmpdir = tempfile.mkdtemp()
+    db_file = os.path.join(tmpdir, 'bench.db')
+    shutil.copy(args.db, db_file)
+    try:
+        baseline = run(lambda: connect_per_request(db_file), args.threads, args.requests)
+        pool = database.ConnectionPool(db_file, size=args.threads)
+        pooled_rps = run(lambda: pooled(pool), args.threads, args.requests)
+        stats = pool.stats()
+        pool.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("connect per request: %8.0f req/s" % baseline)
+    print("pooled connections:  %8.0f req/s  (%.1fx)" % (pooled_rps, pooled_rps / baseline))
+    print("pool: %d opened, %d checkouts, avg wait %.3f ms, max wait %.3f ms" % (
+        stats['opened'], stats['checkouts'], stats['wait_avg'] * 1000, stats['wait_max'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
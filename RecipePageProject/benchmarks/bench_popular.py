@@ -0,0 +1,70 @@
+# Benchmark: the most popular recipes read from the kept favourite counts against counting FAVOURITE,
+# and what the counting triggers add to adding and removing a favourite
+# Run from the RecipePageProject folder: python benchmarks/bench_popular.py [--favourites 200000] [--runs 200]
+# runs on a synthetic site in a temporary folder, so the shipped database is never touched
+import argparse
+import os
+import random
+import shutil
+import tempfile
+
+from harness import percentile, seed_site, timed
+import database
+import popular
+import repository
+
+# the top of the list counted from FAVOURITE on every read, as it would be without FAVOURITE_COUNT
+COUNT_FROM_SOURCE = ("SELECT RECIPE.ID, RECIPE.Username, RECIPE.RecipeName, RECIPE.Time, counts.Favourites "
+                     "FROM (SELECT RecipeID, count(*) AS Favourites FROM FAVOURITE GROUP BY RecipeID) AS counts "
+                     "JOIN RECIPE ON RECIPE.ID = counts.RecipeID "
+                     "ORDER BY counts.Favourites DESC, counts.RecipeID DESC LIMIT ?")
+
+
+def toggle_favourites(conn, rng, ids, runs):
+    def toggle():
+        recipe_id = rng.choice(ids)
+        repository.add_favourite(conn, 'user0', recipe_id)
+        repository.remove_favourite(conn, 'user0', recipe_id)
+        conn.commit()
+    return timed(toggle, runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the popular list and the favourite count triggers.")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--recipes', type=int, default=20000)
+    parser.add_argument('--favourites', type=int, default=200000)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    site_dir = tempfile.mkdtemp()
+    try:
+        rng = random.Random(1)
+        ids = seed_site(site_dir, args.users, args.recipes, args.favourites, 0, rng)
+        conn = database.connect(os.path.join(site_dir, 'mySQLite.db'))
+        favourites = conn.execute("SELECT count(*) FROM FAVOURITE").fetchone()[0]
+        print("%d recipes, %d favourites" % (args.recipes, favourites))
+
+        kept = timed(lambda: repository.popular_recipes(conn, popular.POPULAR_COUNT), args.runs)
+        counted = timed(lambda: conn.execute(COUNT_FROM_SOURCE, (popular.POPULAR_COUNT,)).fetchall(), args.runs)
+        assert repository.popular_recipes(conn, popular.POPULAR_COUNT) == \
+            [tuple(row) for row in conn.execute(COUNT_FROM_SOURCE, (popular.POPULAR_COUNT,))]
+        print("%-36s %10s %10s" % ("", "p50 ms", "p99 ms"))
+        for name, times in (("top %d from FAVOURITE_COUNT" % popular.POPULAR_COUNT, kept),
+                            ("top %d counted from FAVOURITE" % popular.POPULAR_COUNT, counted)):
+            print("%-36s %10.3f %10.3f" % (name, percentile(times, 50) * 1000, percentile(times, 99) * 1000))
+
+        with_triggers = toggle_favourites(conn, rng, ids, args.runs)
+        for name in ('insert', 'delete', 'update'):
+            conn.execute("DROP TRIGGER FAVOURITE_count_%s" % name)
+        without_triggers = toggle_favourites(conn, rng, ids, args.runs)
+        for name, times in (("add + remove favourite, counted", with_triggers),
+                            ("add + remove favourite, not counted", without_triggers)):
+            print("%-36s %10.3f %10.3f" % (name, percentile(times, 50) * 1000, percentile(times, 99) * 1000))
+        conn.close()
+    finally:
+        shutil.rmtree(site_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Benchmark: /profile rendering time for users with 10, 100 and 1,000 favourite recipes
+# Run from the RecipePageProject folder: python benchmarks/bench_profile.py [--runs 50]
+import argparse
+
+from harness import temp_app, logged_in_client, timed, percentile
+
+SIZES = (10, 100, 1000)
+
+
+def seed(conn, username, favourites):
+    conn.execute("INSERT INTO USER (Username, Password, Email) VALUES (?, 'x', 'bench@example.com')", (username,))
+    for i in range(favourites):
+        cursor = conn.execute(
+            "INSERT INTO RECIPE (Username, RecipeName, Info, Time, ImagePath, Steps) VALUES (?, ?, ?, ?, NULL, ?)",
+            (username, "Bench recipe %d" % i, "info " * 20, "20 minutes", "step " * 100))
+        conn.execute("INSERT INTO FAVOURITE (Username, RecipeID) VALUES (?, ?)", (username, cursor.lastrowid))
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time profile page rendering by number of favourites.")
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    with temp_app() as app_module:
+        app = app_module.app
+        with app.app_context():
+            conn = app_module.get_db()
+            for size in SIZES:
+                seed(conn, "bench%d" % size, size)
+
+        print("%12s %12s %12s %12s" % ("favourites", "cold p50 ms", "cold p99 ms", "cached p50 ms"))
+        for size in SIZES:
+            username = "bench%d" % size
+            client = logged_in_client(app, username)
+
+            def cold():
+                app_module.profile_cache.invalidate(username)
+                assert client.get('/profile').status_code == 200
+
+            def warm():
+                assert client.get('/profile').status_code == 200
+
+            cold_times = timed(cold, args.runs)
+            warm_times = timed(warm, args.runs)
+            print("%12d %12.2f %12.2f %12.2f" % (size, percentile(cold_times, 50) * 1000,
+                                                 percentile(cold_times, 99) * 1000,
+                                                 percentile(warm_times, 50) * 1000))
+
+
+if __name__ == '__main__':
+    main()
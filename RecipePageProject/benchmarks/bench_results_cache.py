@@ -0,0 +1,71 @@
+# Benchmark: search and portfolio result pages rendered from scratch, served from the result cache,
+# and revalidated by a browser that already has them (304 Not Modified)
+# Run from the RecipePageProject folder: python benchmarks/bench_results_cache.py [--recipes 5000] [--runs 200]
+import argparse
+import random
+
+from harness import temp_app, add_bench_user, logged_in_client, timed, percentile
+
+WORDS = ("butter sugar flour egg chocolate vanilla lemon ginger oat raspberry cream cheese cake cookie tart "
+         "bread loaf bun muffin scone pie crumble caramel toffee honey almond walnut cinnamon nutmeg apple").split()
+KEYWORDS = ("chocolate", "Lemon  tart", "cinn")
+
+
+def seed(conn, count, rng):
+    add_bench_user(conn)
+    rows = [("bench", ' '.join(rng.sample(WORDS, 3)) + " %d" % i, ' '.join(rng.sample(WORDS, 10)), "20 minutes",
+             ' '.join(rng.choice(WORDS) for _ in range(80))) for i in range(count)]
+    conn.executemany("INSERT INTO RECIPE (Username, RecipeName, Info, Time, Steps) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare result pages with and without the result cache.")
+    parser.add_argument('--recipes', type=int, default=5000)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    with temp_app() as app_module:
+        app = app_module.app
+        pool = app.extensions['db_pool']
+        conn = pool.acquire()
+        try:
+            seed(conn, args.recipes, random.Random(42))
+        finally:
+            pool.release(conn)
+        client = logged_in_client(app, 'bench')
+        cache = app_module.result_cache
+
+        requests = [('/searchRecipeAction', {'keyword': keyword}) for keyword in KEYWORDS]
+        requests.append(('/searchPortfolioAction', {'user': 'bench'}))
+
+        print("%-40s %12s %12s %12s %12s %12s %12s" % ("request", "cold p50 ms", "cold p99 ms", "warm p50 ms",
+                                                       "warm p99 ms", "304 p50 ms", "304 p99 ms"))
+        for url, form in requests:
+            def cold():
+                cache.clear()
+                assert client.get(url, query_string=form).status_code == 200
+
+            def warm():
+                assert client.get(url, query_string=form).status_code == 200
+
+            etag = client.get(url, query_string=form).headers['ETag']
+
+            def revalidate():
+                assert client.get(url, query_string=form, headers={'If-None-Match': etag}).status_code == 304
+
+            cold_times = timed(cold, args.runs)
+            warm_times = timed(warm, args.runs)
+            revalidate_times = timed(revalidate, args.runs)
+            print("%-40s %12.2f %12.2f %12.2f %12.2f %12.2f %12.2f" % (
+                url + ' ' + list(form.values())[0], percentile(cold_times, 50) * 1000, percentile(cold_times, 99) * 1000,
+                percentile(warm_times, 50) * 1000, percentile(warm_times, 99) * 1000,
+                percentile(revalidate_times, 50) * 1000, percentile(revalidate_times, 99) * 1000))
+
+        print()
+        for name, value in cache.stats().items():
+            print("%-14s %s" % (name, value))
+
+
+if __name__ == '__main__':
+    main()
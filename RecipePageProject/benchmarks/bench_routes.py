@@ -0,0 +1,322 @@
+# Benchmark suite: every route of main.py, through the Flask test client and through the production server
+# Run from the RecipePageProject folder:
+#   python benchmarks/bench_routes.py [--output results.json] [--baseline previous.json]
+# a synthetic site (users, recipes, favourites and images, see harness.seed_site) is made from a fixed seed, then
+# each route is sent the same number of requests in the same order in each mode. for every route the results give
+# throughput, p50/p95/p99 latency, errors and peak memory (Linux only), written as JSON with the commit they came from.
+# with --baseline the results are compared with an earlier run and the script exits with status 1 if any route's
+# p99 latency or throughput got worse by more than --tolerance. the "http" mode needs gunicorn installed
+import argparse
+import http.client
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from harness import (BOUNDARY, PROJECT_DIR, WORDS, child_pids, gunicorn_server, logged_in_client, login,
+                     make_image, multipart_body, peak_memory_kb, percentile, reset_peak_memory, seed_site, temp_app)
+
+# image is the bytes of a JPEG sent as the field 'image', which makes the POST multipart
+Request = namedtuple('Request', ['method', 'path', 'fields', 'image'])
+
+# the logged in user - owns a share of the recipes like every other user
+USER = 'user0'
+PASSWORD = 'bench'
+# cheap hashes for the synthetic users, and the same for accounts made by signup
+ENV = {'BCRYPT_LOG_ROUNDS': 4}
+
+
+# Everything the routes pick their requests from - made again from the same seed for each mode
+class Run():
+    def __init__(self, mode, seed, users, recipe_ids, db_file):
+        self.mode = mode
+        self.rng = random.Random(seed)
+        self.users = users
+        self.recipe_ids = recipe_ids
+        self.db_file = db_file
+        self.favourite_ids = []
+        self.deletable_ids = []
+        self.counter = itertools.count()
+
+    def recipe_id(self):
+        return self.rng.choice(self.recipe_ids)
+
+    def unique(self, prefix):
+        return '%s-%s-%d' % (prefix, self.mode, next(self.counter))
+
+    # Add recipes for the logged in user straight into the database, for deleteRecipe to remove
+    def add_deletable(self, count):
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        conn.execute("PRAGMA foreign_keys=ON")
+        for _ in range(count):
+            cursor = conn.execute("INSERT INTO RECIPE (Username, RecipeName, Info, Time, Steps) VALUES (?, ?, ?, ?, ?)",
+                                  (USER, self.unique('Deletable'), 'info', '5 minutes', 'steps'))
+            self.deletable_ids.append(cursor.lastrowid)
+        conn.commit()
+        conn.close()
+
+
+def get(path, **params):
+    return Request('GET', path + ('?' + urlencode(params) if params else ''), None, None)
+
+
+def post(path, image=None, **fields):
+    return Request('POST', path, fields, image)
+
+
+# name -> (logged in, setup(run, count) or None, make(run, i) -> Request), in the order they are run
+# reads come first so the writes do not change what they read; deleting recipes comes last
+ROUTES = {
+    'index': (False, None, lambda run, i: get('/')),
+    'login_page': (False, None, lambda run, i: get('/login')),
+    'signup_page': (False, None, lambda run, i: get('/signup')),
+    'profile': (True, None, lambda run, i: get('/profile')),
+    'user_recipes': (True, None, lambda run, i: get('/userRecipes')),
+    'recipe': (True, None, lambda run, i: get('/recipe/%d' % run.recipe_id())),
+    'search_page': (True, None, lambda run, i: get('/searchRecipe')),
+    'search': (True, None, lambda run, i: get('/searchRecipeAction', keyword=run.rng.choice(WORDS))),
+    'portfolio_page': (True, None, lambda run, i: get('/searchPortfolio')),
+    'portfolio': (True, None, lambda run, i: get('/searchPortfolioAction', user=run.rng.choice(run.users))),
+    'add_recipe_page': (True, None, lambda run, i: get('/addRecipe')),
+    'login': (False, None, lambda run, i: post('/loginAction', username=run.rng.choice(run.users), password=PASSWORD)),
+    'signup': (False, None, lambda run, i: post('/signupAction', username=run.unique('signup'), password=PASSWORD,
+                                                 email='bench@example.com', fname='First', lname='Last')),
+    'add_recipe': (True, None, lambda run, i: post('/addRecipeAction', image=make_image(run.rng),
+                                                   recipeName=run.unique('Added'), info='info', time='5 minutes',
+                                                   steps='steps')),
+    'add_favourite': (True, lambda run, count: run.favourite_ids.extend(run.rng.sample(run.recipe_ids, count)),
+                      lambda run, i: post('/addToFavourites', recipe_id=run.favourite_ids[i])),
+    # removes the favourites added by add_favourite, so it only runs with it
+    'remove_favourite': (True, None, lambda run, i: post('/removeFromFavourites', recipe_id=run.favourite_ids[i])),
+    'delete_recipe': (True, lambda run, count: run.add_deletable(count),
+                      lambda run, i: post('/deleteRecipe', recipe_id=run.deletable_ids[i])),
+}
+
+
+def summarise(latencies, errors, elapsed, peak_kb):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_memory_kb': peak_kb,
+    }
+
+
+# Send requests one after another through the Flask test client, in this process
+def run_client(run, routes, count):
+    import main
+    app = main.app
+    results = {}
+    for name in routes:
+        logged_in, setup, make = ROUTES[name]
+        if setup is not None:
+            setup(run, count)
+        requests = [make(run, i) for i in range(count)]
+        client = logged_in_client(app, USER) if logged_in else app.test_client()
+        latencies = []
+        errors = 0
+        reset_peak_memory(os.getpid())
+        start = time.perf_counter()
+        for request in requests:
+            data = dict(request.fields or {})
+            if request.image is not None:
+                data['image'] = (io.BytesIO(request.image), 'bench.jpg')
+            began = time.perf_counter()
+            response = client.open(request.path, method=request.method, data=data or None)
+            latencies.append(time.perf_counter() - began)
+            if response.status_code >= 400:
+                errors += 1
+        elapsed = time.perf_counter() - start
+        results[name] = summarise(latencies, errors, elapsed, peak_memory_kb(os.getpid()))
+    # let the image renditions finish before the next mode
+    main.image_pipeline.shutdown(wait=True)
+    return results
+
+
+# Send requests from several clients at once to the production server, each on its own keep-alive connection
+def run_http(run, routes, count, clients, port, server):
+    cookie = login(port, USER, PASSWORD)
+    local = threading.local()
+
+    def send(request, logged_in):
+        if getattr(local, 'conn', None) is None:
+            local.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        headers = {'Cookie': cookie} if logged_in else {}
+        body = None
+        if request.image is not None:
+            body = multipart_body(request.fields, request.image)
+            headers['Content-Type'] = 'multipart/form-data; boundary=%s' % BOUNDARY
+        elif request.fields is not None:
+            body = urlencode(request.fields)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        began = time.perf_counter()
+        try:
+            local.conn.request(request.method, request.path, body=body, headers=headers)
+            response = local.conn.getresponse()
+            response.read()
+            failed = response.status >= 400
+        except (OSError, http.client.HTTPException):
+            local.conn.close()
+            local.conn = None
+            failed = True
+        return time.perf_counter() - began, failed
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        for name in routes:
+            logged_in, setup, make = ROUTES[name]
+            if setup is not None:
+                setup(run, count)
+            requests = [make(run, i) for i in range(count)]
+            workers = child_pids(server.pid)
+            for pid in workers:
+                reset_peak_memory(pid)
+            start = time.perf_counter()
+            outcomes = list(executor.map(lambda request: send(request, logged_in), requests))
+            elapsed = time.perf_counter() - start
+            peaks = [peak_memory_kb(pid) for pid in workers]
+            peak_kb = sum(peaks) if peaks and None not in peaks else None
+            results[name] = summarise([seconds for seconds, _ in outcomes], sum(failed for _, failed in outcomes),
+                                      elapsed, peak_kb)
+    return results
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=PROJECT_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Routes of results that are worse than in baseline by more than tolerance (a share, 0.2 is 20%)
+def regressions(results, baseline, tolerance):
+    found = []
+    for mode, routes in results.items():
+        for name, current in routes.items():
+            before = baseline.get('results', {}).get(mode, {}).get(name)
+            if not before:
+                continue
+            if current['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+                found.append("%s %s: p99 %.2f ms, was %.2f ms" % (mode, name, current['p99_ms'], before['p99_ms']))
+            if current['throughput_rps'] < before['throughput_rps'] * (1 - tolerance):
+                found.append("%s %s: %.1f requests/s, was %.1f" % (mode, name, current['throughput_rps'],
+                                                                  before['throughput_rps']))
+    return found
+
+
+def print_table(results, out):
+    print("%-6s %-18s %10s %9s %9s %9s %7s %11s" % ("mode", "route", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors",
+                                                    "peak MiB"), file=out)
+    for mode, routes in results.items():
+        for name, result in routes.items():
+            peak = result['peak_memory_kb']
+            print("%-6s %-18s %10.1f %9.2f %9.2f %9.2f %7d %11s" % (
+                mode, name, result['throughput_rps'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                result['errors'], '-' if peak is None else '%.1f' % (peak / 1024)), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every route through the test client and a real server.")
+    parser.add_argument('--modes', nargs='+', default=['client', 'http'], choices=['client', 'http'])
+    parser.add_argument('--routes', nargs='+', default=list(ROUTES), choices=list(ROUTES), metavar='ROUTE',
+                        help="routes to run (default: all of %s)" % ', '.join(ROUTES))
+    parser.add_argument('--requests', type=int, default=200, help="requests sent to each route")
+    parser.add_argument('--clients', type=int, default=8, help="requests in flight at once in the http mode")
+    parser.add_argument('--workers', type=int, default=2, help="server processes in the http mode")
+    parser.add_argument('--threads', type=int, default=8, help="threads per server process in the http mode")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--recipes', type=int, default=5000)
+    parser.add_argument('--favourites', type=int, default=2000)
+    parser.add_argument('--images', type=int, default=100, help="recipes that have an image")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="write the JSON results here instead of to stdout")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slow down before failing (0.2 = 20%%)")
+    args = parser.parse_args()
+    if 'remove_favourite' in args.routes and 'add_favourite' not in args.routes:
+        parser.error("remove_favourite removes what add_favourite added, so it needs add_favourite too")
+    # run in the order of ROUTES whatever order they were given in
+    routes = [name for name in ROUTES if name in args.routes]
+
+    site_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        print("Seeding %d users, %d recipes, %d favourites, %d images..." % (
+            args.users, args.recipes, args.favourites, args.images), file=sys.stderr)
+        recipe_ids = seed_site(site_dir, args.users, args.recipes, args.favourites, args.images,
+                               random.Random(args.seed))
+        users = ['user%d' % i for i in range(args.users)]
+
+        if 'http' in args.modes:
+            db_dir = tempfile.mkdtemp()
+            try:
+                shutil.copytree(site_dir, db_dir, dirs_exist_ok=True)
+                run = Run('http', args.seed, users, recipe_ids, os.path.join(db_dir, 'mySQLite.db'))
+                with gunicorn_server(db_dir, WORKERS=args.workers, THREADS=args.threads, **ENV) as (port, server):
+                    results['http'] = run_http(run, routes, args.requests, args.clients, port, server)
+            finally:
+                shutil.rmtree(db_dir, ignore_errors=True)
+
+        if 'client' in args.modes:
+            # settings are read from the environment when the app is created
+            for name, value in ENV.items():
+                os.environ['RECIPE_' + name] = str(value)
+            with temp_app(site_dir) as app_module:
+                run = Run('client', args.seed, users, recipe_ids, os.path.abspath(app_module.app.config['DATABASE']))
+                results['client'] = run_client(run, routes, args.requests)
+                app_module.shutdown()
+    finally:
+        shutil.rmtree(site_dir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': vars(args),
+        'results': results,
+    }
+    print_table(results, sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        found = regressions(results, baseline, args.tolerance)
+        print("Compared with %s (commit %s):" % (args.baseline, baseline.get('commit')), file=sys.stderr)
+        for line in found:
+            print("  SLOWER " + line, file=sys.stderr)
+        if found:
+            sys.exit(1)
+        print("  no route slower by more than %d%%" % (args.tolerance * 100), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
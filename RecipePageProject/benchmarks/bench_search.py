@@ -0,0 +1,74 @@
+# Benchmark: FTS5 recipe search versus the old RecipeName LIKE '%keyword%' scan
+# Run from the RecipePageProject folder: python benchmarks/bench_search.py [--sizes 10000 100000 1000000]
+import argparse
+import os
+import random
+import shutil
+import tempfile
+
+from harness import PROJECT_DIR, add_bench_user, timed, percentile
+import database
+import search
+
+WORDS = ("butter sugar flour egg chocolate vanilla lemon ginger oat raspberry cream cheese cake cookie tart "
+         "bread loaf bun muffin scone pie crumble caramel toffee honey almond walnut cinnamon nutmeg apple "
+         "banana cherry orange coconut syrup treacle shortbread brownie sponge icing glaze pastry dough").split()
+KEYWORDS = ("chocolate", "lemon tart", "cinn", "banana bread")
+
+
+# filler vocabulary so that, as in real recipes, each food word only appears in a small share of rows
+FILLER = ["w%04d" % i for i in range(5000)]
+
+
+def sentence(rng, length, food_share=0.05):
+    return ' '.join(rng.choice(WORDS) if rng.random() < food_share else rng.choice(FILLER) for _ in range(length))
+
+
+def seed(conn, count, rng):
+    add_bench_user(conn)
+    batch = []
+    for i in range(count):
+        batch.append(("bench", sentence(rng, 3, 0.3) + " %d" % i, sentence(rng, 20), "20 minutes", sentence(rng, 60)))
+        if len(batch) == 10000:
+            conn.executemany("INSERT INTO RECIPE (Username, RecipeName, Info, Time, Steps) VALUES (?, ?, ?, ?, ?)", batch)
+            batch = []
+    if batch:
+        conn.executemany("INSERT INTO RECIPE (Username, RecipeName, Info, Time, Steps) VALUES (?, ?, ?, ?, ?)", batch)
+    conn.commit()
+
+
+def like_scan(cursor, keyword):
+    cursor.execute("SELECT * FROM RECIPE WHERE RecipeName LIKE ?", ('%' + keyword + '%',))
+    return cursor.fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare FTS5 search latency with the LIKE scan.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print("%10s %-14s %12s %12s %12s %12s" % ("recipes", "keyword", "like p50 ms", "like p99 ms", "fts p50 ms", "fts p99 ms"))
+    for size in args.sizes:
+        tmpdir = tempfile.mkdtemp()
+        db_file = os.path.join(tmpdir, 'bench.db')
+        shutil.copy(os.path.join(PROJECT_DIR, 'mySQLite.db'), db_file)
+        try:
+            conn = database.connect(db_file)
+            database.ensure_schema(conn)
+            seed(conn, size, rng)
+            cursor = conn.cursor()
+            for keyword in KEYWORDS:
+                like_times = timed(lambda: like_scan(cursor, keyword), args.runs)
+                fts_times = timed(lambda: search.search_recipes(cursor, keyword), args.runs)
+                print("%10d %-14s %12.2f %12.2f %12.2f %12.2f" % (
+                    size, keyword, percentile(like_times, 50) * 1000, percentile(like_times, 99) * 1000,
+                    percentile(fts_times, 50) * 1000, percentile(fts_times, 99) * 1000))
+            conn.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# Benchmark and check: how long a new worker takes to start and answer its first request
+# Run from the RecipePageProject folder: python benchmarks/bench_startup.py [--runs 5] [--budget-ms 1000] [--server]
+# each run starts a new python process in a temporary copy of the site, imports main.py, creates the app and sends
+# /login through the test client. the table gives the time to create the app and to the first response, counted from
+# the moment the process was started, and the -X importtime breakdown of the modules main.py imports. with --server, a gunicorn
+# master with one worker is started too and timed to its first answer from /health, then its worker is killed and
+# the replacement the master forks is timed the same way (Linux only).
+# exits with status 1 if the median time to the first response is over --budget-ms, so a change that makes workers
+# slow to start fails the check
+import argparse
+import http.client
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from harness import PROJECT_DIR, child_pids, free_port, percentile
+
+# run inside the new process: print the wall clock times at which the app was created and the first response came
+# back
+CHILD = """
+import json, time
+import main
+app = main.create_app()
+imported = time.time()
+response = app.test_client().get('/login')
+assert response.status_code == 200, response.status_code
+print(json.dumps({'imported': imported, 'responded': time.time()}))
+main.shutdown()
+"""
+
+# modules listed in the breakdown
+TOP_MODULES = 15
+
+
+# Start a new process, import main and send the first request
+# returns (seconds to imported, seconds to first response, importtime lines)
+def start_once(site_dir):
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR, RECIPE_LOG_LEVEL='WARNING')
+    started = time.time()
+    child = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD], cwd=site_dir, env=env,
+                           capture_output=True, text=True, check=True)
+    times = json.loads(child.stdout.strip().splitlines()[-1])
+    return times['imported'] - started, times['responded'] - started, child.stderr.splitlines()
+
+
+# Modules imported directly by main, as (module, microseconds including what they import, microseconds of their own)
+# -X importtime writes one line per module: 'import time: self | cumulative | <indent>name', indented two spaces per
+# level and written once the module has finished loading - so main's own imports are the lines one level down
+# that come after the previous top level module and before main
+def main_imports(lines):
+    modules = []
+    for line in lines:
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$', line)
+        if not match:
+            continue
+        own, total, indent, name = int(match.group(1)), int(match.group(2)), len(match.group(3)), match.group(4)
+        if indent == 2:
+            modules.append((name, total, own))
+        elif indent == 0:
+            if name == 'main':
+                modules.append(('main (its own code)', total, own))
+                return sorted(modules, key=lambda module: module[1], reverse=True)
+            modules = []
+    return []
+
+
+# Seconds from started (time.monotonic()) until /health on port answers
+def wait_health(port, started, timeout=30):
+    while time.monotonic() - started < timeout:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                return time.monotonic() - started
+        except OSError:
+            pass
+        time.sleep(0.01)
+    raise RuntimeError("server did not answer")
+
+
+# Start gunicorn with one worker, and return the seconds until /health first answers
+# and the seconds until it answers again once that worker has been killed
+def server_once(site_dir):
+    port = free_port()
+    env = dict(os.environ, RECIPE_BIND='127.0.0.1:%d' % port, RECIPE_SECRET_KEY='bench', RECIPE_WORKERS='1',
+               RECIPE_LOG_LEVEL='WARNING')
+    started = time.monotonic()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(PROJECT_DIR, 'gunicorn.conf.py'),
+                               '--chdir', site_dir, '--pythonpath', PROJECT_DIR, 'wsgi:create_app()'],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first = wait_health(port, started)
+        worker = child_pids(server.pid)[0]
+        killed = time.monotonic()
+        os.kill(worker, signal.SIGKILL)
+        # the old worker may answer once more before the signal lands - wait for it to be gone
+        while os.path.exists('/proc/%d/status' % worker) and 'zombie' not in open('/proc/%d/status' % worker).read():
+            time.sleep(0.001)
+        return first, wait_health(port, killed)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time a new worker from start to its first response.")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=1000, help="most the median first response may take")
+    parser.add_argument('--server', action='store_true', help="also time gunicorn to its first answer")
+    args = parser.parse_args()
+
+    site_dir = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(PROJECT_DIR, 'mySQLite.db'), site_dir)
+        # the first start migrates the copy and fills the template cache, as a deployment's first worker would
+        start_once(site_dir)
+        runs = [start_once(site_dir) for _ in range(args.runs)]
+        imported = [run[0] for run in runs]
+        responded = [run[1] for run in runs]
+        median_run = sorted(runs, key=lambda run: run[1])[len(runs) // 2]
+
+        print("%-28s %12s %12s" % ("modules imported by main", "total ms", "own ms"))
+        for name, total, own in main_imports(median_run[2])[:TOP_MODULES]:
+            print("%-28s %12.1f %12.1f" % (name, total / 1000, own / 1000))
+        print()
+        print("%-28s %12s %12s" % ("", "p50 ms", "max ms"))
+        print("%-28s %12.1f %12.1f" % ("process start to imported", percentile(imported, 50) * 1000,
+                                       max(imported) * 1000))
+        print("%-28s %12.1f %12.1f" % ("process start to response", percentile(responded, 50) * 1000,
+                                       max(responded) * 1000))
+        if args.server:
+            served = [server_once(site_dir) for _ in range(args.runs)]
+            for name, times in (("gunicorn start to /health", [run[0] for run in served]),
+                                ("worker killed to /health", [run[1] for run in served])):
+                print("%-28s %12.1f %12.1f" % (name, percentile(times, 50) * 1000, max(times) * 1000))
+    finally:
+        shutil.rmtree(site_dir, ignore_errors=True)
+
+    if percentile(responded, 50) * 1000 > args.budget_ms:
+        print("First response took %.0f ms, over the budget of %.0f ms." % (percentile(responded, 50) * 1000,
+                                                                          args.budget_ms), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# Benchmark: peak server memory while 50 clients upload 5 MB images at the same time
+# The app runs in a separate process behind a threaded HTTP server and its peak RSS is read from /proc (Linux only)
+# Run from the RecipePageProject folder: python benchmarks/bench_upload.py [--clients 50] [--size-mb 5]
+import argparse
+import http.client
+import io
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from harness import temp_app
+
+BOUNDARY = 'benchboundary'
+
+
+def serve(port):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    # do not print a line for every request
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+    with temp_app() as app_module:
+        with app_module.app.app_context():
+            conn = app_module.get_db()
+            password = app_module.password_hasher.hash('bench')
+            conn.execute("INSERT INTO USER (Username, Password, Email) VALUES ('bench', ?, 'bench@example.com')", (password,))
+            conn.commit()
+        server = make_server('127.0.0.1', port, app_module.app, threaded=True, request_handler=QuietHandler)
+        print('ready', flush=True)
+        server.serve_forever()
+
+
+def memory_kb(pid, field):
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+# a small valid JPEG followed by padding - image readers ignore bytes after the end of the picture
+def make_image(size):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (180, 120, 60)).save(buffer, 'JPEG')
+    head = buffer.getvalue()
+    return head + b'\0' * (size - len(head))
+
+
+def upload(port, cookie, image, results):
+    fields = b''
+    for name, value in (('recipeName', uuid.uuid4().hex), ('info', 'info'), ('time', '5 minutes'), ('steps', 'steps')):
+        fields += ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (BOUNDARY, name, value)).encode()
+    fields += ('--%s\r\nContent-Disposition: form-data; name="image"; filename="bench.jpg"\r\n'
+               'Content-Type: image/jpeg\r\n\r\n' % BOUNDARY).encode()
+    footer = ('\r\n--%s--\r\n' % BOUNDARY).encode()
+    # every upload differs so none are stored only once by the content hashing
+    unique = uuid.uuid4().bytes
+    parts = [fields, image[:-len(unique)], unique, footer]
+
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    start = time.perf_counter()
+    connection.request('POST', '/addRecipeAction', body=iter(parts), headers={
+        'Content-Type': 'multipart/form-data; boundary=%s' % BOUNDARY,
+        'Content-Length': str(sum(len(part) for part in parts)),
+        'Cookie': cookie,
+    })
+    response = connection.getresponse()
+    response.read()
+    results.append((response.status, response.getheader('Location'), time.perf_counter() - start))
+    connection.close()
+
+
+def login(port):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    connection.request('POST', '/loginAction', body='username=bench&password=bench',
+                       headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    response = connection.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie').split(';', 1)[0]
+    connection.close()
+    return cookie
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure server RSS during concurrent image uploads.")
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--size-mb', type=float, default=5)
+    parser.add_argument('--port', type=int, default=5057)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port)
+        return
+
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--port', str(args.port)],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        server.stdout.readline()
+        cookie = login(args.port)
+        # just under the limit, which is checked against the whole file
+        image = make_image(int(args.size_mb * 1024 * 1024) - 1024)
+        before = memory_kb(server.pid, 'VmRSS')
+
+        results = []
+        threads = [threading.Thread(target=upload, args=(args.port, cookie, image, results)) for _ in range(args.clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        peak = memory_kb(server.pid, 'VmHWM')
+    finally:
+        server.terminate()
+        server.wait()
+
+    accepted = sum(1 for status, location, _ in results if status == 302 and location.endswith('/profile'))
+    print("uploads: %d of %d accepted in %.2f s" % (accepted, args.clients, elapsed))
+    print("server RSS before: %.1f MB, peak: %.1f MB, growth: %.1f MB (%.2f MB per upload)" % (
+        before / 1024, peak / 1024, (peak - before) / 1024, (peak - before) / 1024 / args.clients))
+
+
+if __name__ == '__main__':
+    main()
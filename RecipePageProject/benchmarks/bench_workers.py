@@ -0,0 +1,86 @@
+# Load test: throughput of the production server (gunicorn, see gunicorn.conf.py) with 1, 2, 4 and 8 worker processes
+# Run from the RecipePageProject folder: python benchmarks/bench_workers.py [--workers 1 2 4 8] [--seconds 10]
+# needs gunicorn installed. The server runs against a temporary copy of the database
+# and the result cache is turned off, so every request renders its page
+import argparse
+import http.client
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from harness import PROJECT_DIR, WORDS, gunicorn_server, percentile, seed_recipes
+
+
+# One load generating process - sends requests over a keep-alive connection until the time is up
+def client(port, seconds, seed_value, results):
+    rng = random.Random(seed_value)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    latencies = []
+    errors = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        if rng.random() < 0.8:
+            path = '/searchRecipeAction?' + urlencode({'keyword': rng.choice(WORDS)})
+        else:
+            path = '/searchPortfolioAction?user=bench'
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        latencies.append(time.perf_counter() - start)
+    results.put((latencies, errors))
+
+
+def run(workers, args, db_dir):
+    with gunicorn_server(db_dir, WORKERS=workers, THREADS=args.threads, RESULT_CACHE_BYTES=0) as (port, server):
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(port, args.seconds, i, results))
+                   for i in range(args.clients)]
+        for process in clients:
+            process.start()
+        latencies = []
+        errors = 0
+        for _ in clients:
+            client_latencies, client_errors = results.get()
+            latencies += client_latencies
+            errors += client_errors
+        for process in clients:
+            process.join()
+    return len(latencies) / args.seconds, percentile(latencies, 50), percentile(latencies, 99), errors, server.returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure request throughput with different numbers of workers.")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=int, default=10)
+    parser.add_argument('--recipes', type=int, default=5000)
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(PROJECT_DIR, 'mySQLite.db'), db_dir)
+        seed_recipes(os.path.join(db_dir, 'mySQLite.db'), args.recipes, random.Random(42))
+        print("%d cpus, %d threads per worker, %d clients" % (os.cpu_count() or 1, args.threads, args.clients))
+        print("%8s %12s %10s %10s %8s %10s" % ("workers", "requests/s", "p50 ms", "p99 ms", "errors", "exit code"))
+        for workers in args.workers:
+            throughput, p50, p99, errors, code = run(workers, args, db_dir)
+            print("%8d %12.1f %10.2f %10.2f %8d %10s" % (workers, throughput, p50 * 1000, p99 * 1000, errors, code))
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Check: a catalogue written by export-recipes imports again with every recipe and its image
+# Run from the RecipePageProject folder: python benchmarks/check_catalogue.py [--recipes 200] [--images 50]
+# runs on a synthetic site in a temporary folder: exports its recipes in each format to a folder of their own, empties
+# RECIPE and imports the catalogue back, then compares the recipes with those it started with.
+# exits with status 1 if any recipe or image did not come back
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from harness import seed_site
+import catalogue
+import database
+
+UPLOAD_FOLDER = os.path.join('static', 'uploads')
+
+
+def recipes(conn):
+    return sorted(conn.execute("SELECT Username, RecipeName, Info, Time, Steps, ImagePath FROM RECIPE"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the recipes of a site and import them back.")
+    parser.add_argument('--recipes', type=int, default=200)
+    parser.add_argument('--images', type=int, default=50)
+    args = parser.parse_args()
+
+    site_dir = tempfile.mkdtemp()
+    export_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    failures = []
+    try:
+        seed_site(site_dir, 10, args.recipes, 0, args.images, random.Random(42))
+        # image paths are stored relative to the site folder, as the app stores them
+        os.chdir(site_dir)
+        conn = database.connect('mySQLite.db')
+        before = recipes(conn)
+        for fmt in catalogue.FORMATS:
+            path = os.path.join(export_dir, 'recipes.' + fmt)
+            with catalogue.open_output(path) as out:
+                written = catalogue.export_recipes(conn, out, fmt, upload_folder=UPLOAD_FOLDER)
+            conn.execute("DELETE FROM RECIPE")
+            conn.commit()
+            counts = catalogue.import_recipes(conn, path, fmt, UPLOAD_FOLDER, log=lambda message: None)
+            after = recipes(conn)
+            lost = len(set(before) - set(after))
+            with_images = sum(1 for row in after if row[5] is not None)
+            ok = written == len(before) and counts['added'] == len(before) and not lost
+            print("%-4s %-5s exported %d, imported %d, %d with an image, %d lost" % (
+                "ok" if ok else "FAIL", fmt, written, counts['added'], with_images, lost))
+            if not ok:
+                failures.append(fmt)
+        conn.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(site_dir, ignore_errors=True)
+        shutil.rmtree(export_dir, ignore_errors=True)
+
+    if failures:
+        print("\nRecipes were lost in the round trip through %s." % ', '.join(failures))
+        sys.exit(1)
+    print("\nEvery recipe came back with its image.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Check: recipe times are read as the minutes a cook would read them as
+# Run from the RecipePageProject folder: python benchmarks/check_cooktime.py
+# prints each time with the minutes read from it and exits with status 1 if any of them is wrong
+import sys
+
+import harness  # puts the project folder on the import path
+from cooktime import MAX_MINUTES, parse_minutes
+
+# Time text -> minutes it takes (None if no time can be read from it)
+CASES = {
+    '20 minutes': 20,
+    '1 hour': 60,
+    '30 seconds': 1,
+    '1.5 hours': 90,
+    '1,5 h': 90,
+    '1 1/2 hours': 90,
+    '3/4 hour': 45,
+    '2-3 hours': 180,
+    '2 to 3 hours': 180,
+    'about 2 days': 2 * 24 * 60,
+    'Prep 10 mins, cook 1h': 70,
+    # a number without a unit is minutes straight after hours, or when it is the whole time
+    '1h30': 90,
+    '1 hour 30': 90,
+    '2hrs 15': 135,
+    '90': 90,
+    ' 20-30 ': 30,
+    # ...and nowhere else
+    'serves 4, 20 mins': 20,
+    '1 hour, 2 eggs': 60,
+    '1 hour and 30': 60,
+    '2 eggs': None,
+    'preheat to 200': None,
+    # a number is read whole, never the start of a longer one
+    'Bake at 180C for 25 mins': 25,
+    '1.5x': None,
+    'gas mark 4, 1h': 60,
+    # nothing to read, or too long to be a real time
+    '': None,
+    'until golden': None,
+    '9' * 400 + ' minutes': None,
+    '%d minutes' % (MAX_MINUTES + 1): None,
+}
+
+
+def main():
+    failures = []
+    for text, expected in CASES.items():
+        minutes = parse_minutes(text)
+        print("%-4s %-28r %s" % ("ok" if minutes == expected else "FAIL", text[:24], minutes))
+        if minutes != expected:
+            failures.append("%r read as %s, not %s" % (text[:24], minutes, expected))
+
+    if failures:
+        print("\n%d times read wrongly:\n  %s" % (len(failures), '\n  '.join(failures)))
+        sys.exit(1)
+    print("\nEvery time is read as expected.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Check: a cursor from the request, however it has been tampered with, is read as no cursor - never a server error
+# Run from the RecipePageProject folder: python benchmarks/check_cursors.py
+# runs against a temporary copy of the database, seeded so every order has more than one page.
+# prints each cursor with the status of every list page given it and exits with status 1 if any of them fails
+import os
+import random
+import shutil
+import sys
+import tempfile
+from urllib.parse import urlencode
+
+from harness import PROJECT_DIR, logged_in_client, seed_recipes, temp_app
+from pagination import decode_cursor, encode_cursor, text
+
+# cursors that are not what a page handed out: label -> cursor
+TAMPERED = {
+    'deeply nested': '-' * 3000 + '1:1',
+    'huge expression': '-' * 10000 + '1:1',
+    'lone surrogate (old quoted form)': "'\\ud800':1",
+    'lone surrogate (base64url)': '7aCA:1',
+    'not base64url': '!!:1',
+    'truncated base64url': 'A:1',
+    'too few keys': 'YQ',
+    'huge number': 'YQ:' + '9' * 5000,
+    'number out of range': 'YQ:%d' % 2 ** 63,
+}
+
+# the list pages that take a cursor - sort=name is the order keyed on text
+PAGES = ('/searchRecipeAction?%s', '/api/search?%s', '/searchPortfolioAction?%s')
+
+
+def main():
+    failures = []
+    # text keys must come back as they went in, ':' and all
+    for name in ('Shortbread', 'Crème brûlée: the classic', "Nan's 'best' cake", ''):
+        if decode_cursor(encode_cursor((name, 7)), (text, int)) != (name, 7):
+            failures.append('round trip of %r' % name)
+    for label, cursor in TAMPERED.items():
+        if decode_cursor(cursor, (text, int)) is not None:
+            failures.append('decoded %s' % label)
+
+    site_dir = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(PROJECT_DIR, 'mySQLite.db'), site_dir)
+        seed_recipes(os.path.join(site_dir, 'mySQLite.db'), 100, random.Random(42))
+        with temp_app(site_dir) as main_module:
+            client = logged_in_client(main_module.app, 'bench')
+            for label, cursor in TAMPERED.items():
+                statuses = []
+                for page in PAGES:
+                    for direction in ('after', 'before'):
+                        for sort in ('name', 'time', 'newest'):
+                            params = {'keyword': '', 'user': 'bench', 'sort': sort, direction: cursor}
+                            url = page % urlencode(params)
+                            response = client.get(url)
+                            statuses.append(response.status_code)
+                            if response.status_code >= 500:
+                                failures.append('%s %s' % (label, url[:80]))
+                print("%-4s %-34s %s" % ("FAIL" if max(statuses) >= 500 else "ok", label, sorted(set(statuses))))
+    finally:
+        shutil.rmtree(site_dir, ignore_errors=True)
+
+    if failures:
+        print("\n%d checks failed:\n  %s" % (len(failures), '\n  '.join(failures)))
+        sys.exit(1)
+    print("\nEvery tampered cursor is read as no cursor.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Check: no query the app runs reads a whole table (EXPLAIN QUERY PLAN shows no SCAN of USER, RECIPE or FAVOURITE,
+# other than one that reads a page in index order and stops at its LIMIT - and only if it skips no rows on the way)
+# Run from the RecipePageProject folder: python benchmarks/check_query_plans.py [--recipes 2000]
+# runs against a migrated temporary copy of the database, seeded so the planner statistics look like a real site.
+# prints the plan of every query and exits with status 1 if any of them scans a table
+import argparse
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+
+from harness import PROJECT_DIR, seed_recipes
+import database
+import repository
+import search
+from pagination import keyset_query
+
+# the pages of the paged queries, as pagination.keyset_page runs them: name -> (keys, descending)
+PAGED = {'user_recipes': (('ID',), False)}
+# the walks of an order that search.few_within only chooses when enough recipes are within the time limit to fill a
+# page after a bounded number of rows - the recipes they skip on the way do not make them read the whole table
+WALKED = set()
+for keyword in (True, False):
+    for max_time in (False, True):
+        for sort, (keys, _, descending) in search.SORTS.items():
+            if keyword or sort != 'relevance':
+                PAGED[search.query_name(keyword, max_time, sort)] = (keys, descending)
+                if search.chosen_by_selectivity(keyword, max_time, sort):
+                    PAGED[search.query_name(keyword, max_time, sort, selective=True)] = (keys, descending)
+                    WALKED.add(search.query_name(keyword, max_time, sort))
+
+
+# a column compared in a WHERE clause, and the columns an index search uses ('(Username=? AND rowid>?)')
+COMPARED = re.compile(r'(?:\w+\.)?(\w+)\s*(?:[<>]?=|[<>]|IS NOT NULL)')
+SEARCHED = re.compile(r'(\w+)[<>=]')
+
+
+# every statement to check: name -> (SQL, columns the query filters its rows on)
+# the paged queries only ever run as pages, so only their pages are checked - their filters are those of the query,
+# not the cursor's position
+def statements():
+    result = {name: (sql, filters(sql)) for name, sql in repository.QUERIES.items() if name not in PAGED}
+    for name, (keys, descending) in PAGED.items():
+        query = repository.QUERIES[name]
+        filtered = set() if name in WALKED else filters(query)
+        result[name + ' first page'] = (keyset_query(query, keys, descending=descending), filtered)
+        result[name + ' next page'] = (keyset_query(query, keys, continued=True, descending=descending), filtered)
+        result[name + ' previous page'] = (keyset_query(query, keys, continued=True, backwards=True,
+                                                        descending=descending), filtered)
+    return result
+
+
+# Columns compared in the WHERE clause of sql - ID is the rowid, as the plans call it
+def filters(sql):
+    where = re.split(r' WHERE ', sql, maxsplit=1)
+    if len(where) < 2:
+        return set()
+    where = re.split(r' (?:ORDER BY|GROUP BY|LIMIT|RETURNING) ', where[1])[0]
+    return {'rowid' if column == 'ID' else column for column in COMPARED.findall(where)}
+
+
+# A step of the plan that reads every row of a table (or of an index) - the full-text index is searched, not read
+# a walk through a table or index in the page's order (no temporary b-tree to sort) stops at the LIMIT, so it only
+# reads the rows of one page - unless it skips rows on a column its index does not search, as then a filter that
+# few rows pass makes it read most of the table to fill the page
+def is_scan(detail, plan, sql, filtered):
+    if not detail.startswith(('SCAN ', 'SEARCH ')) or 'VIRTUAL TABLE' in detail:
+        return False
+    ordered = sql.rstrip().endswith('LIMIT ?') and not any('TEMP B-TREE' in step for step in plan)
+    if detail.startswith('SCAN '):
+        return not ordered or bool(filtered)
+    # a search reads only the rows its index finds - the walk in page order is the outer loop of the plan
+    searched = set(SEARCHED.findall(detail.rsplit('(', 1)[-1]))
+    return ordered and detail == plan[0] and not filtered <= searched
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fail if any query of the app scans a whole table.")
+    parser.add_argument('--recipes', type=int, default=2000)
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(db_dir, 'mySQLite.db')
+        shutil.copy(os.path.join(PROJECT_DIR, 'mySQLite.db'), db_file)
+        seed_recipes(db_file, args.recipes, random.Random(42))
+        conn = database.connect(db_file)
+        conn.execute("ANALYZE")
+        failures = []
+        for name, (sql, filtered) in statements().items():
+            # the values do not matter to the plan, only how many there are
+            params = (1,) * sql.count('?')
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+            scans = [detail for detail in plan if is_scan(detail, plan, sql, filtered)]
+            print("%-4s %s" % ("FAIL" if scans else "ok", name))
+            for detail in plan:
+                print("       %s" % detail)
+            if scans:
+                failures.append(name)
+        conn.close()
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+    if failures:
+        print("\n%d queries scan a whole table: %s" % (len(failures), ', '.join(failures)))
+        sys.exit(1)
+    print("\nNo query scans a whole table.")
+
+
+if __name__ == '__main__':
+    main()
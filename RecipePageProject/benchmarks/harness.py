@@ -0,0 +1,246 @@
+# shared helpers for the benchmark scripts
+# the app is always run against a temporary copy of mySQLite.db so the shipped database is never touched
+import contextlib
+import http.client
+import io
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PROJECT_DIR)
+
+
+# Import main.py and create its app inside a temporary working directory holding a copy of the database
+# or a copy of site_dir (a database and its uploads, see seed_site) instead of the shipped database
+@contextlib.contextmanager
+def temp_app(site_dir=None):
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    if site_dir is None:
+        shutil.copy(os.path.join(PROJECT_DIR, 'mySQLite.db'), tmpdir)
+        os.makedirs(os.path.join(tmpdir, 'static', 'uploads'))
+    else:
+        shutil.copytree(site_dir, tmpdir, dirs_exist_ok=True)
+    os.chdir(tmpdir)
+    try:
+        import main
+        main.create_app()
+        main.app.config['TESTING'] = True
+        yield main
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# Return a test client that is logged in as username without going through bcrypt
+def logged_in_client(app, username):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = username
+        session['_fresh'] = True
+    return client
+
+
+# Time fn over a number of runs and return the durations in seconds
+def timed(fn, runs):
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+# Value at percentile p (0-100) of a list of numbers
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+WORDS = ("butter sugar flour egg chocolate vanilla lemon ginger oat raspberry cream cheese cake cookie tart "
+         "bread loaf bun muffin scone pie crumble caramel toffee honey almond walnut cinnamon nutmeg apple").split()
+
+
+# Add the user 'bench' (password 'bench') - recipes must belong to a user that exists
+def add_bench_user(conn):
+    import bcrypt
+    conn.execute("INSERT OR IGNORE INTO USER (Username, Password, Email) VALUES (?, ?, ?)",
+                 ('bench', bcrypt.hashpw(b'bench', bcrypt.gensalt(4)).decode('utf-8'), 'bench@example.com'))
+
+
+# Cook time of the i-th synthetic recipe, 5 minutes to 4 hours - spread out without drawing from the seeded rng,
+# so the rest of the synthetic site is the same as before recipes had times
+def cook_minutes(i):
+    return 5 + (i * 37) % 236
+
+
+# Add count recipes by the user 'bench' to the database in db_file
+def seed_recipes(db_file, count, rng):
+    import database
+    conn = database.connect(db_file)
+    database.ensure_schema(conn)
+    add_bench_user(conn)
+    rows = [("bench", ' '.join(rng.sample(WORDS, 3)) + " %d" % i, ' '.join(rng.sample(WORDS, 10)),
+             "%d minutes" % cook_minutes(i), cook_minutes(i), ' '.join(rng.choice(WORDS) for _ in range(80)))
+            for i in range(count)]
+    conn.executemany("INSERT INTO RECIPE (Username, RecipeName, Info, Time, Minutes, Steps) VALUES (?, ?, ?, ?, ?, ?)",
+                     rows)
+    conn.commit()
+    conn.close()
+
+
+# Make a synthetic site in site_dir - a new mySQLite.db and the images in static/uploads - and return the recipe IDs
+# users are user0, user1, ... all with the password 'bench'; recipes are shared out between them in turn,
+# favourites are random (user, recipe) pairs and the first `images` recipes get an image with its renditions
+def seed_site(site_dir, users, recipes, favourites, images, rng):
+    import bcrypt
+    import database
+    from images import ImagePipeline
+    upload_folder = os.path.join('static', 'uploads')
+    conn = database.connect(os.path.join(site_dir, 'mySQLite.db'))
+    cwd = os.getcwd()
+    # image paths are stored relative to the site folder, as the app stores them
+    os.chdir(site_dir)
+    try:
+        database.ensure_schema(conn)
+        password = bcrypt.hashpw(b'bench', bcrypt.gensalt(4)).decode('utf-8')
+        conn.executemany("INSERT INTO USER (Username, Password, Email, First_Name, Last_Name) VALUES (?, ?, ?, ?, ?)",
+                         [('user%d' % i, password, 'user%d@example.com' % i, 'First', 'Last') for i in range(users)])
+        rows = [('user%d' % (i % users), ' '.join(rng.sample(WORDS, 3)) + " %d" % i, ' '.join(rng.sample(WORDS, 10)),
+                 "%d minutes" % cook_minutes(i), cook_minutes(i), ' '.join(rng.choice(WORDS) for _ in range(80)))
+                for i in range(recipes)]
+        conn.executemany("INSERT INTO RECIPE (Username, RecipeName, Info, Time, Minutes, Steps) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        ids = [row[0] for row in conn.execute("SELECT ID FROM RECIPE ORDER BY ID")]
+        pairs = [('user%d' % rng.randrange(users), rng.choice(ids)) for _ in range(favourites)]
+        conn.executemany("INSERT OR IGNORE INTO FAVOURITE (Username, RecipeID) VALUES (?, ?)", pairs)
+        pipeline = ImagePipeline(upload_folder, pool=None)
+        for recipe_id in ids[:images]:
+            path, _ = pipeline.store(io.BytesIO(make_image(rng)), 'jpg')
+            paths = pipeline.make_renditions(path)
+            conn.execute("UPDATE RECIPE SET ImagePath = ?, ImageThumb = ?, ImageCard = ?, ImageFull = ? WHERE ID = ?",
+                         (path, paths['thumb'], paths['card'], paths['full'], recipe_id))
+        pipeline.shutdown()
+        conn.commit()
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        os.chdir(cwd)
+        conn.close()
+    return ids
+
+
+# A small JPEG with a random colour followed by random bytes, so no two are stored as one file
+# image readers ignore bytes after the end of the picture
+def make_image(rng, size=32):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), (rng.randrange(256), rng.randrange(256), rng.randrange(256))).save(buffer, 'JPEG')
+    return buffer.getvalue() + rng.randbytes(16)
+
+
+BOUNDARY = 'benchboundary'
+
+
+# Body of a multipart/form-data POST with the text fields and, if given, a JPEG as the field 'image'
+def multipart_body(fields, image=None):
+    body = b''
+    for name, value in fields.items():
+        body += ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (BOUNDARY, name, value)).encode()
+    if image is not None:
+        body += ('--%s\r\nContent-Disposition: form-data; name="image"; filename="bench.jpg"\r\n'
+                 'Content-Type: image/jpeg\r\n\r\n' % BOUNDARY).encode() + image + b'\r\n'
+    return body + ('--%s--\r\n' % BOUNDARY).encode()
+
+
+# Highest resident memory of a process since it started or since reset_peak_memory (KiB, Linux only)
+def peak_memory_kb(pid):
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_memory(pid):
+    try:
+        with open('/proc/%d/clear_refs' % pid, 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+# Process IDs of the direct children of a process - the gunicorn workers of its master (Linux only)
+def child_pids(pid):
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as children:
+            return [int(child) for child in children.read().split()]
+    except OSError:
+        return []
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/ready')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+
+# Run the production server (gunicorn.conf.py) in db_dir with RECIPE_ settings from env, yielding its port
+# it is stopped with SIGTERM, as a process manager would - server.returncode is 0 after a clean shutdown
+@contextlib.contextmanager
+def gunicorn_server(db_dir, **env):
+    port = free_port()
+    env = dict(os.environ, RECIPE_BIND='127.0.0.1:%d' % port, RECIPE_SECRET_KEY='bench',
+               **{'RECIPE_' + name: str(value) for name, value in env.items()})
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(PROJECT_DIR, 'gunicorn.conf.py'),
+                               '--chdir', db_dir, '--pythonpath', PROJECT_DIR, 'wsgi:create_app()'],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        wait_ready(port)
+        yield port, server
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+# Log in to the server and return the session cookie
+def login(port, username='bench', password='bench'):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('POST', '/loginAction', body=urlencode({'username': username, 'password': password}),
+                 headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie')
+    if not cookie or response.getheader('Location', '').endswith('/login'):
+        raise RuntimeError("benchmark login failed")
+    return cookie.split(';')[0]
@@ -0,0 +1,220 @@
+# small in-process caches shared by the routes
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+
+# A thread-safe least-recently-used cache with an optional time-to-live (seconds)
+class LRUCache():
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Return the cached value for key, or default if it is missing or has expired
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    # Snapshot of the cache metrics
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+# A cache of rendered HTML fragments, bounded by the memory they use rather than by the number of entries
+# entries carry tags (such as 'recipe:5' or 'owner:Cian') so everything built from some piece of data
+# can be dropped at once when that data changes.
+# with disk_dir set, entries pushed out of memory are kept in files there until the disk limit is reached.
+# the disk tier belongs to this process only and starts empty - it holds overflow, not saved state
+class FragmentCache():
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=None, disk_dir=None, max_disk_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_dir = None
+        if disk_dir:
+            self.disk_dir = os.path.join(disk_dir, 'fragments-%d' % os.getpid())
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+            os.makedirs(self.disk_dir)
+        # key -> (value, size, expires)
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # key -> (file name, size, expires)
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        # tag -> keys, key -> tags
+        self._tagged = defaultdict(set)
+        self._tags = {}
+        self._lock = threading.Lock()
+        # metrics
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None and (item[2] is None or item[2] >= now):
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return item[0]
+            item = self._disk.get(key)
+            if item is not None and (item[2] is None or item[2] >= now):
+                try:
+                    with open(item[0], 'r', encoding='utf-8') as handle:
+                        value = handle.read()
+                except OSError:
+                    value = None
+                if value is not None:
+                    # move it back into memory
+                    self._remove(key, keep_tags=True)
+                    self._store_memory(key, value, item[1], item[2])
+                    self.disk_hits += 1
+                    return value
+            if key in self._tags:
+                # expired or unreadable
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, tags=()):
+        size = len(value.encode('utf-8'))
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._tags[key] = set(tags)
+            for tag in tags:
+                self._tagged[tag].add(key)
+            self._store_memory(key, value, size, expires)
+
+    # Drop every entry carrying tag
+    def invalidate_tag(self, tag):
+        with self._lock:
+            for key in list(self._tagged.get(tag, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._tags):
+                self._remove(key)
+
+    # Snapshot of the cache metrics
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._memory),
+                'bytes': self._memory_bytes,
+                'max_bytes': self.max_bytes,
+                'disk_entries': len(self._disk),
+                'disk_bytes': self._disk_bytes,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    # the methods below must be called with self._lock held
+    def _store_memory(self, key, value, size, expires):
+        self._memory[key] = (value, size, expires)
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_bytes:
+            old_key, (old_value, old_size, old_expires) = self._memory.popitem(last=False)
+            self._memory_bytes -= old_size
+            if not self._store_disk(old_key, old_value, old_size, old_expires):
+                self._forget_tags(old_key)
+                self.evictions += 1
+
+    def _store_disk(self, key, value, size, expires):
+        if self.disk_dir is None or size > self.max_disk_bytes:
+            return False
+        path = os.path.join(self.disk_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+        try:
+            with open(path, 'w', encoding='utf-8') as handle:
+                handle.write(value)
+        except OSError:
+            return False
+        self._disk[key] = (path, size, expires)
+        self._disk_bytes += size
+        while self._disk_bytes > self.max_disk_bytes:
+            old_key, (old_path, old_size, _) = self._disk.popitem(last=False)
+            self._disk_bytes -= old_size
+            self._delete_file(old_path)
+            self._forget_tags(old_key)
+            self.evictions += 1
+        return True
+
+    def _remove(self, key, keep_tags=False):
+        item = self._memory.pop(key, None)
+        if item is not None:
+            self._memory_bytes -= item[1]
+        item = self._disk.pop(key, None)
+        if item is not None:
+            self._disk_bytes -= item[1]
+            self._delete_file(item[0])
+        if not keep_tags:
+            self._forget_tags(key)
+
+    def _forget_tags(self, key):
+        for tag in self._tags.pop(key, ()):
+            keys = self._tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[tag]
+
+    def _delete_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,278 @@
+# bulk import and export of recipes (python manage.py import-recipes / export-recipes)
+# a catalogue is a JSONL file (one JSON object per line) or a CSV file with a header row, with the fields
+#     username, name, info, time, steps, image
+# image is optional - the path of an image file, relative to the images folder given to the import or, failing that,
+# to the upload folder. the export writes the images of the site relative to its upload folder, so its catalogue
+# imports again on the same site, or on another one given a copy of the folder with --images-dir.
+# both directions stream: the import reads and inserts a batch at a time, the export reads a page of rows at a time,
+# so neither holds the catalogue in memory
+import csv
+import json
+import os
+import sys
+import time
+
+import database
+import repository
+from images import MAGIC_BYTES, ImagePipeline, UploadError
+
+FIELDS = ('username', 'name', 'info', 'time', 'steps', 'image')
+# fields that cannot be empty (the NOT NULL columns of RECIPE)
+REQUIRED = ('username', 'name', 'time', 'steps')
+FORMATS = ('jsonl', 'csv')
+# recipes inserted per transaction, and per page of the export
+BATCH_SIZE = 1000
+# seconds between progress lines
+PROGRESS_EVERY = 2.0
+# records that could not be imported are listed up to this many times
+MAX_REPORTED = 20
+
+
+# Raised for a catalogue that cannot be read at all
+class CatalogueError(Exception):
+    pass
+
+
+# Format of a catalogue from its file name
+def guess_format(path):
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    if extension in ('jsonl', 'ndjson', 'json'):
+        return 'jsonl'
+    if extension == 'csv':
+        return 'csv'
+    raise CatalogueError("Cannot tell the format of %s, use --format %s." % (path, ' or '.join(FORMATS)))
+
+
+# Yield (record number, record dict) for every record in a catalogue, reading one line or row at a time
+def read_records(stream, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        missing = [field for field in REQUIRED if field not in (reader.fieldnames or ())]
+        if missing:
+            raise CatalogueError("CSV header has no column for %s." % ', '.join(missing))
+        for number, row in enumerate(reader, 1):
+            yield number, row
+        return
+    number = 0
+    for line in stream:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            record = {'_error': "not valid JSON (%s)" % e}
+        if not isinstance(record, dict):
+            record = {'_error': "not a JSON object"}
+        yield number, record
+
+
+# Checkpoint - how far an import got, saved after every committed batch so an interrupted import carries on from there
+# it only applies to the same input file, unchanged since the checkpoint was written
+class Checkpoint():
+    def __init__(self, path, input_path):
+        self.path = path
+        info = os.stat(input_path)
+        self.key = {'input': os.path.abspath(input_path), 'size': info.st_size, 'mtime': info.st_mtime}
+
+    # Counts saved by an earlier run of the same import, or None
+    def load(self):
+        try:
+            with open(self.path) as checkpoint_file:
+                saved = json.load(checkpoint_file)
+        except (OSError, ValueError):
+            return None
+        if {name: saved.get(name) for name in self.key} != self.key:
+            return None
+        return saved['counts']
+
+    def save(self, counts):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(dict(self.key, counts=counts), checkpoint_file)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Import the recipes in the catalogue at input_path and return the counts:
+# records read, added, duplicate (the user already has a recipe with that name), invalid, unknown_user
+# recipes are inserted with executemany, batch_size at a time, each batch in its own write transaction.
+# with checkpoint_path, a rerun after an interruption skips the records already committed.
+# images are stored like uploads; run "python manage.py backfill-images" afterwards to make their renditions
+def import_recipes(conn, input_path, fmt=None, upload_folder='static/uploads', images_dir=None,
+                   batch_size=BATCH_SIZE, checkpoint_path=None, log=print):
+    fmt = fmt or guess_format(input_path)
+    if images_dir is None:
+        images_dir = os.path.dirname(os.path.abspath(input_path))
+    images_dirs = (images_dir, upload_folder)
+    checkpoint = Checkpoint(checkpoint_path, input_path) if checkpoint_path else None
+    counts = {'read': 0, 'added': 0, 'duplicate': 0, 'invalid': 0, 'unknown_user': 0}
+    resume_after = 0
+    if checkpoint is not None:
+        saved = checkpoint.load()
+        if saved is not None:
+            counts.update(saved)
+            resume_after = saved['read']
+            log("Resuming after record %d." % resume_after)
+    known_users = {}
+    reported = 0
+    started = last_progress = time.monotonic()
+
+    def problem(number, message):
+        nonlocal reported
+        reported += 1
+        if reported <= MAX_REPORTED:
+            log("Record %d: %s, skipped." % (number, message))
+
+    def commit_batch(batch):
+        added = database.write_transaction(conn, _insert_batch, pipeline, batch)
+        counts['added'] += added
+        counts['duplicate'] += len(batch) - added
+        if checkpoint is not None:
+            checkpoint.save(counts)
+
+    pipeline = ImagePipeline(upload_folder, pool=None, workers=1)
+    with open(input_path, newline='', encoding='utf-8') as stream:
+        batch = []
+        for number, record in read_records(stream, fmt):
+            if number <= resume_after:
+                continue
+            counts['read'] = number
+            values, error = _validate(record)
+            if error is not None:
+                counts['invalid'] += 1
+            elif not _user_exists(conn, known_users, values['username']):
+                error = "user %s does not exist" % values['username']
+                counts['unknown_user'] += 1
+            else:
+                row, error = _prepare(values, images_dirs, pipeline)
+                if error is not None:
+                    counts['invalid'] += 1
+            if error is not None:
+                problem(number, error)
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                commit_batch(batch)
+                batch = []
+                if time.monotonic() - last_progress >= PROGRESS_EVERY:
+                    last_progress = time.monotonic()
+                    log("%d records read, %d added, %.0f records/s." % (
+                        counts['read'], counts['added'], (counts['read'] - resume_after) / (last_progress - started)))
+        if batch:
+            commit_batch(batch)
+        elif checkpoint is not None:
+            # records skipped at the end still move the checkpoint on
+            checkpoint.save(counts)
+    pipeline.shutdown()
+    if reported > MAX_REPORTED:
+        log("%d more records skipped." % (reported - MAX_REPORTED))
+    if checkpoint is not None:
+        checkpoint.remove()
+    return counts
+
+
+# Write every recipe to out (an open text file) as JSONL or CSV, reading batch_size rows at a time
+# each page is its own short read, so a long export does not hold up the database's WAL checkpoints.
+# image paths are written relative to upload_folder, where import_recipes also looks for them
+def export_recipes(conn, out, fmt='jsonl', batch_size=BATCH_SIZE, upload_folder='static/uploads'):
+    if fmt not in FORMATS:
+        raise CatalogueError("Unknown format %r, expected one of %s." % (fmt, ', '.join(FORMATS)))
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, fieldnames=FIELDS, lineterminator='\n')
+        writer.writeheader()
+    written = 0
+    after_id = 0
+    while True:
+        rows = repository.export_recipes(conn, after_id, batch_size)
+        if not rows:
+            break
+        for recipe_id, username, name, info, recipe_time, steps, image_path in rows:
+            record = {'username': username, 'name': name, 'info': info, 'time': recipe_time, 'steps': steps,
+                      'image': _exported_image(image_path, upload_folder) if image_path else None}
+            if writer is not None:
+                writer.writerow(record)
+            else:
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        written += len(rows)
+        after_id = rows[-1][0]
+    return written
+
+
+# The record's fields as strings (None for empty ones), or an error
+def _validate(record):
+    if '_error' in record:
+        return None, record['_error']
+    values = {field: (record.get(field) or None) for field in FIELDS}
+    missing = [field for field in REQUIRED if not values[field]]
+    if missing:
+        return None, "missing %s" % ', '.join(missing)
+    for field in FIELDS:
+        if values[field] is not None and not isinstance(values[field], str):
+            values[field] = str(values[field])
+    return values, None
+
+
+# Path of a stored image as the export writes it - relative to the upload folder, unless it is outside it
+def _exported_image(image_path, upload_folder):
+    # older rows were saved on Windows with backslashes in the path
+    image_path = image_path.replace('\\', '/')
+    relative = os.path.relpath(image_path, upload_folder).replace('\\', '/')
+    return image_path if relative.startswith('../') else relative
+
+
+# Turn valid fields into (row for repository.import_recipes, True if the image file is new), or return an error
+# the image is stored here, before the batch's transaction, so no file is copied while the write lock is held
+# it is looked for in each of images_dirs in turn
+def _prepare(values, images_dirs, pipeline):
+    image_path, created = None, False
+    if values['image']:
+        source = _image_source(values['image'].replace('\\', '/'), images_dirs)
+        extension = os.path.splitext(source)[1].lower().lstrip('.')
+        if extension not in MAGIC_BYTES:
+            return None, "image %s is not a %s file" % (values['image'], ', '.join(MAGIC_BYTES))
+        try:
+            with open(source, 'rb') as image_file:
+                image_path, created = pipeline.store(image_file, extension)
+        except (OSError, UploadError) as e:
+            return None, "image %s: %s" % (values['image'], e)
+    row = (values['username'], values['name'], values['info'], values['time'], values['steps'], image_path)
+    return (row, created), None
+
+
+# The first of images_dirs holding the image, or the path in the first one if none of them do
+def _image_source(image, images_dirs):
+    for images_dir in images_dirs:
+        source = os.path.join(images_dir, image)
+        if os.path.isfile(source):
+            return source
+    return os.path.join(images_dirs[0], image)
+
+
+# Insert one batch - called inside a write transaction by database.write_transaction
+def _insert_batch(conn, pipeline, batch):
+    added = repository.import_recipes(conn, [row for row, _ in batch])
+    if added < len(batch):
+        # some recipes were duplicates - remove the new image files that no recipe uses
+        # (several records can share one file, only the first of them stored it, and a recipe added through the
+        # site since it was stored may use it too)
+        for path in {row[5] for row, created in batch if created}:
+            pipeline.discard_unused(conn, path)
+    return added
+
+
+def _user_exists(conn, known_users, username):
+    if username not in known_users:
+        known_users[username] = repository.get_user(conn, username) is not None
+    return known_users[username]
+
+
+# Open path for writing, or stdout for '-'
+def open_output(path):
+    if path == '-':
+        return sys.stdout
+    return open(path, 'w', newline='', encoding='utf-8')
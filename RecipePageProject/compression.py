@@ -0,0 +1,117 @@
+# compression of the pages the app renders, for browsers that accept it
+# pages full of recipe steps shrink to a fraction of their size. the coding is picked from the request's
+# Accept-Encoding (brotli before gzip when both are accepted equally), and bodies under COMPRESS_MIN_BYTES are sent
+# as they are, as the saving would not pay for the work. streamed responses (the NDJSON of the API) are compressed
+# a chunk at a time, each flushed as it is written so the client still gets every batch straight away.
+# static files are not touched here - they are sent from their precompressed copies by assets.py
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, without it pages are only sent gzip compressed
+    brotli = None
+
+from flask import request
+
+# types of response worth compressing
+COMPRESSIBLE_TYPES = ('text/html', 'text/plain', 'application/json')
+# types of streamed response worth compressing
+STREAMED_TYPES = ('application/x-ndjson',)
+# smaller bodies are sent uncompressed
+MIN_BYTES = 1024
+# low levels - the page is compressed on every request, so speed matters more than the last few bytes
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+# content coding -> compress function, in order of preference
+CODINGS = {}
+if brotli is not None:
+    CODINGS['br'] = lambda data: brotli.compress(data, quality=BROTLI_QUALITY)
+CODINGS['gzip'] = lambda data: gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+
+# Compressors for a stream, with the same preference as CODINGS: coding -> new object with
+# compress(chunk) (the compressed bytes of everything so far, flushed) and finish() (the last bytes)
+class GzipStream():
+    def __init__(self):
+        # wbits 31 writes a gzip header and trailer around the deflate stream
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, chunk):
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliStream():
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, chunk):
+        return self._compressor.process(chunk) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+STREAM_CODINGS = {}
+if brotli is not None:
+    STREAM_CODINGS['br'] = BrotliStream
+STREAM_CODINGS['gzip'] = GzipStream
+
+
+# Compress the body of response if it is worth it and the browser accepts it
+def compress_response(response, min_bytes=MIN_BYTES):
+    if response.is_streamed and response.status_code == 200 and response.mimetype in STREAMED_TYPES \
+            and 'Content-Encoding' not in response.headers:
+        return compress_stream(response)
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    # the body depends on Accept-Encoding from here on, even when it is sent as it is
+    response.vary.add('Accept-Encoding')
+    if (response.content_length or 0) < min_bytes:
+        return response
+    # the browser's most wanted coding, the first of CODINGS when it wants several equally
+    coding = request.accept_encodings.best_match(list(CODINGS))
+    if coding is None:
+        return response
+    response.set_data(CODINGS[coding](response.get_data()))
+    response.headers['Content-Encoding'] = coding
+    return response
+
+
+# Compress a streamed response chunk by chunk if the browser accepts it - its size is not known up front
+def compress_stream(response):
+    response.vary.add('Accept-Encoding')
+    coding = request.accept_encodings.best_match(list(STREAM_CODINGS))
+    if coding is None:
+        return response
+    response.response = _compressed(response.response, STREAM_CODINGS[coding]())
+    response.headers['Content-Encoding'] = coding
+    return response
+
+
+def _compressed(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        # let the stream end its request context (flask.stream_with_context) even if the client went away
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+# Compress the responses of app, from min_bytes up
+def init_app(app, min_bytes=MIN_BYTES):
+    @app.after_request
+    def compress(response):
+        return compress_response(response, min_bytes)
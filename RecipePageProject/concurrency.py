@@ -0,0 +1,33 @@
+# support for the async server mode (gunicorn's gevent worker, see gunicorn.conf.py)
+# under gevent every request is a greenlet, so one process can hold hundreds of open connections.
+# greenlets only take turns while waiting on the network - a long sqlite query or image resize would stop
+# every other request in the process, so that work is handed to real threads with offload().
+# without gevent offload() just calls the function on the request thread (the sync mode).
+# gevent is never imported here - the gevent worker has imported and patched it before the app is loaded, so in the
+# sync mode a worker starts without paying for it
+import sys
+
+# real threads for offloaded work in each worker process
+OFFLOAD_THREADS = 8
+
+
+# True if this process was started by the gevent worker (which patches threading, sockets, etc.)
+def async_mode():
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+# Call fn(*args, **kwargs) on a real thread when in async mode, otherwise call it directly
+# the calling greenlet waits for the result while the other requests carry on
+def offload(fn, *args, **kwargs):
+    if not async_mode():
+        return fn(*args, **kwargs)
+    import gevent
+    return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+
+
+# Size the thread pool used by offload() - roughly one thread per database connection
+def set_offload_threads(count=OFFLOAD_THREADS):
+    if async_mode():
+        import gevent
+        gevent.get_hub().threadpool.maxsize = count
@@ -0,0 +1,81 @@
+# reading the free-form recipe time ("20 minutes", "1 hr 30 mins", "1.5 hours", "2-3 hours") as whole minutes
+# the minutes are stored next to the text in RECIPE.Minutes, so recipes can be filtered and sorted by how long they
+# take using an index instead of reading every Time. the text itself is still what the pages show
+import math
+import re
+
+# unit as written -> minutes in one of it
+UNITS = (
+    (('days', 'day', 'd'), 24 * 60),
+    (('hours', 'hour', 'hrs', 'hr', 'h'), 60),
+    (('minutes', 'minute', 'mins', 'min', 'm'), 1),
+    (('seconds', 'second', 'secs', 'sec', 's'), 1 / 60),
+)
+UNIT_MINUTES = {spelling: minutes for spellings, minutes in UNITS for spelling in spellings}
+# longest time read from a recipe, a year - anything longer is a typo or a joke, and a number too large for sqlite
+# would stop the recipe being stored at all
+MAX_MINUTES = 365 * 24 * 60
+
+# a number ('2', '1.5', '1 1/2', '3/4'), or a range of them ('2-3', '2 to 3'), and the unit after it if there is one
+# a number is only ever read whole - never the '18' of '180C' - so it may not start or end next to another digit
+NUMBER = r'(?<![\d.,/])(\d+/\d+|\d+(?:[.,]\d+)?(?:\s+\d+/\d+)?)(?![\d/]|[.,]\d)'
+AMOUNT = re.compile(NUMBER + r'(?:\s*(?:-|–|to)\s*' + NUMBER + r')?\s*(' +
+                    # longest spellings first, so 'mins' is not read as 'm'
+                    '|'.join(sorted(UNIT_MINUTES, key=len, reverse=True)) + r')?(?![a-z])', re.IGNORECASE)
+# a number is only read as minutes without a unit straight after an amount of hours ('1h30', '1 hour 30') or
+# when it is the whole time ('90') - elsewhere it counts something else ('serves 4', '2 eggs')
+ONLY_AMOUNT = re.compile(r'\s*' + AMOUNT.pattern + r'\s*', re.IGNORECASE)
+
+
+# Minutes a recipe takes, read from its Time text, or None if no time can be read from it
+# the amounts are added up ('1 hour 20 minutes'), a range counts as its upper end, a number without a unit is
+# minutes where it is one (see ONLY_AMOUNT), and part of a minute counts as a whole one.
+# a time over MAX_MINUTES reads as None
+def parse_minutes(text):
+    if not text:
+        return None
+    whole = ONLY_AMOUNT.fullmatch(text)
+    amounts = [whole.groups()] if whole else _amounts(text)
+    total = 0.0
+    for low, high, unit in amounts:
+        amount = _number(high or low)
+        total += amount * (UNIT_MINUTES[unit.lower()] if unit else 1)
+    # a number with hundreds of digits is read as infinity
+    if not amounts or not math.isfinite(total) or total > MAX_MINUTES:
+        return None
+    return int(math.ceil(total - 1e-9))
+
+
+# The amounts in text that are times - those with a unit, and a number without one straight after hours
+def _amounts(text):
+    amounts = []
+    after_hours = None
+    for match in AMOUNT.finditer(text):
+        low, high, unit = match.groups()
+        if unit or (after_hours is not None and not text[after_hours:match.start()].strip()):
+            amounts.append((low, high, unit))
+        after_hours = match.end() if unit and UNIT_MINUTES[unit.lower()] == 60 else None
+    return amounts
+
+
+# A limit on the minutes a recipe takes, from a form or URL, or None if it is not a whole number
+# a limit over MAX_MINUTES is read as MAX_MINUTES, which every recipe with a time is within
+def parse_limit(text):
+    try:
+        minutes = int(text)
+    except ValueError:
+        return None
+    if minutes < 0:
+        return None
+    return min(minutes, MAX_MINUTES)
+
+
+def _number(text):
+    total = 0.0
+    for part in text.replace(',', '.').split():
+        if '/' in part:
+            numerator, denominator = part.split('/')
+            total += float(numerator) / float(denominator) if float(denominator) else 0.0
+        else:
+            total += float(part)
+    return total
@@ -0,0 +1,284 @@
+# connection management for the SQLite database
+# keeps a bounded pool of long-lived connections instead of opening the database file on every request
+import queue
+import random
+import sqlite3
+import threading
+import time
+from sqlite3 import Error
+from flask import current_app, g
+import concurrency
+import migrations
+
+# number of connections kept open - roughly one per worker thread
+POOL_SIZE = 8
+# how long a request waits for a free connection before giving up (seconds)
+CHECKOUT_TIMEOUT = 10.0
+# connections older than this are closed and reopened when they are returned (seconds)
+MAX_CONNECTION_AGE = 3600
+# how long sqlite waits on a locked database before raising "database is locked" (seconds)
+BUSY_TIMEOUT = 5.0
+# attempts at a write transaction that is still locked out after BUSY_TIMEOUT, and the pause before the first retry
+WRITE_ATTEMPTS = 3
+RETRY_DELAY = 0.05
+# number of compiled statements sqlite3 keeps per connection - the routes use a few dozen distinct queries
+STATEMENT_CACHE_SIZE = 256
+
+# tuning applied to every new connection
+# WAL lets readers run alongside a writer, cache_size is in KiB when negative, mmap_size is in bytes
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    # sqlite only enforces REFERENCES (and ON DELETE CASCADE) when this is on, and it is off by default
+    "PRAGMA foreign_keys=ON",
+    # PRAGMA optimize looks at a sample of each index rather than all of it
+    "PRAGMA analysis_limit=1000",
+)
+
+
+# A connection that counts the queries run on it (see repository.py) - read by the per-request metrics
+class Connection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def record_query(self, seconds):
+        self.queries += 1
+        self.query_seconds += seconds
+
+    # Return (queries, seconds) since the last call and start counting again
+    def take_query_counts(self):
+        counts = (self.queries, self.query_seconds)
+        self.queries = 0
+        self.query_seconds = 0.0
+        return counts
+
+
+# Open a single tuned connection to the database
+def connect(db_file):
+    # check_same_thread is off because a pooled connection is handed to whichever thread borrows it
+    # the pool guarantees only one thread uses a connection at a time
+    conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE, factory=Connection)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+# A bounded pool of connections to one database file
+class ConnectionPool():
+    def __init__(self, db_file, size=POOL_SIZE, timeout=CHECKOUT_TIMEOUT, max_age=MAX_CONNECTION_AGE):
+        self.db_file = db_file
+        self.size = size
+        self.timeout = timeout
+        self.max_age = max_age
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created_at = {}
+        self._closed = False
+        self._waiting = 0
+        # metrics
+        self.opened = 0
+        self.recycled = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    # Borrow a connection, opening a new one while the pool is below its size
+    def acquire(self):
+        if self._closed:
+            raise Error("Connection pool is closed.")
+        start = time.perf_counter()
+        conn = None
+        # while requests are queued for a connection, a new one joins the back of the queue instead of taking
+        # the next connection returned - otherwise, with many more requests than connections, some wait for ever
+        if not self._waiting:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    if len(self._created_at) < self.size:
+                        conn = self._open()
+        if conn is None:
+            with self._lock:
+                self._waiting += 1
+            try:
+                conn = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                with self._lock:
+                    self.timeouts += 1
+                raise Error("Timed out waiting for a database connection.")
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+        waited = time.perf_counter() - start
+        # queries counted for the previous borrower (e.g. the image workers) are not this one's
+        conn.take_query_counts()
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return conn
+
+    # Give a connection back to the pool
+    def release(self, conn):
+        # never hand an open transaction to the next request
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Error:
+            self._discard(conn)
+            return
+        if self._closed:
+            self._discard(conn)
+            return
+        # replace connections that have been open for too long
+        if time.monotonic() - self._created_at.get(id(conn), 0) > self.max_age:
+            self._discard(conn)
+            with self._lock:
+                self.recycled += 1
+                if self._closed:
+                    return
+                conn = self._open()
+        self._idle.put_nowait(conn)
+
+    # Close every idle connection, connections still borrowed are closed when they are released
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    # Close the pool and wait up to timeout seconds for borrowed connections to be returned and closed
+    # returns True once every connection is closed, False if some were still in use at the timeout
+    def drain(self, timeout=CHECKOUT_TIMEOUT):
+        self.close()
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if not self._created_at:
+                    return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    # Snapshot of the pool metrics
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            ages = [now - created for created in self._created_at.values()]
+            return {
+                'size': self.size,
+                'open': len(self._created_at),
+                'idle': self._idle.qsize(),
+                'in_use': len(self._created_at) - self._idle.qsize(),
+                'waiting': self._waiting,
+                'opened': self.opened,
+                'recycled': self.recycled,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_avg': self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'wait_max': self.wait_max,
+                'age_max': max(ages) if ages else 0.0,
+                'age_avg': sum(ages) / len(ages) if ages else 0.0,
+            }
+
+    # must be called with self._lock held
+    def _open(self):
+        conn = connect(self.db_file)
+        self._created_at[id(conn)] = time.monotonic()
+        self.opened += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created_at.pop(id(conn), None)
+        try:
+            # refresh the query planner statistics of any table this connection found out of date
+            conn.execute("PRAGMA optimize")
+        except Error:
+            pass
+        try:
+            conn.close()
+        except Error:
+            pass
+
+
+# Run fn(conn, *args) in a write transaction, commit it and return what fn returned
+# BEGIN IMMEDIATE takes the write lock before anything is read, so a busy database is waited for (BUSY_TIMEOUT)
+# up front - a transaction that starts as a reader and then writes can fail straight away instead.
+# if the lock is still held after the timeout the transaction is rolled back and tried again after a pause
+def write_transaction(conn, fn, *args, attempts=WRITE_ATTEMPTS):
+    for attempt in range(attempts):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            if not is_busy(e) or attempt == attempts - 1:
+                raise
+        except BaseException:
+            conn.rollback()
+            raise
+        # the pause doubles each time, and is spread out so the retries of waiting writers do not collide again
+        time.sleep(RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+# True if e means another connection held the lock for longer than the busy timeout
+def is_busy(e):
+    message = str(e)
+    return 'database is locked' in message or 'database is busy' in message
+
+
+# Create the tables on a new database, or bring an older copy up to date (see migrations.py)
+def ensure_schema(conn):
+    return migrations.migrate(conn)
+
+
+# Attach a pool to a Flask app - each request borrows at most one connection through get_db()
+def init_app(app, db_file, size=POOL_SIZE):
+    pool = ConnectionPool(db_file, size=size)
+    conn = pool.acquire()
+    try:
+        ensure_schema(conn)
+    finally:
+        pool.release(conn)
+    app.extensions['db_pool'] = pool
+    # in the async mode queries run on offload threads - one for each connection
+    concurrency.set_offload_threads(size)
+    app.teardown_appcontext(_release_db)
+
+
+# Return the connection borrowed by the current request, borrowing one on first use
+def get_db():
+    if 'db' not in g:
+        g.db = current_app.extensions['db_pool'].acquire()
+    return g.db
+
+
+# Return the pool attached to the current app
+def get_pool():
+    return current_app.extensions['db_pool']
+
+
+# Give the connection borrowed by the current request back to the pool before the request ends
+# for a streamed response, whose request lasts until its last byte is sent - the queries already run on the
+# connection are then left out of the request's metrics
+def release_db():
+    _release_db()
+
+
+def _release_db(exception=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        current_app.extensions['db_pool'].release(conn)
@@ -0,0 +1,51 @@
+# gunicorn settings for production: gunicorn -c gunicorn.conf.py "wsgi:create_app()"
+# each value can be changed with the environment variable next to it
+import importlib
+import os
+import sys
+
+cpus = os.cpu_count() or 1
+
+# address to listen on (RECIPE_BIND)
+bind = os.environ.get('RECIPE_BIND', '0.0.0.0:8000')
+# worker processes (RECIPE_WORKERS) - requests are spread over the processes, so pages are rendered on every core
+workers = int(os.environ.get('RECIPE_WORKERS', cpus * 2 + 1))
+# threads per worker (RECIPE_THREADS) - a thread waiting on the database lets another one run,
+# and each worker keeps one pooled connection per thread
+threads = int(os.environ.get('RECIPE_THREADS', 8))
+# RECIPE_WORKER_CLASS=gevent is the async mode - each request is a greenlet instead of a thread, so a worker can hold
+# RECIPE_WORKER_CONNECTIONS clients at once, and slow clients no longer tie up one of a few threads each.
+# database queries and image resizing are moved to real threads (see concurrency.py). Needs gevent installed
+worker_class = os.environ.get('RECIPE_WORKER_CLASS', 'gthread')
+worker_connections = int(os.environ.get('RECIPE_WORKER_CONNECTIONS', 1000))
+# requests that take longer than this are stopped and their worker restarted (seconds)
+timeout = 60
+# on shutdown or reload, requests in progress get this long to finish (RECIPE_GRACEFUL_TIMEOUT, seconds)
+graceful_timeout = int(os.environ.get('RECIPE_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+# access log to stdout when RECIPE_ACCESS_LOG is set
+accesslog = '-' if os.environ.get('RECIPE_ACCESS_LOG') else None
+
+# the app is imported in each worker after the fork, not in the master -
+# sqlite connections, thread pools and process pools must not be shared across a fork
+preload_app = False
+
+# the libraries the app is built on hold none of those, so the master imports them once and every worker forked
+# from it - at start, after a crash or when one is added - starts with them already loaded (Flask alone is most of
+# a worker's start up time). not in the async mode, where gevent must patch the standard library before they load it
+PRELOAD_MODULES = ('flask', 'flask_login', 'jinja2', 'markupsafe', 'bcrypt')
+if worker_class != 'gevent':
+    for module in PRELOAD_MODULES:
+        importlib.import_module(module)
+
+# share the cores between the workers' password hashing processes instead of every worker starting one per core
+os.environ.setdefault('RECIPE_HASH_WORKERS', str(max(1, cpus // workers)))
+if worker_class == 'gthread':
+    os.environ.setdefault('RECIPE_DB_POOL_SIZE', str(threads))
+
+
+# finish background work and drain the connection pool once the worker has stopped taking requests
+def worker_exit(server, worker):
+    main = sys.modules.get('main')
+    if main is not None:
+        main.shutdown()
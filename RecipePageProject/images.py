@@ -0,0 +1,296 @@
+# image pipeline for recipe uploads
+# originals are stored under the hash of their contents, so the same photo uploaded twice is kept once
+# and two different photos with the same file name can no longer overwrite each other.
+# resized copies (renditions) are made on a background worker pool so the upload request returns straight away
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from sqlite3 import Error
+
+import logs
+import repository
+from concurrency import offload
+
+log = logs.get_logger('images')
+
+# name -> (column in RECIPE, longest side in pixels)
+# thumb for small previews, card for the result pages, full for the recipe page
+RENDITIONS = {
+    'thumb': ('ImageThumb', 160),
+    'card': ('ImageCard', 480),
+    'full': ('ImageFull', 1280),
+}
+JPEG_QUALITY = 80
+# background threads making renditions - resizing releases the GIL so threads use several cores
+WORKERS = 2
+CHUNK_SIZE = 64 * 1024
+
+# the first bytes of each allowed file type - the file name alone does not prove what a file contains
+MAGIC_BYTES = {
+    'png': b'\x89PNG\r\n\x1a\n',
+    'jpg': b'\xff\xd8\xff',
+    'jpeg': b'\xff\xd8\xff',
+}
+
+
+# Raised when an upload is rejected, nothing is left on disk
+class UploadError(Exception):
+    pass
+
+
+class FileTooLarge(UploadError):
+    pass
+
+
+class FileTypeMismatch(UploadError):
+    pass
+
+
+# Add the rendition columns to an older RECIPE table
+def ensure_image_columns(conn):
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(RECIPE)")}
+    for column, _ in RENDITIONS.values():
+        if column not in existing:
+            conn.execute("ALTER TABLE RECIPE ADD COLUMN %s TEXT" % column)
+
+
+# Path of a file inside the upload folder, two levels deep so no folder gets too large
+def content_path(upload_folder, digest, suffix):
+    return os.path.join(upload_folder, digest[:2], digest + suffix).replace('\\', '/')
+
+
+# A temporary file in the upload folder an upload is written into, checked and hashed as each chunk arrives
+# the type is checked on the first bytes and the size as it grows, so writing stops at the first bad chunk and the
+# file is removed. store() then renames the finished file into place - a half written upload is never visible.
+# it is removed on close unless it was stored
+class UploadFile():
+    _file = None
+
+    def __init__(self, upload_folder, extension, max_size=None):
+        os.makedirs(upload_folder, exist_ok=True)
+        self.upload_folder = upload_folder
+        self.extension = extension
+        self.max_size = max_size
+        self.size = 0
+        self._magic = MAGIC_BYTES.get(extension)
+        self._head = b''
+        self._digest = hashlib.sha256()
+        self._stored = False
+        handle, self.path = tempfile.mkstemp(dir=upload_folder, suffix='.part')
+        self._file = os.fdopen(handle, 'w+b')
+
+    def write(self, chunk):
+        try:
+            self._check(chunk)
+        except UploadError:
+            self.close()
+            raise
+        self._digest.update(chunk)
+        self.size += len(chunk)
+        return self._file.write(chunk)
+
+    def _check(self, chunk):
+        if self._magic is None:
+            raise FileTypeMismatch("Files of type %s are not accepted." % self.extension)
+        # the first bytes may arrive over more than one chunk
+        if len(self._head) < len(self._magic):
+            self._head = (self._head + chunk)[:len(self._magic)]
+            if not self._magic.startswith(self._head):
+                raise FileTypeMismatch("File contents are not a %s image." % self.extension)
+        if self.max_size is not None and self.size + len(chunk) > self.max_size:
+            raise FileTooLarge("File is larger than %d bytes." % self.max_size)
+
+    # Move the finished file to the path named after the hash of its contents
+    # returns (path, True if this call created the file) - a file already stored is kept and this one removed
+    def store(self):
+        if self._head != self._magic:
+            self.close()
+            raise FileTypeMismatch("File is empty." if not self.size else "File is too short to be an image.")
+        path = content_path(self.upload_folder, self._digest.hexdigest(), '.' + self.extension)
+        self._file.close()
+        if os.path.exists(path):
+            # already uploaded before - keep the existing copy
+            self.close()
+            return path, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.path, path)
+        self._stored = True
+        return path, True
+
+    def close(self):
+        self._file.close()
+        if not self._stored:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    # read back by the request parser before store() - seek, read and the rest of the file interface
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class ImagePipeline():
+    # on_processed is called with the recipe ID once its renditions are recorded
+    def __init__(self, upload_folder, pool, workers=WORKERS, on_processed=None):
+        self.upload_folder = upload_folder
+        self.pool = pool
+        self.on_processed = on_processed
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='images')
+
+    # A file in the upload folder to write an upload into as it arrives, see UploadFile
+    def upload_file(self, extension, max_size=None):
+        return UploadFile(self.upload_folder, extension, max_size)
+
+    # Save an uploaded file under the hash of its contents and return (path, True if this call created the file)
+    # the file is copied in chunks to an UploadFile, so it is never held in memory as a whole, and is checked on the
+    # way. stream may already be an UploadFile the request body was read into, which is then only moved into place
+    def store(self, stream, extension, max_size=None):
+        if isinstance(stream, UploadFile):
+            return stream.store()
+        upload = self.upload_file(extension, max_size)
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                upload.write(chunk)
+            return upload.store()
+        finally:
+            upload.close()
+
+    # Remove a file stored by store() that no recipe ended up using
+    # only call this for a file that store() reported as created, an older copy may belong to another recipe
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    # Remove a file stored by store() unless a recipe uses it, True if it was removed
+    # two uploads of the same image share one file, and the one that created it may not be the one that keeps it.
+    # call inside a write transaction (database.write_transaction), so no recipe can be added with the file
+    # between the check and the removal
+    def discard_unused(self, conn, path):
+        if repository.image_in_use(conn, path):
+            return False
+        self.discard(path)
+        return True
+
+    # Make the renditions for a recipe in the background
+    def submit(self, recipe_id, original_path):
+        future = self._executor.submit(self.process, recipe_id, original_path)
+        future.add_done_callback(lambda done: _report(recipe_id, done))
+        return future
+
+    # Make the renditions of original_path and record them on the recipe
+    # resizing is run through offload() so in the async server mode it does not stop other requests
+    def process(self, recipe_id, original_path):
+        paths = offload(self.make_renditions, original_path)
+        conn = self.pool.acquire()
+        try:
+            conn.execute("UPDATE RECIPE SET ImageThumb = ?, ImageCard = ?, ImageFull = ? WHERE ID = ?",
+                         (paths['thumb'], paths['card'], paths['full'], recipe_id))
+            conn.commit()
+        finally:
+            self.pool.release(conn)
+        if self.on_processed is not None:
+            self.on_processed(recipe_id)
+        return paths
+
+    # Write each rendition next to the original, skipping ones that already exist
+    def make_renditions(self, original_path):
+        digest = hashlib.sha256()
+        with open(original_path, 'rb') as original:
+            for chunk in iter(lambda: original.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+
+        paths = {}
+        image = None
+        try:
+            for name, (_, size) in RENDITIONS.items():
+                path = content_path(self.upload_folder, digest, '-%s.jpg' % name)
+                paths[name] = path
+                if os.path.exists(path):
+                    continue
+                if image is None:
+                    image = load_image(original_path)
+                write_rendition(image, path, size)
+        finally:
+            if image is not None:
+                image.close()
+        return paths
+
+    # Stop accepting work, finishing what is already queued if wait is True
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+# Open an image the right way up and in RGB, flattening any transparency onto white
+# Pillow is imported by the first resize rather than with the app, so workers start without loading it
+def load_image(path):
+    from PIL import Image, ImageOps
+    with Image.open(path) as opened:
+        image = ImageOps.exif_transpose(opened)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            return background
+        return image.convert('RGB')
+
+
+# Save a copy of image no larger than size pixels on its longest side
+def write_rendition(image, path, size):
+    from PIL import Image
+    copy = image.copy()
+    copy.thumbnail((size, size), Image.LANCZOS)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(handle, 'wb') as tmp:
+            copy.save(tmp, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        copy.close()
+
+
+# the recipe keeps showing its original image if its renditions could not be made
+def _report(recipe_id, future):
+    error = future.exception()
+    if error is not None:
+        log.error("Failed to make image renditions", extra={'recipe_id': recipe_id},
+                  exc_info=(type(error), error, error.__traceback__))
+
+
+# Backfill - make renditions for recipes that have an image but none yet
+# returns (processed, skipped) counts
+def backfill(pool, upload_folder, log=print):
+    pipeline = ImagePipeline(upload_folder, pool)
+    conn = pool.acquire()
+    try:
+        rows = conn.execute("SELECT ID, ImagePath FROM RECIPE WHERE ImagePath IS NOT NULL AND ImageCard IS NULL").fetchall()
+    finally:
+        pool.release(conn)
+
+    processed = skipped = 0
+    for recipe_id, image_path in rows:
+        # older rows were saved on Windows with backslashes in the path
+        image_path = image_path.replace('\\', '/')
+        if not os.path.exists(image_path):
+            log("Recipe %d: image %s not found, skipped." % (recipe_id, image_path))
+            skipped += 1
+            continue
+        try:
+            pipeline.process(recipe_id, image_path)
+        except (OSError, Error) as e:
+            log("Recipe %d: %s" % (recipe_id, e))
+            skipped += 1
+            continue
+        processed += 1
+        log("Recipe %d: renditions created." % recipe_id)
+    pipeline.shutdown()
+    return processed, skipped
@@ -0,0 +1,87 @@
+# structured logging for the app's own messages
+# every line is one event as key=value pairs (logfmt), or a JSON object with LOG_FORMAT=json, so logs can be
+# searched by field instead of by wording. extra fields are passed with extra={...}:
+#     log.warning("Slow request", extra={'ms': 1234.5, 'queries': 12})
+# lines logged during a request also carry its endpoint and method.
+# formatting only happens for messages at or above LOG_LEVEL, so debug calls cost almost nothing when it is off
+import json
+import logging
+import sys
+import time
+
+from flask import has_request_context, request
+
+# loggers of the app are named recipe.<module>, their lines go through the one handler on this logger
+ROOT = 'recipe'
+
+# attributes every LogRecord has - anything else on a record came from extra={...}
+STANDARD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def get_logger(module):
+    return logging.getLogger('%s.%s' % (ROOT, module))
+
+
+# The fields of a record in the order they are written
+def record_fields(record):
+    fields = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + '.%03dZ' % record.msecs,
+        'level': record.levelname.lower(),
+        'logger': record.name,
+        'msg': record.getMessage(),
+    }
+    for name, value in vars(record).items():
+        if name not in STANDARD_FIELDS and not name.startswith('_'):
+            fields[name] = value
+    if record.exc_info:
+        fields['exc'] = logging.Formatter().formatException(record.exc_info)
+    return fields
+
+
+class LogfmtFormatter(logging.Formatter):
+    def format(self, record):
+        return ' '.join('%s=%s' % (name, _logfmt_value(value)) for name, value in record_fields(record).items())
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record_fields(record), default=str)
+
+
+FORMATTERS = {'logfmt': LogfmtFormatter, 'json': JsonFormatter}
+
+
+# Adds the endpoint and method of the request being handled to each record
+class RequestFilter(logging.Filter):
+    def filter(self, record):
+        if has_request_context():
+            record.endpoint = request.endpoint
+            record.method = request.method
+        return True
+
+
+# Send the app's log lines to stream (stderr by default) at level and above
+# safe to call again, e.g. once per worker process - the handler is replaced rather than added twice
+def configure(level='INFO', fmt='logfmt', stream=None):
+    if fmt not in FORMATTERS:
+        raise ValueError("Unknown log format %r, expected one of %s" % (fmt, ', '.join(FORMATTERS)))
+    logger = logging.getLogger(ROOT)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(FORMATTERS[fmt]())
+    handler.addFilter(RequestFilter())
+    logger.addHandler(handler)
+    logger.setLevel(level.upper())
+    # the server's own logging (gunicorn, werkzeug) is configured separately
+    logger.propagate = False
+    return logger
+
+
+def _logfmt_value(value):
+    if isinstance(value, float):
+        return '%.3f' % value
+    text = str(value)
+    if text and not any(c in text for c in ' ="\n\\'):
+        return text
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
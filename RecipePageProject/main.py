@@ -1,11 +1,33 @@
 # import necessary packages
 import os
-from flask import Flask, render_template, request, url_for, flash, session
+import hashlib
+import threading
+from flask import Flask, Request, render_template, request, url_for, flash, session, make_response, jsonify
+from markupsafe import Markup
 from werkzeug.utils import redirect, secure_filename
-import sqlite3
 from sqlite3 import Error
-from flask_bcrypt import Bcrypt
 from flask_login import LoginManager, login_user, current_user, logout_user, login_required
+import database
+import migrations
+import assets
+import compression
+import cooktime
+import templating
+import settings
+import repository
+import api
+import logs
+import metrics
+import profiler
+import popular
+from database import get_db
+from concurrency import offload
+from cache import LRUCache, FragmentCache
+from search import SORTS, default_sort, normalize_keyword
+from pagination import PAGE_SIZE, MAX_INTEGER, Page
+from images import ImagePipeline, UploadError, FileTooLarge
+from werkzeug.exceptions import RequestEntityTooLarge
+from passwords import PasswordHasher, LoginThrottle, HashingBusy, BCRYPT_LOG_ROUNDS, HASH_WORKERS
 
 db_file = "mySQLite.db"
 
@@ -16,24 +38,199 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 # specify maximum file size - 5MB
 MAX_FILE_SIZE = 5 * 1024 * 1024
 
+# Extension of an uploaded file's name in lower case, '' if it has none
+def file_extension(filename):
+    return secure_filename(filename).rsplit('.', 1)[-1].lower() if '.' in filename else ''
+
+# the image of a recipe being added is written into the upload folder as the request body is read (images.UploadFile)
+# rather than into a temporary file that is copied there afterwards - and an image that is too large or not the type
+# its name says stops the reading of the body at its first bad chunk, raising an UploadError from request.form
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint == 'addRecipeAction' and filename and file_extension(filename) in ALLOWED_EXTENSIONS:
+            return image_pipeline.upload_file(file_extension(filename), MAX_FILE_SIZE)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
 # setup flask application
+# every setting below can be changed with a RECIPE_<SETTING> environment variable (see settings.py)
 app = Flask(__name__)
-app.config['ENV'] = "Development"
-app.config['DEBUG'] = True
+app.request_class = UploadRequest
+# debug is off unless asked for - the development server at the bottom of this file turns it on
+app.config['DEBUG'] = False
+# Set a secret key for the login session - production must set its own with RECIPE_SECRET_KEY
+app.config['SECRET_KEY'] = 'super secret key'
+app.config['DATABASE'] = db_file
+# connections kept open to the database - roughly one per server thread
+app.config['DB_POOL_SIZE'] = database.POOL_SIZE
+# how long shutdown waits for requests still using a connection (seconds)
+app.config['SHUTDOWN_TIMEOUT'] = 30
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
-# Create a Bcrypt object
-bcrypt = Bcrypt (app)
-
-# Create a LoginManager
+# reject request bodies larger than the biggest allowed image plus room for the text fields
+# before they are read, rather than after the whole upload has been received
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE + 1024 * 1024
+# number of recipes shown on one page of results
+app.config['PAGE_SIZE'] = PAGE_SIZE
+# bcrypt work factor for new passwords - older hashes are upgraded when their user next logs in
+app.config['BCRYPT_LOG_ROUNDS'] = BCRYPT_LOG_ROUNDS
+# processes used for password hashing
+app.config['HASH_WORKERS'] = HASH_WORKERS
+# memory used by cached pages of search results, and a folder to keep the ones pushed out of memory (None for no folder)
+app.config['RESULT_CACHE_BYTES'] = 32 * 1024 * 1024
+app.config['RESULT_CACHE_DIR'] = None
+# cached results are dropped as this app changes recipes - the time limit covers changes made by other processes
+app.config['RESULT_CACHE_TTL'] = 60
+# how long the RECIPE change count is trusted before it is read again (seconds)
+# within this time a browser revalidating a result page gets its 304 without any database work
+app.config['RESULT_VERSION_TTL'] = 1
+# recipes on the most popular list of the search page, and how often it is read again (seconds)
+app.config['POPULAR_COUNT'] = popular.POPULAR_COUNT
+app.config['POPULAR_REFRESH_SECONDS'] = popular.REFRESH_SECONDS
+
+# compiled templates are kept in this folder, so new worker processes load them instead of compiling (None for no cache)
+app.config['TEMPLATE_CACHE_DIR'] = 'template_cache'
+# send pages gzip or brotli compressed to browsers that accept it, when they are at least COMPRESS_MIN_BYTES long
+app.config['COMPRESS'] = True
+app.config['COMPRESS_MIN_BYTES'] = compression.MIN_BYTES
+
+# log lines at this level and above, as key=value pairs ('logfmt') or JSON objects ('json') - see logs.py
+app.config['LOG_LEVEL'] = 'INFO'
+app.config['LOG_FORMAT'] = 'logfmt'
+# serve request metrics at /metrics (Prometheus text format) - keep it reachable from the monitoring network only
+app.config['METRICS'] = True
+# requests slower than this are logged with their query count and timings (seconds, 0 logs none)
+app.config['SLOW_REQUEST_SECONDS'] = metrics.SLOW_REQUEST
+# sample the stacks of running requests and write flamegraph input to PROFILE_DIR (see profiler.py)
+app.config['PROFILE'] = False
+app.config['PROFILE_DIR'] = 'profiles'
+app.config['PROFILE_INTERVAL'] = profiler.INTERVAL
+
+log = logs.get_logger('main')
+
+# The caches, workers and services below are set up by create_app() - importing this module only defines the app and
+# its routes: it opens no database, starts no threads or processes and writes no files
+# Cache of rendered pages of search and portfolio results
+# entries are tagged with the recipes they show ('recipe:<id>') and the user whose portfolio they are ('owner:<name>')
+# keyword searches are also tagged 'search', as any new recipe may belong in them
+result_cache = None
+
+# Change counts of the tables the result pages are built from (see repository.table_version), keyed by table name
+version_cache = None
+
+# Background workers that make resized copies of uploaded images
+image_pipeline = None
+
+# Cache of logged in users and their details, keyed by username
+# entries are dropped when the user logs in and expire after 5 minutes for changes made elsewhere
+user_cache = None
+
+# Cache of the favourite recipes shown on each user's profile page, keyed by username
+# entries are dropped when the user's favourites change and expire after 5 minutes for changes made elsewhere
+# (other worker processes, and the resized images made for a recipe)
+profile_cache = None
+
+# The most favourited recipes, read again by a background thread every POPULAR_REFRESH_SECONDS
+popular_recipes = None
+
+# Hash of the files the result pages are built from, part of their ETags so a new release is never answered with 304
+RESULT_PAGE_FILES = [os.path.join(app.static_folder, 'CSS', 'StyleSheet.css')] + [
+    os.path.join(app.root_path, app.template_folder, name)
+    for name in ("base.html", "macros.html", "searchResult.html", "searchResultList.html", "searchResultPortfolio.html",
+                 "searchResultPortfolioList.html")]
+RESULT_PAGES_VERSION = None
+
+# The password hasher - bcrypt runs in its own processes, away from the request threads
+password_hasher = None
+
+# Count failed logins so password guessing floods are turned away before any hashing
+login_throttle = None
+
+# Logs the users of a session in - attached to the app by create_app()
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'loginAction'
 
+# Set the app up in this process and return it - called once by each server worker (see wsgi.py) and by the
+# development server; later calls return the same app without setting it up again
+# settings are read from RECIPE_<SETTING> environment variables here, so they can be changed until the app is created
+def create_app():
+    global result_cache, version_cache, image_pipeline, user_cache, profile_cache, popular_recipes
+    global RESULT_PAGES_VERSION, password_hasher, login_throttle
+    if 'db_pool' in app.extensions:
+        return app
+
+    # apply RECIPE_<SETTING> environment variables
+    settings.load_environment(app.config)
+
+    # log is the 'main' child of the logger set up here
+    logs.configure(app.config['LOG_LEVEL'], app.config['LOG_FORMAT'])
+
+    # Time every request, count its queries, template rendering and bytes, and serve the totals at /metrics
+    metrics.init_app(app, app.config['SLOW_REQUEST_SECONDS'] or None, app.config['METRICS'])
+    if app.config['PROFILE']:
+        profiler.init_app(app, app.config['PROFILE_DIR'], app.config['PROFILE_INTERVAL'])
+
+    # Create a pool of database connections shared by all requests
+    database.init_app(app, app.config['DATABASE'], app.config['DB_POOL_SIZE'])
+
+    result_cache = FragmentCache(app.config['RESULT_CACHE_BYTES'], ttl=app.config['RESULT_CACHE_TTL'],
+                                 disk_dir=app.config['RESULT_CACHE_DIR'])
+    version_cache = LRUCache(maxsize=len(migrations.COUNTED_TABLES), ttl=app.config['RESULT_VERSION_TTL'])
+    # once a recipe has its card sized image, cached results showing the original are out of date
+    image_pipeline = ImagePipeline(app.config['UPLOAD_FOLDER'], app.extensions['db_pool'],
+                                   on_processed=lambda recipe_id: recipes_changed('recipe:%d' % recipe_id))
+    user_cache = LRUCache(maxsize=4096, ttl=300)
+    profile_cache = LRUCache(maxsize=1024, ttl=300)
+    popular_recipes = popular.PopularRecipes(app.extensions['db_pool'], app.config['POPULAR_COUNT'],
+                                             app.config['POPULAR_REFRESH_SECONDS'])
+    popular_recipes.start()
+
+    # Serve static files with long lived cache headers and precompressed copies of the stylesheet
+    assets.init_app(app)
+
+    # Load every template up front, compiled from the bytecode cache when an earlier process left it there
+    templating.init_app(app, app.config['TEMPLATE_CACHE_DIR'])
+
+    # Answer errors of the JSON API as JSON
+    api.init_app(app)
+
+    # Compress pages for browsers that accept it - runs before the metrics count the bytes sent
+    if app.config['COMPRESS']:
+        compression.init_app(app, app.config['COMPRESS_MIN_BYTES'])
+
+    RESULT_PAGES_VERSION = ''.join(assets.fingerprint(path) for path in RESULT_PAGE_FILES)
+
+    password_hasher = PasswordHasher(app.config['BCRYPT_LOG_ROUNDS'], app.config['HASH_WORKERS'])
+    login_throttle = LoginThrottle()
+
+    metrics.add_collector(app, collect_metrics)
+    login_manager.init_app(app)
+    return app
+
+# Drop the cached results tagged with any of tags, and the cached RECIPE count so the ETags change straight away
+def recipes_changed(*tags):
+    version_cache.invalidate('RECIPE')
+    for tag in tags:
+        result_cache.invalidate_tag(tag)
+
+# Pool, cache and per-query numbers for /metrics, read at each scrape
+def collect_metrics():
+    samples = metrics.gauges('db_pool', database.get_pool().stats())
+    for name, cache in (('result', result_cache), ('user', user_cache), ('profile', profile_cache),
+                        ('version', version_cache)):
+        for key, values in metrics.gauges('cache', cache.stats(), cache=name).items():
+            samples.setdefault(key, []).extend(values)
+    for query, numbers in repository.query_stats().items():
+        for key, values in metrics.gauges('query', numbers, query=query).items():
+            samples.setdefault(key, []).extend(values)
+    return samples
+
 # Create a User Class for the user that will be stored when the user is logged in
+# it also holds the user's details, so most requests need no USER query
 class User():
-    def __init__(self, username):
+    def __init__(self, username, email=None, fname=None, lname=None):
         self.username = username
+        self.email = email
+        self.fname = fname
+        self.lname = lname
     def is_authenticated(self):
         return True
     def is_active(self):
@@ -44,12 +241,29 @@ class User():
         return self.username
 
 # Define a userloader function
+# users are kept in user_cache, so a logged in request only queries USER when the cached copy is missing or stale
 @login_manager.user_loader
 def load_user(username):
-    return User(username)
-
-# Set a secret key for the login session
-app.secret_key = 'super secret key'
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+    try:
+        user = offload(fetch_user, get_db(), username)
+    except Error:
+        log.exception("Database error")
+        return None
+    if user is None:
+        # the account no longer exists
+        return None
+    user_cache.set(username, user)
+    return user
+
+# read a user and their details
+def fetch_user(conn, username):
+    user_data = repository.get_user(conn, username)
+    if user_data is None:
+        return None
+    return User(username, user_data.email, user_data.fname, user_data.lname)
 
 # set session timeout - 30minutes (1800s)
 app.permanent_session_lifetime = 1800
@@ -81,8 +295,11 @@ def signupAction():
         password = request.form.get("password")
         # HASHING PASSWORD
         # password is a normal string, we need to hash it before put in database
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
-        print("True Password:", password, ", Hashed Password:", hashed_password)
+        try:
+            hashed_password = password_hasher.hash(password)
+        except HashingBusy:
+            flash("The server is busy. Please try again.")
+            return redirect(url_for('signup'))
         password = hashed_password
     if request.form.get("email"):
         email = request.form.get("email")
@@ -92,12 +309,9 @@ def signupAction():
         lname = request.form.get("lname")
 
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
+        conn = get_db()
         # PARAMETERIZATION - get user inputs as parameters (prevent SQL injection attack)
-        myquery="INSERT INTO USER (Username, Password, Email, First_Name, Last_Name) VALUES (?, ?, ?, ?, ?)"
-        print("My query is: ", myquery)
-        cursor.execute(myquery, (username, password, email, fname, lname))
+        repository.add_user(conn, username, password, email, fname, lname)
         conn.commit()
 
         # if this works, this means the user has been added succesfully
@@ -106,11 +320,10 @@ def signupAction():
     except Error as e:
         # if the user is not added, we will get an exception which will be caught here
         # tell user signup has failed and send them to the sign up page again
+        # (usually the username is taken, which is not worth a stack trace)
+        log.info("Signup failed", extra={'error': str(e)})
         flash("Failled to signup. Try again!")
         return redirect(url_for('signup'))
-    finally:
-        if conn:
-            conn.close()
     flash("Account created successfully.")
     return redirect(url_for('login'))
 
@@ -132,46 +345,58 @@ def loginAction():
         username=request.form.get("username")
     if request.form.get("password"):
         password = request.form.get("password")
+
+    # Too many failed logins for this username or from this address - refuse before doing any hashing
+    if login_throttle.is_blocked(username, request.remote_addr):
+        flash("Too many failed login attempts. Please wait a few minutes and try again.")
+        return redirect(url_for('login'))
+
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
+        conn = get_db()
         # PARAMETERIZATION
-        myquery="SELECT Password FROM USER WHERE Username=?"
-        data=cursor.execute(myquery, (username,))
-        passwordInDB=None
-        for row in data:
-            passwordInDB=row[0]
+        passwordInDB = repository.password_hash(conn, username)
         if passwordInDB:
             # We have found a username matching the one provide for the login
             # Now, we need to check that the password provide for the login is also correct
-            validPassword = bcrypt.check_password_hash(passwordInDB, password)
+            validPassword = password_hasher.check(password, passwordInDB)
 
             # AUTHENTICATION
             # If the passwords match, we need to mark them as logged in and send them to their profile
             # Else we need to send them to the login page again
             if validPassword:
+                login_throttle.succeeded(username)
+                # the stored hash was made with an older work factor - replace it while we have the password
+                if password_hasher.needs_rehash(passwordInDB):
+                    repository.update_password(conn, username, password_hasher.hash(password))
+                    conn.commit()
+                # start the session with fresh user details
+                user_cache.invalidate(username)
                 login_user(User(username))
                 flash("You are now logged in.")
                 return redirect(url_for('profile'))
             else:
                 # The password does not match
                 # we need to send them to the login page again
+                login_throttle.failed(username, request.remote_addr)
                 flash("Your username or password are incorrect! Try to login again.")
                 return redirect(url_for('login'))
             pass
         else:
             # The Username does not exist
             # we need to send them to the login page again
+            login_throttle.failed(username, request.remote_addr)
             flash("Your username is incorrect! Try to login again. Or create an account")
             return redirect(url_for('login'))
-    except Error as e:
+    except HashingBusy:
+        # too many logins are already waiting for the password hasher
+        flash("The server is busy. Please try again.")
+        return redirect(url_for('login'))
+    except Error:
         # if there was an error in the login, we will get an exception which will be caught here
         # So we need to send the user to the login page again
+        log.exception("Database error")
         flash("Failled to login. Try again!")
         return redirect(url_for('login'))
-    finally:
-        if conn:
-            conn.close()
     flash("You are now logged in.")
     return redirect(url_for('profile'))
 
@@ -188,42 +413,19 @@ def profile():
     # If the user is logged in, we need to get their username
     myusername = current_user.username
 
-    conn = None
-    try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-
-        # Get the personal data of the user
-        myquery = "SELECT Email, First_Name, Last_Name, FavouriteRecipes FROM USER WHERE Username=?"
-        cursor.execute(myquery, (myusername,))
-        user_data = cursor.fetchone()
-
-        if user_data:
-            myemail = user_data[0]
-            myfname = user_data[1]
-            mylname = user_data[2]
-            favourite_recipe_ids = user_data[3].split(",") if user_data[3] else []
-
-            # Fetch the details of favorite recipes using recipe IDs
-            favourite_recipes = []
-            for recipe_id in favourite_recipe_ids:
-                cursor.execute("SELECT * FROM RECIPE WHERE ID=?", (recipe_id,))
-                recipe_data = cursor.fetchone()
-                if recipe_data:
-                    favourite_recipes.append(recipe_data)
-        else:
-            return render_template("error.html", message="User data not found.")
-
-    except Error as e:
-        print(e)
-        return render_template("error.html", message="Database error.")
-
-    finally:
-        if conn:
-            conn.close()
+    # The favourites only change when the user edits them, so they are cached between views
+    # the personal data of the user comes from the cached user
+    favourite_recipes = profile_cache.get(myusername)
+    if favourite_recipes is None:
+        try:
+            favourite_recipes = offload(repository.favourite_recipes, get_db(), myusername)
+        except Error:
+            log.exception("Database error")
+            return render_template("error.html", message="Database error.")
+        profile_cache.set(myusername, favourite_recipes)
 
-    return render_template("profile.html", username=myusername, email=myemail, fname=myfname, lname=mylname,
-                           favourite_recipes=favourite_recipes)
+    return render_template("profile.html", username=myusername, email=current_user.email, fname=current_user.fname,
+                           lname=current_user.lname, favourite_recipes=favourite_recipes)
 
 # direct to add recipe page
 @app.route('/addRecipe')
@@ -236,72 +438,94 @@ def addRecipe():
 # complete add recipe action
 @app.route('/addRecipeAction', methods=['POST'])
 def addRecipeAction():
+    # checks - before the form is read, as reading it writes the image to the upload folder
+    if not (current_user.is_authenticated):
+        flash("You need to login to add recipes.")
+        return redirect(url_for('login'))
+
     # get parameters from the form
+    # an image that is too large or not an image stops the reading of the form, see UploadRequest
     recipeName = request.form.get("recipeName")
     info = request.form.get("info")
     time = request.form.get("time")
     steps = request.form.get("steps")
     image = request.files.get("image")
 
-    # checks
-    if not (current_user.is_authenticated):
-        flash("You need to login to add recipes.")
-        return redirect(url_for('login'))
-
     if not (recipeName and info and time and steps):
         flash("Please fill out all required fields.")
         return redirect(url_for('addRecipe'))
 
-    try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-
-        # Check if the recipe name already exists for the user
-        query = "SELECT * FROM RECIPE WHERE Username = ? AND RecipeName = ?"
-        cursor.execute(query, (current_user.username, recipeName))
-        existing_recipe = cursor.fetchone()
-
-        if existing_recipe:
-            flash("Recipe with the same name already exists.")
-            return redirect(url_for('addRecipe'))
-
-        # FILE UPLOAD SECURITY
+    # FILE UPLOAD SECURITY
+    # the image is saved before any database work, so the write lock is only taken once the file is in place
+    image_path, image_created = None, False
+    if image:
         # Check if the file has an allowed extension
-        if image and '.' in image.filename and image.filename.rsplit('.', 1)[1].lower() not in ALLOWED_EXTENSIONS:
+        extension = file_extension(image.filename)
+        if extension not in ALLOWED_EXTENSIONS:
             flash("File type not allowed. Please upload an image with extensions: png, jpg, jpeg.")
             return redirect(url_for('addRecipe'))
 
-        # Check if the file size exceeds the maximum allowed size
-        if image and len(image.stream.read()) > MAX_FILE_SIZE:
-            flash("File size exceeds the maximum allowed size (5MB).")
-            return redirect(url_for('addRecipe'))
+        # Save the uploaded image, named after the hash of its contents
+        # it was written to the upload folder and checked as the form was read - it only needs moving into place
+        try:
+            image_path, image_created = image_pipeline.store(image.stream, extension, MAX_FILE_SIZE)
+        except UploadError as e:
+            return uploadRejected(e)
 
-        # Reset the file pointer to the beginning of the file then save image
-        image.stream.seek(0)
+    try:
+        # Insert the recipe unless the user already has one with the same name - one statement in one transaction
+        recipe_id = offload(database.write_transaction, get_db(), repository.add_recipe, current_user.username,
+                            recipeName, info, time, steps, image_path)
+    except Error:
+        log.exception("Database error")
+        if image_created:
+            discard_image(image_path)
+        flash("Failed to add recipe. Please try again.")
+        return redirect(url_for('addRecipe'))
 
-        # Save the uploaded image
-        if image:
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(image.filename))
-            image.save(image_path)
-        else:
-            image_path = None
+    if recipe_id is None:
+        # the image saved above is not used by this recipe
+        if image_created:
+            discard_image(image_path)
+        flash("Recipe with the same name already exists.")
+        return redirect(url_for('addRecipe'))
 
-        # Insert the recipe into the database
-        query = "INSERT INTO RECIPE (Username, RecipeName, Info, Time, Steps, ImagePath) VALUES (?, ?, ?, ?, ?, ?)"
-        cursor.execute(query, (current_user.username, recipeName, info, time, steps, image_path))
-        conn.commit()
+    # the new recipe may appear in any search and at the end of its owner's portfolio
+    recipes_changed('search', 'owner:' + current_user.username)
 
-        flash("Recipe added successfully.")
-        return redirect(url_for('profile'))
+    # make the smaller copies of the image in the background
+    if image_path:
+        image_pipeline.submit(recipe_id, image_path)
 
-    except Error as e:
-        print(e)
-        flash("Failed to add recipe. Please try again.")
-        return redirect(url_for('addRecipe'))
+    flash("Recipe added successfully.")
+    return redirect(url_for('profile'))
 
-    finally:
-        if conn:
-            conn.close()
+# the image of a recipe was rejected while its form was read (see UploadRequest) or stored - back to the form
+@app.errorhandler(UploadError)
+def uploadRejected(e):
+    if isinstance(e, FileTooLarge):
+        flash("File size exceeds the maximum allowed size (5MB).")
+    else:
+        flash("File is not a valid image. Please upload a png, jpg or jpeg image.")
+    return redirect(url_for('addRecipe'))
+
+# remove an image stored for a recipe that was not added - unless another request uploading the same image at the same
+# time has added its recipe with the file since
+def discard_image(image_path):
+    try:
+        offload(database.write_transaction, get_db(), image_pipeline.discard_unused, image_path)
+    except Error:
+        # an unused file left behind does no harm, unlike removing one a recipe shows
+        log.exception("Database error")
+
+# the request was larger than MAX_CONTENT_LENGTH and was stopped before it was read
+# only an image upload is sent back to its form - any other request gets the plain 413
+@app.errorhandler(RequestEntityTooLarge)
+def requestTooLarge(e):
+    if request.endpoint != 'addRecipeAction':
+        return e
+    flash("File size exceeds the maximum allowed size (5MB).")
+    return redirect(url_for('addRecipe'))
 
 # direct and display all recipes by a user
 @app.route('/userRecipes')
@@ -313,46 +537,40 @@ def userRecipes():
     # If the user is logged in, we need to get their username
     myusername = current_user.username
 
-    conn = None
-    userRecipes = []
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-
-        # Get the personal data of the user
-        myquery = "SELECT * FROM RECIPE WHERE Username=?"
-        cursor.execute(myquery, (myusername,))
-        recipe_data = cursor.fetchall()
-
-        if recipe_data:
-            for row in recipe_data:
-                myrecipeID = row[0]
-                myrecipeName = row[2]
-                myrecipeInfo = row[3]
-                myrecipeTime = row[4]
-                myrecipeImgPath = row[5]
-                myrecipeSteps = row[6]
-                userRecipes.append({
-                    'id': myrecipeID,
-                    'name': myrecipeName,
-                    'info': myrecipeInfo,
-                    'time': myrecipeTime,
-                    'img_path': myrecipeImgPath,
-                    'steps': myrecipeSteps
-                })
+        # Get one page of the user's recipes
+        page = offload(repository.user_recipes_page, get_db(), myusername, request.args.get("after"),
+                       request.args.get("before"), app.config['PAGE_SIZE'])
+        userRecipes = page.rows
 
-        else:
+        if not userRecipes and not (request.args.get("after") or request.args.get("before")):
             flash("No recipes found for the current user.")
 
-    except Error as e:
-        print(e)
+    except Error:
+        log.exception("Database error")
         return render_template("error.html", message="Database error.")
 
-    finally:
-        if conn:
-            conn.close()
+    return render_template("userRecipes.html", username=myusername, userRecipes=userRecipes, page=page)
 
-    return render_template("userRecipes.html", username=myusername, userRecipes=userRecipes)
+# display a single recipe in full
+@app.route('/recipe/<int:recipe_id>')
+def recipe(recipe_id):
+    if not (current_user.is_authenticated):
+        flash("You need to login to view recipes.")
+        return redirect(url_for('login'))
+
+    try:
+        # an ID too large for the database cannot be a recipe
+        recipe_data = repository.get_recipe(get_db(), recipe_id) if recipe_id <= MAX_INTEGER else None
+    except Error:
+        log.exception("Database error")
+        return render_template("error.html", message="Database error.")
+
+    if not recipe_data:
+        flash("Recipe does not exist.")
+        return redirect(url_for('searchRecipe'))
+
+    return render_template("recipe.html", recipe=recipe_data)
 
 # allow user to delete one of their own recipes
 @app.route('/deleteRecipe', methods=['POST'])
@@ -365,101 +583,104 @@ def deleteRecipe():
     recipe_id = request.form.get("recipe_id")
 
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
+        conn = get_db()
 
-        # Check if the recipe exists
-        query = "SELECT COUNT(*) FROM RECIPE WHERE ID = ?"
-        cursor.execute(query, (recipe_id,))
-        recipe_exists = cursor.fetchone()[0]
+        # Delete the recipe from the database and from every user's favourites
+        # the cached profile pages of those users are now out of date
+        deleted = repository.delete_recipe(conn, recipe_id)
 
-        if not recipe_exists:
+        if deleted is None:
             flash("Recipe does not exist.")
             return redirect(url_for('userRecipes'))
+        deleted_id, owner, affected_users = deleted
 
-        # Delete the recipe from the database
-        delete_query = "DELETE FROM RECIPE WHERE ID = ?"
-        cursor.execute(delete_query, (recipe_id,))
-        conn.commit()
-
-        # Remove the recipe from users' favorite recipes
-        # First, get all users who have this recipe in their favorites
-        user_query = "SELECT Username, FavouriteRecipes FROM USER WHERE FavouriteRecipes LIKE ?"
-        cursor.execute(user_query, ('%' + recipe_id + '%',))
-        users_with_recipe = cursor.fetchall()
-
-        # Update each user's favorite recipes list
-        for user in users_with_recipe:
-            username = user[0]
-            favorite_recipes = user[1].split(',')
-            favorite_recipes.remove(recipe_id)
-            updated_favorites = ','.join(favorite_recipes)
-
-            update_query = "UPDATE USER SET FavouriteRecipes = ? WHERE Username = ?"
-            cursor.execute(update_query, (updated_favorites, username))
-
+        # both deletes are committed together
         conn.commit()
+        for username in affected_users:
+            profile_cache.invalidate(username)
+        recipes_changed('recipe:%d' % deleted_id, 'owner:' + owner)
 
         flash("Recipe deleted successfully.")
         return redirect(url_for('userRecipes'))
 
-    except Error as e:
-        print(e)
+    except Error:
+        log.exception("Database error")
         flash("Failed to delete recipe.")
         return redirect(url_for('userRecipes'))
 
-    finally:
-        if conn:
-            conn.close()
-
 # direct to recipe search
 @app.route('/searchRecipe')
 def searchRecipe():
     if not (current_user.is_authenticated):
         flash("You need to login to search recipes.")
         return redirect(url_for('login'))
-    return render_template("searchRecipe.html")
+    # the popular list is read on a schedule, showing it costs no query
+    return render_template("searchRecipe.html", popular=popular_recipes.get())
 
 # complete recipe search by keyword
-@app.route('/searchRecipeAction', methods=['POST'])
+# a GET so that results have their own URL - the back button and browser caches can reuse them
+# POST is still accepted from forms in pages opened before the change
+# max_time keeps to recipes that take at most that many minutes, sort orders them by 'relevance', 'time', 'name'
+# or 'newest' - with either of them the keyword can be left out to list every recipe
+@app.route('/searchRecipeAction', methods=['GET', 'POST'])
 def searchRecipeAction():
-    # get the keyword from the form
-    keyword = request.form.get("keyword")
-    if not keyword:
+    # get the keyword from the form, and where to continue from when paging through the results
+    keyword = request.values.get("keyword", "")
+    after = request.values.get("after")
+    before = request.values.get("before")
+    sort = request.values.get("sort") or None
+    max_time = request.values.get("max_time") or None
+    if max_time is not None:
+        max_time = cooktime.parse_limit(max_time)
+        if max_time is None:
+            flash("Please enter the time as a whole number of minutes.")
+            return redirect(url_for('searchRecipe'))
+    if sort is not None and sort not in SORTS:
+        sort = None
+    if not keyword and max_time is None and sort in (None, 'relevance'):
         flash("Please enter a keyword to search.")
         return redirect(url_for('searchRecipe'))
+    sort = default_sort(keyword, sort)
 
-    try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-
-        try:
-            # find recipes in the database that contain keyword
-            query = "SELECT * FROM RECIPE WHERE RecipeName LIKE ?"
-            cursor.execute(query, ('%' + keyword + '%',))
-            recipes = cursor.fetchall()
+    # the same words in any case or spacing are the same search, and share a cache entry
+    key = ('search', normalize_keyword(keyword), max_time, sort, after, before, app.config['PAGE_SIZE'])
 
-            if not recipes:
-                flash("No recipes found with the given keyword.")
+    try:
+        # pages are cached and tagged as of a RECIPE change count, so one cached before a change made by another
+        # process is never sent again under the ETag of the new count
+        key += (recipe_version(),)
+        # the heading shows the keyword as typed, so it is part of the ETag
+        etag = result_etag(key + (keyword,))
+        if is_unchanged(etag):
+            return not_modified(etag)
+
+        results = result_cache.get(key)
+        if results is None:
+            conn = get_db()
+
+            try:
+                # find recipes whose name, info or steps contain the keyword, in the order asked for
+                page = offload(repository.search_page, conn, keyword, after, before, app.config['PAGE_SIZE'],
+                               max_time, sort)
+
+                results = render_results("searchResultList.html", key, page.rows, {'search'}, after or before,
+                                         keyword=keyword, max_time=max_time, sort=sort, recipes=page.rows,
+                                         page=page)
+
+            except Error:
+                # Handle any potential database errors here
+                log.exception("Database error")
+                flash("Failed to retrieve recipes from the database. Please try again.")
                 return redirect(url_for('searchRecipe'))
 
-            # return the results
-            return render_template("searchResult.html", keyword=keyword, recipes=recipes)
+        return show_results(results, "searchResult.html", "No recipes found with the given keyword.",
+                            'searchRecipe', after or before, etag, keyword=keyword, max_time=max_time)
 
-        except Error as e:
-            # Handle any potential database errors here
-            flash("Failed to retrieve recipes from the database. Please try again.")
-            return redirect(url_for('searchRecipe'))
-
-    except Error as e:
-        print(e)
+    except Error:
+        log.exception("Database error")
         flash("Failed to search for recipes. Please try again.")
         return redirect(url_for('searchRecipe'))
 
-    finally:
-        if conn:
-            conn.close()
-
 # direct to search for a user portfolio
 @app.route('/searchPortfolio')
 def searchPortfolio():
@@ -469,43 +690,102 @@ def searchPortfolio():
     return render_template("searchPortfolio.html")
 
 # take username and show their work
-@app.route('/searchPortfolioAction', methods=['POST'])
+@app.route('/searchPortfolioAction', methods=['GET', 'POST'])
 def searchPortfolioAction():
     # get from the form
-    user = request.form.get("user")
+    user = request.values.get("user")
+    after = request.values.get("after")
+    before = request.values.get("before")
     if not user:
         flash("Please enter a user to search.")
         return redirect(url_for('searchPortfolio'))
 
-    try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
+    key = ('portfolio', user, after, before, app.config['PAGE_SIZE'])
 
-        try:
-            query = "SELECT * FROM RECIPE WHERE Username=?"
-            cursor.execute(query, (user,))
-            portfolio = cursor.fetchall()
-
-            # needs to be valid username that has recipes associated
-            if not portfolio:
-                flash("No recipes found with the given username.")
+    try:
+        key += (recipe_version(),)
+        etag = result_etag(key)
+        if is_unchanged(etag):
+            return not_modified(etag)
+
+        results = result_cache.get(key)
+        if results is None:
+            conn = get_db()
+
+            try:
+                page = offload(repository.user_recipes_page, conn, user, after, before, app.config['PAGE_SIZE'])
+
+                # needs to be valid username that has recipes associated - show_results sends an empty first page back
+                results = render_results("searchResultPortfolioList.html", key, page.rows, {'owner:' + user},
+                                         after or before, username=user, portfolio=page.rows, page=page)
+
+            except Error:
+                # Handle any potential database errors here
+                log.exception("Database error")
+                flash("Failed to retrieve recipes from the database. Please try again.")
                 return redirect(url_for('searchPortfolio'))
 
-            return render_template("searchResultPortfolio.html", username=user, portfolio=portfolio)
-
-        except Error as e:
-            # Handle any potential database errors here
-            flash("Failed to retrieve recipes from the database. Please try again.")
-            return redirect(url_for('searchPortfolio'))
+        return show_results(results, "searchResultPortfolio.html", "No recipes found with the given username.",
+                            'searchPortfolio', after or before, etag, username=user)
 
-    except Error as e:
-        print(e)
+    except Error:
+        log.exception("Database error")
         flash("Failed to search for user. Please try again.")
         return redirect(url_for('searchPortfolio'))
 
-    finally:
-        if conn:
-            conn.close()
+# render the recipe cards of one page of results and cache them under key
+# an empty first page is cached as an empty string, so repeated searches with no results skip the database too
+def render_results(template, key, rows, tags, paging, **context):
+    results = render_template(template, **context) if rows or paging else ''
+    tags = set(tags) | {'recipe:%d' % recipe.id for recipe in rows}
+    result_cache.set(key, results, tags)
+    return results
+
+# wrap cached or freshly rendered recipe cards in their page
+# an empty first page goes back to the search form instead
+def show_results(results, template, message, search_page, paging, etag, **context):
+    if not results and not paging:
+        flash(message)
+        return redirect(url_for(search_page))
+    # flashed messages are part of the page, so a page showing them is only for this user
+    private = bool(session.get('_flashes'))
+    response = make_response(render_template(template, results=Markup(results), **context))
+    set_result_caching(response, etag, private)
+    return response
+
+# Current change count of RECIPE, read from the database at most once every RESULT_VERSION_TTL seconds
+def recipe_version():
+    version = version_cache.get('RECIPE')
+    if version is None:
+        version = offload(repository.table_version, get_db(), 'RECIPE')
+        version_cache.set('RECIPE', version)
+    return version
+
+# ETag of a result page - key ends with the recipe_version() the page was built at, so the ETag changes whenever
+# RECIPE or the templates and stylesheet the page is built from change
+def result_etag(key):
+    value = repr((RESULT_PAGES_VERSION,) + key)
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()[:16]
+
+# True if the browser sent If-None-Match with etag and the page would be the same as its copy
+# a page with flashed messages waiting is always sent in full, or the messages would be lost
+def is_unchanged(etag):
+    return request.method == 'GET' and request.if_none_match.contains_weak(etag) and not session.get('_flashes')
+
+def not_modified(etag, private=False):
+    response = app.response_class(status=304)
+    set_result_caching(response, etag, private)
+    return response
+
+# result pages may be stored by browsers and proxies, but must be checked with the server before each use
+# the ETag is weak as it names the page, not its bytes - the page is sent gzip, brotli or uncompressed
+def set_result_caching(response, etag, private=False):
+    response.set_etag(etag, weak=True)
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.cache_control.no_cache = True
 
 # add recipe to the users favourites
 @app.route('/addToFavourites', methods=['POST'])
@@ -518,55 +798,37 @@ def addToFavourites():
     recipe_id = request.form.get("recipe_id")
 
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
+        conn = get_db()
 
-        # Check if the recipe exists
-        query = "SELECT COUNT(*) FROM RECIPE WHERE ID = ?"
-        cursor.execute(query, (recipe_id,))
-        recipe_exists = cursor.fetchone()[0]
-
-        if not recipe_exists:
-            flash("Recipe does not exist.")
-            return redirect(url_for('searchRecipe'))
-
-        # Get the current user's favourite recipes
-        query = "SELECT FavouriteRecipes FROM USER WHERE Username = ?"
-        cursor.execute(query, (current_user.username,))
-        current_favourites = cursor.fetchone()[0]
+        # Add the recipe to the user's favourites
+        # only inserts if the recipe exists, and is ignored if it is already a favourite
+        added = repository.add_favourite(conn, current_user.username, recipe_id)
+        conn.commit()
 
-        # check if the recipe is already in the user's favourites
-        if current_favourites and recipe_id in current_favourites.split(','):
+        if not added:
+            # nothing was inserted - find out why
+            if not repository.recipe_exists(conn, recipe_id):
+                flash("Recipe does not exist.")
+                return redirect(url_for('searchRecipe'))
             flash("Recipe is already in your favorites.")
-            return redirect(request.referrer, code=307)
-
-        # Append the new recipe ID to the list of favourites
-        if current_favourites:
-            current_favourites += ',' + recipe_id
-        else:
-            current_favourites = recipe_id
-
-        # Update the FavouriteRecipes column
-        update_query = "UPDATE USER SET FavouriteRecipes = ? WHERE Username = ?"
-        cursor.execute(update_query, (current_favourites, current_user.username))
-        conn.commit()
+            return redirect_back()
 
+        profile_cache.invalidate(current_user.username)
         flash("Recipe added to favourites successfully.")
         # do not want redirect after every added favourite
         # return redirect(url_for('profile'))
         # redirect back to same page before form submission
-        # code=307 indicates to browser preserve the request method during redirection
-        # This should resolve the "Method Not Allowed" error
-        return redirect(request.referrer, code=307)
+        return redirect_back()
 
-    except Error as e:
-        print(e)
+    except Error:
+        log.exception("Database error")
         flash("Failed to add recipe to favourites.")
         return redirect(url_for('profile'))
 
-    finally:
-        if conn:
-            conn.close()
+# send the browser back to the page the form was on with a GET (303 See Other)
+# the result pages are GET pages now, so the old 307 - which repeated the POST - is no longer needed
+def redirect_back():
+    return redirect(request.referrer or url_for('searchRecipe'), code=303)
 
 # remove a recipe from the users favourites
 @app.route('/removeFromFavourites', methods=['POST'])
@@ -578,44 +840,130 @@ def removeFromFavourites():
     recipe_id = request.form.get("recipe_id")
 
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-
-        # Check if the recipe ID exists in the user's favourites
-        query = "SELECT FavouriteRecipes FROM USER WHERE Username = ?"
-        cursor.execute(query, (current_user.username,))
-        row = cursor.fetchone()
-        if not row:
-            flash("Failed to remove recipe from favourites. User not found.")
-            return redirect(url_for('profile'))
-
-        favourite_recipes = row[0]
-        if favourite_recipes is None:
-            flash("Failed to remove recipe from favourites. User has no favourite recipes.")
-            return redirect(url_for('profile'))
-
-        # Split the string of favourite recipe IDs and remove the selected ID
-        recipe_ids = favourite_recipes.split(',')
-        if recipe_id in recipe_ids:
-            recipe_ids.remove(recipe_id)
+        conn = get_db()
 
-        # Update the user's favourite recipes in the database
-        updated_favourite_recipes = ','.join(recipe_ids)
-        update_query = "UPDATE USER SET FavouriteRecipes = ? WHERE Username = ?"
-        cursor.execute(update_query, (updated_favourite_recipes, current_user.username))
+        # Remove the recipe from the user's favourites
+        removed = repository.remove_favourite(conn, current_user.username, recipe_id)
         conn.commit()
 
+        if not removed:
+            flash("Failed to remove recipe from favourites. Recipe is not in your favourites.")
+            return redirect(url_for('profile'))
+
+        profile_cache.invalidate(current_user.username)
         flash("Recipe removed from favourites successfully.")
         return redirect(url_for('profile'))
 
-    except Error as e:
-        print(e)
+    except Error:
+        log.exception("Database error")
         flash("Failed to remove recipe from favourites. Please try again.")
         return redirect(url_for('profile'))
 
+# JSON API - the recipes of the pages above for the mobile client and sync jobs (see api.py)
+# every route needs a logged in session, and answers errors as {"error": message}
+def api_login_required():
+    if not current_user.is_authenticated:
+        raise api.ApiError("You need to login to use the API.", 401)
+
+# one recipe in full
+@app.route('/api/recipes/<int:recipe_id>')
+def apiRecipe(recipe_id):
+    api_login_required()
+    fields = api.requested_fields(repository.Recipe)
+    # an ID too large for the database cannot be a recipe
+    if recipe_id > MAX_INTEGER:
+        raise api.ApiError("Recipe does not exist.", 404)
+    try:
+        etag = result_etag(('api_recipe', recipe_id, tuple(fields), recipe_version()))
+        if is_unchanged(etag):
+            return not_modified(etag, private=True)
+        recipe_data = offload(repository.get_recipe, get_db(), recipe_id)
+    except Error:
+        log.exception("Database error")
+        raise api.ApiError("Database error.", 500)
+    if not recipe_data:
+        raise api.ApiError("Recipe does not exist.", 404)
+    response = api.recipe_response(recipe_data, fields)
+    set_result_caching(response, etag, private=True)
+    return response
+
+# recipes matching ?keyword=, taking at most ?max_time= minutes, in ?sort= order - the same search as
+# searchRecipeAction, except that without a keyword it lists every recipe
+@app.route('/api/search')
+def apiSearch():
+    api_login_required()
+    keyword = request.args.get("keyword", "")
+    max_time = api.minutes_limit("max_time")
+    sort = request.args.get("sort") or None
+    if sort is not None and sort not in SORTS:
+        raise api.ApiError("Unknown sort %r, expected one of %s." % (sort, ', '.join(SORTS)))
+    sort = default_sort(keyword, sort)
+    return api_list(repository.SearchResult, ('api_search', normalize_keyword(keyword), max_time, sort),
+                    lambda conn, after, before, size: repository.search_page(conn, keyword, after, before, size,
+                                                                             max_time, sort))
+
+# the recipes of a user, oldest first
+@app.route('/api/users/<username>/recipes')
+def apiPortfolio(username):
+    api_login_required()
+    return api_list(repository.Recipe, ('api_portfolio', username),
+                    lambda conn, after, before, size: repository.user_recipes_page(conn, username, after, before,
+                                                                                   size))
+
+# the logged in user's favourites, in the order they were added
+# a user's favourites are few enough to send in one go, from the same cached list as the profile page
+@app.route('/api/favourites')
+def apiFavourites():
+    api_login_required()
+    fields = api.requested_fields(repository.Recipe)
+    stream = api.wants_stream()
+    favourite_recipes = profile_cache.get(current_user.username)
+    if favourite_recipes is None:
+        try:
+            favourite_recipes = offload(repository.favourite_recipes, get_db(), current_user.username)
+        except Error:
+            log.exception("Database error")
+            raise api.ApiError("Database error.", 500)
+        profile_cache.set(current_user.username, favourite_recipes)
+    page = Page(favourite_recipes, None, None)
+    if stream:
+        return api.stream_response(app.response_class, page, None, fields)
+    return api.page_response(page, fields)
+
+# a list of recipes as a page of JSON, or streamed as NDJSON - fetch(conn, after, before, page_size) reads a page
+# JSON pages get the same ETags as the result pages, the streams are read fresh every time
+def api_list(record, key, fetch):
+    fields = api.requested_fields(record)
+    stream = api.wants_stream()
+    after = request.args.get("after")
+    before = request.args.get("before")
+    page_size = api.page_size(app.config['PAGE_SIZE'])
+    try:
+        if stream:
+            # a slow download must not keep a connection from the other requests for as long as it lasts -
+            # each batch borrows one for its own read instead
+            database.release_db()
+            page = read_batch(fetch, after)
+            return api.stream_response(app.response_class, page, lambda cursor: read_batch(fetch, cursor), fields)
+        etag = result_etag(key + (after, before, page_size, tuple(fields), recipe_version()))
+        if is_unchanged(etag):
+            return not_modified(etag, private=True)
+        page = offload(fetch, get_db(), after, before, page_size)
+    except Error:
+        log.exception("Database error")
+        raise api.ApiError("Database error.", 500)
+    response = api.page_response(page, fields)
+    set_result_caching(response, etag, private=True)
+    return response
+
+# read the STREAM_BATCH recipes after cursor with fetch, on a connection borrowed for just this read
+def read_batch(fetch, cursor):
+    pool = database.get_pool()
+    conn = pool.acquire()
+    try:
+        return offload(fetch, conn, cursor, None, api.STREAM_BATCH)
     finally:
-        if conn:
-            conn.close()
+        pool.release(conn)
 
 # logout out the user
 @app.route("/logout")
@@ -626,5 +974,43 @@ def logout():
     flash("Logout successfull.")
     return redirect(url_for('login'))
 
+# liveness check for the server or load balancer - answers as long as the process can serve requests
+@app.route('/health')
+def health():
+    return jsonify(status="ok")
+
+# readiness check - the database can be used and the app is not shutting down
+@app.route('/ready')
+def ready():
+    if shutting_down.is_set():
+        return jsonify(status="shutting down"), 503
+    try:
+        repository.table_version(get_db(), 'RECIPE')
+    except Error:
+        log.exception("Database error")
+        return jsonify(status="database unavailable"), 503
+    return jsonify(status="ready", pool=database.get_pool().stats())
+
+# set once shutdown() has started, from then on /ready answers 503
+shutting_down = threading.Event()
+
+# Stop the app cleanly - called by the server as a worker exits (see wsgi.py and gunicorn.conf.py)
+# queued image renditions are finished, the popular list and the hashing processes stopped and the connection pool
+# drained
+def shutdown():
+    # nothing was started if the app was never created
+    if shutting_down.is_set() or 'db_pool' not in app.extensions:
+        return
+    shutting_down.set()
+    image_pipeline.shutdown(wait=True)
+    popular_recipes.stop()
+    password_hasher.shutdown()
+    if 'profiler' in app.extensions:
+        app.extensions['profiler'].stop()
+    pool = app.extensions['db_pool']
+    if not pool.drain(app.config['SHUTDOWN_TIMEOUT']):
+        log.warning("Shutdown: database connections were still in use", extra={'in_use': pool.stats()['in_use']})
+
+# development server only - production runs through wsgi.py
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
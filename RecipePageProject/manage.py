@@ -0,0 +1,177 @@
+# command line maintenance tasks for the recipe database
+# usage: python manage.py <command> [--db mySQLite.db]
+import argparse
+import sys
+
+import assets
+import catalogue
+import database
+import images
+import migrations
+import popular
+import search
+
+# where main.py saves uploaded images
+UPLOAD_FOLDER = 'static/uploads'
+
+
+# create the database, or bring its schema up to date (also done when the app starts)
+def migrate(args):
+    conn = database.connect(args.db)
+    try:
+        before = migrations.schema_version(conn)
+        applied = migrations.migrate(conn, log=print)
+        if applied:
+            print("Schema upgraded from version %d to %d." % (before, migrations.LATEST_VERSION))
+        else:
+            print("Schema is up to date (version %d)." % before)
+    finally:
+        conn.close()
+
+
+# rebuild the full-text search index from the RECIPE table
+def rebuild_search(args):
+    conn = database.connect(args.db)
+    try:
+        database.ensure_schema(conn)
+        search.rebuild_search_index(conn)
+        conn.commit()
+        count = conn.execute("SELECT COUNT(*) FROM RECIPE").fetchone()[0]
+        print("Search index rebuilt for %d recipes." % count)
+    finally:
+        conn.close()
+
+
+# make the thumbnail, card and full size copies of existing recipe images
+def backfill_images(args):
+    conn = database.connect(args.db)
+    try:
+        database.ensure_schema(conn)
+    finally:
+        conn.close()
+    pool = database.ConnectionPool(args.db, size=1)
+    try:
+        processed, skipped = images.backfill(pool, UPLOAD_FOLDER)
+    finally:
+        pool.close()
+    print("Created renditions for %d recipes, skipped %d." % (processed, skipped))
+
+
+# add the recipes of a JSONL or CSV file, a batch per transaction - rerun after an interruption to carry on
+def import_recipes(args):
+    conn = database.connect(args.db)
+    try:
+        database.ensure_schema(conn)
+        counts = catalogue.import_recipes(conn, args.path, args.format, UPLOAD_FOLDER, args.images_dir,
+                                          args.batch_size, args.checkpoint or args.path + '.checkpoint')
+    finally:
+        conn.close()
+    print("Read %(read)d records: added %(added)d, %(duplicate)d already existed, %(invalid)d invalid, "
+          "%(unknown_user)d for unknown users." % counts)
+    if counts['added']:
+        print("Run backfill-images to make the resized copies of imported images.")
+
+
+# write every recipe to a JSONL or CSV file, or to stdout with -
+def export_recipes(args):
+    conn = database.connect(args.db)
+    try:
+        database.ensure_schema(conn)
+        out = catalogue.open_output(args.path)
+        try:
+            written = catalogue.export_recipes(conn, out, args.format or _format_of(args.path), args.batch_size,
+                                               UPLOAD_FOLDER)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    finally:
+        conn.close()
+    print("Exported %d recipes." % written, file=sys.stderr)
+
+
+# compare the favourite count kept for every recipe with FAVOURITE, and with --fix recount them all
+# exits with status 1 if the counts were wrong and left as they were
+def check_favourites(args):
+    conn = database.connect(args.db)
+    try:
+        database.ensure_schema(conn)
+        if args.fix:
+            mismatches = database.write_transaction(conn, _recount_favourites)
+        else:
+            # both counts are read in one transaction, so they are of the same moment
+            conn.execute("BEGIN")
+            try:
+                mismatches = popular.check_favourite_counts(conn)
+            finally:
+                conn.rollback()
+    finally:
+        conn.close()
+    for mismatch in mismatches[:catalogue.MAX_REPORTED]:
+        print("Recipe %d: %d favourites counted, %d in FAVOURITE." % mismatch)
+    if len(mismatches) > catalogue.MAX_REPORTED:
+        print("%d more recipes with wrong counts." % (len(mismatches) - catalogue.MAX_REPORTED))
+    if not mismatches:
+        print("Favourite counts are correct.")
+    elif args.fix:
+        print("Recounted the favourites, %d recipes had wrong counts." % len(mismatches))
+    else:
+        sys.exit(1)
+
+
+def _recount_favourites(conn):
+    mismatches = popular.check_favourite_counts(conn)
+    if mismatches:
+        popular.rebuild_favourite_counts(conn)
+    return mismatches
+
+
+def _format_of(path):
+    return 'jsonl' if path == '-' else catalogue.guess_format(path)
+
+
+# make the gzip and brotli copies of the stylesheet (also done when the app starts)
+def precompress_assets(args):
+    written = assets.precompress('static')
+    print("Wrote %d compressed files." % written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recipe Realm maintenance commands.")
+    parser.add_argument('--db', default='mySQLite.db', help="database file (default: mySQLite.db)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('migrate', help="create or upgrade the database schema").set_defaults(func=migrate)
+    commands.add_parser('rebuild-search', help="backfill the full-text search index").set_defaults(func=rebuild_search)
+    commands.add_parser('precompress-assets', help="make compressed copies of the css files").set_defaults(func=precompress_assets)
+    commands.add_parser('backfill-images', help="make resized copies of existing recipe images").set_defaults(func=backfill_images)
+
+    importer = commands.add_parser('import-recipes', help="add recipes from a JSONL or CSV file")
+    importer.add_argument('path', help="file to read, one recipe per line or row")
+    importer.add_argument('--format', choices=catalogue.FORMATS, help="file format (default: from the file name)")
+    importer.add_argument('--batch-size', type=int, default=catalogue.BATCH_SIZE,
+                          help="recipes per transaction (default: %d)" % catalogue.BATCH_SIZE)
+    importer.add_argument('--checkpoint', help="progress file for resuming (default: <path>.checkpoint)")
+    importer.add_argument('--images-dir', help="folder image paths are relative to, tried before the upload folder "
+                                               "(default: the file's folder)")
+    importer.set_defaults(func=import_recipes)
+
+    exporter = commands.add_parser('export-recipes', help="write every recipe to a JSONL or CSV file")
+    exporter.add_argument('path', help="file to write, - for stdout")
+    exporter.add_argument('--format', choices=catalogue.FORMATS, help="file format (default: from the file name)")
+    exporter.add_argument('--batch-size', type=int, default=catalogue.BATCH_SIZE,
+                          help="recipes read per query (default: %d)" % catalogue.BATCH_SIZE)
+    exporter.set_defaults(func=export_recipes)
+
+    checker = commands.add_parser('check-favourites', help="check the favourite count of every recipe")
+    checker.add_argument('--fix', action='store_true', help="recount them from FAVOURITE if any are wrong")
+    checker.set_defaults(func=check_favourites)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except catalogue.CatalogueError as e:
+        parser.exit(1, "%s\n" % e)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# request metrics, served at /metrics in the Prometheus text format
+# for every endpoint: requests by method and status, a latency histogram, and the SQL queries, SQL time,
+# template rendering time and response bytes that went into its requests.
+# collectors added with add_collector() report gauges read at scrape time (pool, caches, per-query timings).
+# every server worker process keeps its own numbers, so a scrape sees the worker that answered it -
+# scrape each worker, or add the numbers up over several scrapes
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, g, has_request_context, request
+from jinja2 import Template
+
+import logs
+
+log = logs.get_logger('metrics')
+
+# upper bounds of the latency histogram buckets (seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# requests slower than this are logged with their query count and timings (seconds), None to log none
+SLOW_REQUEST = 1.0
+PREFIX = 'recipe_'
+
+
+# Counts, sums and histograms per endpoint, safe to update from many threads
+class RequestMetrics():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # (endpoint, method, status) -> requests
+        self._requests = defaultdict(int)
+        # endpoint -> count in each bucket (the last one is +Inf), and the total seconds
+        self._histogram = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self._seconds = defaultdict(float)
+        # endpoint -> totals
+        self._queries = defaultdict(int)
+        self._query_seconds = defaultdict(float)
+        self._template_seconds = defaultdict(float)
+        self._bytes = defaultdict(int)
+
+    def record(self, endpoint, method, status, seconds, queries, query_seconds, template_seconds, size):
+        bucket = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                bucket = i
+                break
+        with self._lock:
+            self._requests[(endpoint, method, status)] += 1
+            self._histogram[endpoint][bucket] += 1
+            self._seconds[endpoint] += seconds
+            self._queries[endpoint] += queries
+            self._query_seconds[endpoint] += query_seconds
+            self._template_seconds[endpoint] += template_seconds
+            self._bytes[endpoint] += size
+
+    # Lines of the Prometheus text format
+    def exposition(self):
+        with self._lock:
+            lines = _header('requests_total', 'counter', "Requests handled, by endpoint, method and status.")
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                lines.append(_sample('requests_total', count, endpoint=endpoint, method=method, status=status))
+
+            lines += _header('request_seconds', 'histogram', "Time taken to handle a request.")
+            for endpoint, counts in sorted(self._histogram.items()):
+                total = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    total += count
+                    lines.append(_sample('request_seconds_bucket', total, endpoint=endpoint, le=bound))
+                lines.append(_sample('request_seconds_sum', self._seconds[endpoint], endpoint=endpoint))
+                lines.append(_sample('request_seconds_count', total, endpoint=endpoint))
+
+            for name, values, help_text in (
+                    ('request_queries_total', self._queries, "SQL queries run by requests."),
+                    ('request_query_seconds_total', self._query_seconds, "Time requests spent in SQL queries."),
+                    ('request_template_seconds_total', self._template_seconds, "Time requests spent rendering templates."),
+                    ('response_bytes_total', self._bytes, "Bytes of response bodies sent.")):
+                lines += _header(name, 'counter', help_text)
+                for endpoint, value in sorted(values.items()):
+                    lines.append(_sample(name, value, endpoint=endpoint))
+            return lines
+
+
+# Jinja template that adds the time it takes to render to the current request's total
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            if has_request_context():
+                g._template_seconds = g.get('_template_seconds', 0.0) + time.perf_counter() - start
+
+
+# Gauges from a dict of numbers, e.g. the stats() of a cache: name -> [(labels, value)]
+def gauges(prefix, stats, **labels):
+    return {prefix + '_' + key: [(labels, value)] for key, value in stats.items()
+            if isinstance(value, (int, float))}
+
+
+# Record metrics for every request of app, and serve them at /metrics if endpoint is True
+# collectors are called at each scrape and return gauges as {name: [(labels, value), ...]}
+def init_app(app, slow_request=SLOW_REQUEST, endpoint=True):
+    metrics = RequestMetrics()
+    collectors = []
+    app.extensions['metrics'] = (metrics, collectors)
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def start_timer():
+        g._request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('_request_start', None)
+        if start is None:
+            return response
+        seconds = time.perf_counter() - start
+        # the request's connection counts the queries run on it (see database.Connection)
+        queries, query_seconds = 0, 0.0
+        conn = g.get('db')
+        if conn is not None and hasattr(conn, 'take_query_counts'):
+            queries, query_seconds = conn.take_query_counts()
+        template_seconds = g.pop('_template_seconds', 0.0)
+        endpoint = request.endpoint or 'none'
+        metrics.record(endpoint, request.method, response.status_code, seconds, queries, query_seconds,
+                       template_seconds, response.content_length or 0)
+        if slow_request is not None and seconds > slow_request:
+            log.warning("Slow request", extra={'path': request.path, 'status': response.status_code,
+                                               'ms': seconds * 1000, 'queries': queries, 'query_ms': query_seconds * 1000,
+                                               'template_ms': template_seconds * 1000})
+        return response
+
+    def metrics_endpoint():
+        lines = metrics.exposition()
+        for collect in collectors:
+            for name, samples in sorted(collect().items()):
+                lines += _header(name, 'gauge', None)
+                for labels, value in samples:
+                    lines.append(_sample(name, value, **labels))
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+    if endpoint:
+        app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
+    return metrics
+
+
+# Report the gauges returned by collect() at every scrape of app's /metrics
+def add_collector(app, collect):
+    app.extensions['metrics'][1].append(collect)
+
+
+def _header(name, kind, help_text):
+    lines = ['# HELP %s%s %s' % (PREFIX, name, help_text)] if help_text else []
+    return lines + ['# TYPE %s%s %s' % (PREFIX, name, kind)]
+
+
+def _sample(name, value, **labels):
+    if labels:
+        label_text = ','.join('%s="%s"' % (key, _escape(value)) for key, value in labels.items())
+        return '%s%s{%s} %s' % (PREFIX, name, label_text, _number(value))
+    return '%s%s %s' % (PREFIX, name, _number(value))
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    if isinstance(value, float):
+        value = repr(value)
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
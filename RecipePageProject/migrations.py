@@ -0,0 +1,271 @@
+# versioned schema migrations for the recipe database
+# the schema version is kept in the database file itself (PRAGMA user_version). on start, and with
+# "python manage.py migrate", every migration newer than that version runs in order, each in its own
+# transaction together with the version bump - so a failed migration leaves the database as it was.
+# a database made before the migrations existed is at version 0; the first ones only create what is missing,
+# so they are safe on any older copy of the database.
+# to change the schema add a new function to the end of MIGRATIONS - never edit one that has been released
+import cooktime
+import images
+import popular
+import search
+
+
+# Raised when a migration cannot be applied, the database is left at the last good version
+class MigrationError(Exception):
+    pass
+
+
+# Tables whose changes are counted, see repository.table_version()
+COUNTED_TABLES = ('RECIPE',)
+
+
+# 1 - the original tables, for a new empty database
+def create_tables(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS USER (
+        Username VARCHAR(255) PRIMARY KEY,
+        Password VARCHAR(255) NOT NULL,
+        Email VARCHAR(255) NOT NULL,
+        First_Name CHAR(25),
+        Last_Name CHAR(25),
+        FavouriteRecipes TEXT
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS RECIPE (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Username TEXT NOT NULL,
+        RecipeName TEXT NOT NULL,
+        Info TEXT,
+        Time TEXT NOT NULL,
+        ImagePath TEXT,
+        Steps TEXT NOT NULL,
+        FOREIGN KEY (Username) REFERENCES USER(Username)
+    )""")
+
+
+# 2 - favourite recipes, one row per (user, recipe), rowid keeps the order they were added in
+def create_favourites(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS FAVOURITE (
+        Username TEXT NOT NULL REFERENCES USER(Username),
+        RecipeID INTEGER NOT NULL REFERENCES RECIPE(ID),
+        PRIMARY KEY (Username, RecipeID)
+    )""")
+    # reverse lookup used when a recipe is deleted
+    conn.execute("CREATE INDEX IF NOT EXISTS FAVOURITE_RecipeID ON FAVOURITE(RecipeID)")
+    migrate_favourites(conn)
+
+
+# Move the old comma separated USER.FavouriteRecipes strings into FAVOURITE
+# the old column is emptied afterwards
+def migrate_favourites(conn):
+    rows = conn.execute("SELECT Username, FavouriteRecipes FROM USER WHERE FavouriteRecipes IS NOT NULL").fetchall()
+    for username, favourites in rows:
+        for recipe_id in favourites.split(','):
+            recipe_id = recipe_id.strip()
+            # old rows contain values such as 'None' and ids of recipes that were since deleted
+            if recipe_id.isdigit():
+                conn.execute("INSERT OR IGNORE INTO FAVOURITE (Username, RecipeID) SELECT ?, ID FROM RECIPE WHERE ID = ?",
+                             (username, int(recipe_id)))
+    conn.execute("UPDATE USER SET FavouriteRecipes = NULL WHERE FavouriteRecipes IS NOT NULL")
+
+
+# 3 - full-text index used by the recipe search
+def create_search_index(conn):
+    search.ensure_search_index(conn)
+
+
+# 4 - resized copies of the recipe images
+def add_image_columns(conn):
+    images.ensure_image_columns(conn)
+
+
+# 5 - CHANGE_COUNTER, one row per counted table, its Version goes up by one for every row changed
+# the triggers run inside the same transaction as the change, so every connection and process sees the same number
+def create_change_counters(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS CHANGE_COUNTER (
+        TableName TEXT PRIMARY KEY,
+        Version INTEGER NOT NULL DEFAULT 0
+    )""")
+    for table in COUNTED_TABLES:
+        conn.execute("INSERT OR IGNORE INTO CHANGE_COUNTER (TableName) VALUES (?)", (table,))
+        create_counter_triggers(conn, table)
+
+
+def create_counter_triggers(conn, table):
+    for event in ('INSERT', 'DELETE', 'UPDATE'):
+        conn.execute("""CREATE TRIGGER IF NOT EXISTS %s_count_%s AFTER %s ON %s BEGIN
+            UPDATE CHANGE_COUNTER SET Version = Version + 1 WHERE TableName = '%s';
+        END""" % (table, event.lower(), event, table, table))
+
+
+# 6 - deleting a user deletes their recipes and favourites, deleting a recipe removes it from every favourites list
+# sqlite cannot change the foreign keys of a table, so RECIPE and FAVOURITE are copied into new tables
+# (keeping their IDs and the order of the favourites) and the old ones dropped
+def cascade_deletes(conn):
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'RECIPE'").fetchone()
+    conn.execute("""CREATE TABLE RECIPE_new (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Username TEXT NOT NULL REFERENCES USER(Username) ON DELETE CASCADE,
+        RecipeName TEXT NOT NULL,
+        Info TEXT,
+        Time TEXT NOT NULL,
+        ImagePath TEXT,
+        Steps TEXT NOT NULL,
+        ImageThumb TEXT,
+        ImageCard TEXT,
+        ImageFull TEXT
+    )""")
+    columns = "ID, Username, RecipeName, Info, Time, ImagePath, Steps, ImageThumb, ImageCard, ImageFull"
+    conn.execute("INSERT INTO RECIPE_new (%s) SELECT %s FROM RECIPE" % (columns, columns))
+    conn.execute("DROP TABLE RECIPE")
+    conn.execute("ALTER TABLE RECIPE_new RENAME TO RECIPE")
+    # AUTOINCREMENT never reuses the ID of a deleted recipe - carry on from where the old table was
+    if sequence is not None:
+        conn.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'RECIPE'", sequence)
+
+    conn.execute("""CREATE TABLE FAVOURITE_new (
+        Username TEXT NOT NULL REFERENCES USER(Username) ON DELETE CASCADE,
+        RecipeID INTEGER NOT NULL REFERENCES RECIPE(ID) ON DELETE CASCADE,
+        PRIMARY KEY (Username, RecipeID)
+    )""")
+    conn.execute("INSERT INTO FAVOURITE_new (rowid, Username, RecipeID) SELECT rowid, Username, RecipeID FROM FAVOURITE")
+    conn.execute("DROP TABLE FAVOURITE")
+    conn.execute("ALTER TABLE FAVOURITE_new RENAME TO FAVOURITE")
+    conn.execute("CREATE INDEX FAVOURITE_RecipeID ON FAVOURITE(RecipeID)")
+
+    # dropping RECIPE dropped its triggers - the search index itself still holds the same IDs
+    search.ensure_search_index(conn)
+    create_counter_triggers(conn, 'RECIPE')
+
+
+# 7 - indexes for looking recipes up by user
+# RECIPE_Username serves the portfolio pages: an index also holds the rowid (ID), so a user's recipes come out
+# of it already in ID order and a page starts straight at its cursor with no sort
+# RECIPE_Username_RecipeName stops a user having two recipes with the same name
+def create_recipe_indexes(conn):
+    # older copies of the database may already have duplicates - later ones get their ID added to the name
+    conn.execute("""UPDATE RECIPE SET RecipeName = RecipeName || ' (' || ID || ')'
+        WHERE ID NOT IN (SELECT min(ID) FROM RECIPE GROUP BY Username, RecipeName)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS RECIPE_Username ON RECIPE(Username)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS RECIPE_Username_RecipeName ON RECIPE(Username, RecipeName)")
+
+
+# 8 - RECIPE.Minutes, the time of each recipe read as whole minutes (NULL where none could be read),
+# filled in for the existing recipes and indexed with RecipeName so searches can filter and sort by either
+def add_cook_minutes(conn):
+    conn.execute("ALTER TABLE RECIPE ADD COLUMN Minutes INTEGER")
+    times = conn.execute("SELECT ID, Time FROM RECIPE").fetchall()
+    conn.executemany("UPDATE RECIPE SET Minutes = ? WHERE ID = ?",
+                     [(cooktime.parse_minutes(recipe_time), recipe_id) for recipe_id, recipe_time in times])
+    conn.execute("CREATE INDEX IF NOT EXISTS RECIPE_Minutes ON RECIPE(Minutes)")
+    conn.execute("CREATE INDEX IF NOT EXISTS RECIPE_RecipeName ON RECIPE(RecipeName)")
+
+
+# 9 - FAVOURITE_COUNT, the number of favourites of each recipe, counted from the existing favourites and kept up to
+# date by triggers on FAVOURITE (see popular.py)
+def add_favourite_counts(conn):
+    popular.ensure_favourite_counts(conn)
+
+
+# 10 - RECIPE_ImagePath, so an uploaded image can be checked for recipes still using it before its file is removed
+# (see images.ImagePipeline.discard_unused) - only recipes with an image are indexed
+def index_image_paths(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS RECIPE_ImagePath ON RECIPE(ImagePath) WHERE ImagePath IS NOT NULL")
+
+
+# 11 - RECIPE_Minutes_RecipeName, so a browse by name with a time limit finds the recipes within the limit, and their
+# names, in the index instead of walking every recipe in name order (dropped again by migration 13)
+def index_minutes_and_names(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS RECIPE_Minutes_RecipeName ON RECIPE(Minutes, RecipeName)")
+
+
+# 12 - RECIPE.Minutes read again from Time, now that a number is only read whole and a number without a unit only as
+# minutes where it is one ('Bake at 180C for 25 mins' was stored as 43, 'serves 4, 20 mins' as 24)
+def reread_cook_minutes(conn):
+    changed = []
+    for recipe_id, recipe_time, stored in conn.execute("SELECT ID, Time, Minutes FROM RECIPE").fetchall():
+        minutes = cooktime.parse_minutes(recipe_time)
+        if minutes != stored:
+            changed.append((minutes, recipe_id))
+    conn.executemany("UPDATE RECIPE SET Minutes = ? WHERE ID = ?", changed)
+
+
+# 13 - drop RECIPE_Minutes_RecipeName - a browse by name with a time limit few recipes are within sorts the rows it
+# finds in RECIPE_Minutes, and walks RECIPE_RecipeName otherwise (see search.CHOSEN_BY_SELECTIVITY)
+def drop_minutes_and_names_index(conn):
+    conn.execute("DROP INDEX IF EXISTS RECIPE_Minutes_RecipeName")
+
+
+# in order - the position in the list (from 1) is the schema version a migration brings the database to
+MIGRATIONS = (
+    create_tables,
+    create_favourites,
+    create_search_index,
+    add_image_columns,
+    create_change_counters,
+    cascade_deletes,
+    create_recipe_indexes,
+    add_cook_minutes,
+    add_favourite_counts,
+    index_image_paths,
+    index_minutes_and_names,
+    reread_cook_minutes,
+    drop_minutes_and_names_index,
+)
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+# Bring the database up to LATEST_VERSION and return the versions that were applied
+# safe to call from several processes at once - BEGIN IMMEDIATE lets one of them migrate while the others
+# wait, and they then find there is nothing left to do
+def migrate(conn, log=None):
+    if schema_version(conn) > LATEST_VERSION:
+        raise MigrationError("Database schema version %d is newer than this code (%d)."
+                             % (schema_version(conn), LATEST_VERSION))
+    applied = []
+    if schema_version(conn) < LATEST_VERSION:
+        # tables are dropped and copied while migrating, which foreign key checks would stop half way
+        # the whole database is checked at the end of each migration instead
+        # (the setting cannot change inside a transaction, so it is switched here)
+        conn.execute("PRAGMA foreign_keys=OFF")
+        try:
+            for version, upgrade in enumerate(MIGRATIONS, 1):
+                if _apply(conn, version, upgrade):
+                    applied.append(version)
+                    if log:
+                        log("Applied migration %d: %s" % (version, upgrade.__name__))
+        finally:
+            conn.execute("PRAGMA foreign_keys=ON")
+    if applied:
+        # fresh statistics for the query planner, the new indexes are only used well once it has them
+        conn.execute("ANALYZE")
+        conn.commit()
+    else:
+        conn.execute("PRAGMA optimize")
+    return applied
+
+
+# Run one migration if the database is not already past it, True if it ran
+def _apply(conn, version, upgrade):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if schema_version(conn) >= version:
+            conn.rollback()
+            return False
+        upgrade(conn)
+        problems = conn.execute("PRAGMA foreign_key_check").fetchall()
+        if problems:
+            tables = sorted({row[0] for row in problems})
+            raise MigrationError("Migration %d (%s) left %d rows pointing at missing rows in %s."
+                                 % (version, upgrade.__name__, len(problems), ', '.join(tables)))
+        # the version is part of the same transaction as the changes
+        conn.execute("PRAGMA user_version = %d" % version)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return True
@@ -0,0 +1,112 @@
+# keyset pagination for the recipe lists
+# a page continues from the sort key of the last row shown instead of using OFFSET,
+# so every page costs the same no matter how far into the results it is
+import base64
+import re
+from collections import namedtuple
+
+# default number of recipes on one page (app.config['PAGE_SIZE'] overrides it)
+PAGE_SIZE = 20
+
+# columns the recipe cards need - same positions as SELECT * so the templates index them the same way
+# only the start of Steps is sent to the list pages, the full text is on the recipe page
+# the card sized image is used once it has been made, the original until then
+STEPS_PREVIEW_LENGTH = 200
+CARD_COLUMNS = ("RECIPE.ID, RECIPE.Username, RECIPE.RecipeName, RECIPE.Info, RECIPE.Time, "
+                "coalesce(RECIPE.ImageCard, RECIPE.ImagePath) AS ImagePath, "
+                "substr(RECIPE.Steps, 1, %d) AS Steps, length(RECIPE.Steps) > %d AS StepsTruncated"
+                % (STEPS_PREVIEW_LENGTH, STEPS_PREVIEW_LENGTH))
+
+# the integers sqlite can store - an ID or cursor outside this range cannot match any row, and would not bind
+MIN_INTEGER = -2 ** 63
+MAX_INTEGER = 2 ** 63 - 1
+
+# rows - the recipes on this page
+# next_cursor / prev_cursor - pass as after= / before= to get the neighbouring page, None at either end
+Page = namedtuple('Page', ['rows', 'next_cursor', 'prev_cursor'])
+
+
+# Turn the sort key of a row into a string that can go in a form or URL
+# numbers are written as they are, text as base64url of its UTF-8 bytes so it never holds ':' or needs quoting
+def encode_cursor(values):
+    return ':'.join(encode_text(value) if isinstance(value, str) else repr(value) for value in values)
+
+
+# Read a cursor string back into its sort key, None if it is missing or has been tampered with
+# only the first key may be text - the keys after it are numbers
+def decode_cursor(text, types):
+    if not text:
+        return None
+    parts = text.rsplit(':', len(types) - 1)
+    if len(parts) != len(types):
+        return None
+    try:
+        values = tuple(cast(part) for cast, part in zip(types, parts))
+    except (ValueError, OverflowError):
+        return None
+    if any(isinstance(value, int) and not MIN_INTEGER <= value <= MAX_INTEGER for value in values):
+        return None
+    return values
+
+
+def encode_text(value):
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+# Cursor type of a text sort key - the cursor holds it as encode_text wrote it
+# bytes that are not base64url or not UTF-8 (a lone surrogate is not) raise ValueError, as int() and float() do
+def text(part):
+    if not re.fullmatch(r'[A-Za-z0-9_-]*', part):
+        raise ValueError("not a text cursor: %r" % part)
+    return base64.urlsafe_b64decode(part + '=' * (-len(part) % 4)).decode('utf-8')
+
+
+# SQL for one page of query - the parameters are those of query, then the position if continued, then the limit
+# descending pages through the results from the largest key down
+def keyset_query(query, keys, continued=False, backwards=False, descending=False):
+    # (a, b) > (?, ?) compares the sort keys as a whole, like comparing tuples in python
+    columns = '(%s)' % ', '.join(keys)
+    placeholders = '(%s)' % ', '.join('?' * len(keys))
+    # going back through a descending list reads it in ascending order, and the other way round
+    reverse = backwards != descending
+    direction = ' DESC' if reverse else ''
+    paged_query = "SELECT * FROM (%s)" % query
+    if continued:
+        paged_query += " WHERE %s %s %s" % (columns, '<' if reverse else '>', placeholders)
+    return paged_query + " ORDER BY %s LIMIT ?" % ', '.join(key + direction for key in keys)
+
+
+# Fetch one page of the rows returned by query
+# keys are the columns the results are ordered by, together they must be unique (end with ID)
+# types convert each key column back from a cursor string
+def keyset_page(cursor, query, params, keys, types, after=None, before=None, page_size=PAGE_SIZE, descending=False):
+    after = decode_cursor(after, types)
+    before = decode_cursor(before, types)
+    position = before or after
+    backwards = before is not None
+
+    paged_params = list(params)
+    if position is not None:
+        paged_params += list(position)
+    # one extra row tells us whether there is another page after this one
+    paged_params.append(page_size + 1)
+
+    cursor.execute(keyset_query(query, keys, position is not None, backwards, descending), paged_params)
+    rows = cursor.fetchall()
+    names = [column[0] for column in cursor.description]
+    key_positions = [names.index(key) for key in keys]
+
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+
+    def key_of(row):
+        return encode_cursor(row[i] for i in key_positions)
+
+    if not rows:
+        return Page(rows, None, None)
+    if backwards:
+        # we came back from a later page, so there is always a next one
+        return Page(rows, key_of(rows[-1]), key_of(rows[0]) if more else None)
+    return Page(rows, key_of(rows[-1]) if more else None, key_of(rows[0]) if position is not None else None)
@@ -0,0 +1,184 @@
+# password hashing and login flood protection
+# bcrypt is slow on purpose, so hashing is done in a separate pool of processes: it can use every core,
+# and a burst of logins queues there instead of pinning every web worker thread on the CPU
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import bcrypt
+
+# bcrypt work factor - every step up doubles the time one hash takes
+BCRYPT_LOG_ROUNDS = 12
+# processes doing the hashing, 0 hashes on the request thread instead
+HASH_WORKERS = os.cpu_count() or 1
+# hashes allowed to wait for a free process, per process - anything more is turned away
+MAX_PENDING_PER_WORKER = 4
+# how long a request waits for a place in the queue (seconds)
+QUEUE_TIMEOUT = 5.0
+# how the hashing processes are started, the first one the platform has - not forked from the web worker, whose
+# threads, locks and database connections a forked child would copy in whatever state they were in at that moment
+START_METHODS = ('forkserver', 'spawn')
+# bcrypt only uses the first 72 bytes of a password
+MAX_PASSWORD_BYTES = 72
+
+# failed logins allowed per username and per IP address within the window (seconds)
+MAX_FAILED_LOGINS = 5
+FAILED_LOGIN_WINDOW = 300
+# usernames and addresses whose failures have all expired that each failed login drops
+EXPIRED_PER_FAILURE = 4
+
+
+# Raised when too many hashes are already waiting
+class HashingBusy(Exception):
+    pass
+
+
+# these run inside the worker processes, so they must be plain module level functions
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+def _encode(password):
+    return password.encode('utf-8')[:MAX_PASSWORD_BYTES]
+
+
+# Work factor a stored hash was made with, e.g. 12 for '$2b$12$...'
+def hash_rounds(hashed):
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher():
+    def __init__(self, rounds=BCRYPT_LOG_ROUNDS, workers=HASH_WORKERS, max_pending=None, timeout=QUEUE_TIMEOUT):
+        self.rounds = rounds
+        self.workers = workers
+        self.timeout = timeout
+        if max_pending is None:
+            max_pending = max(1, workers) * MAX_PENDING_PER_WORKER
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # Hash a new password with the configured work factor
+    def hash(self, password):
+        return self._run(_hash, _encode(password), self.rounds)
+
+    # True if password matches the stored hash
+    def check(self, password, hashed):
+        if not hashed:
+            return False
+        return self._run(_check, _encode(password), hashed.encode('utf-8'))
+
+    # True if the stored hash was made with a different work factor than the configured one
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HashingBusy("Too many passwords waiting to be hashed.")
+        try:
+            return self._submit(fn, *args)
+        finally:
+            self._slots.release()
+
+    # a hashing process that dies (killed, or out of memory) breaks the whole pool, and every later hash with it -
+    # so a broken pool is replaced with a new one and the hash tried once more
+    def _submit(self, fn, *args):
+        executor = self._pool()
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            self._replace(executor)
+            return self._pool().submit(fn, *args).result()
+
+    # the processes are only started when first needed, and multiprocessing is only loaded then
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context(next(m for m in START_METHODS if m in methods))
+                # the fork server loads bcrypt once, and the processes forked from it start with it loaded
+                if context.get_start_method() == 'forkserver':
+                    context.set_forkserver_preload([__name__])
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._executor
+
+    # Drop executor if it is still the pool in use - requests that found it broken at the same time start one new pool
+    def _replace(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+
+# Counts failed logins per username and per IP address and blocks either once it has too many
+# a blocked login is turned away before any hashing, so a flood of bad passwords costs no CPU
+# keys are kept in the order of their last failure, so those whose failures have expired are always the first ones
+class LoginThrottle():
+    def __init__(self, max_failures=MAX_FAILED_LOGINS, window=FAILED_LOGIN_WINDOW):
+        self.max_failures = max_failures
+        self.window = window
+        self._failures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_blocked(self, username, address):
+        with self._lock:
+            return any(self._count(key) >= self.max_failures for key in self._keys(username, address))
+
+    # each failure drops at most EXPIRED_PER_FAILURE expired keys, so no failed login waits on a sweep of them all -
+    # and as that is more than the two keys it adds, expired keys never pile up
+    def failed(self, username, address):
+        with self._lock:
+            now = time.monotonic()
+            for key in self._keys(username, address):
+                failures = self._failures.get(key)
+                if failures is None:
+                    failures = self._failures[key] = deque()
+                else:
+                    self._failures.move_to_end(key)
+                failures.append(now)
+            cutoff = now - self.window
+            for _ in range(EXPIRED_PER_FAILURE):
+                key, failures = next(iter(self._failures.items()))
+                if failures[-1] >= cutoff:
+                    break
+                del self._failures[key]
+
+    # a successful login clears the failures for the username, not for the address
+    def succeeded(self, username):
+        with self._lock:
+            self._failures.pop(('user', username), None)
+
+    def _keys(self, username, address):
+        return (('user', username), ('ip', address))
+
+    # must be called with self._lock held
+    def _count(self, key):
+        failures = self._failures.get(key)
+        if not failures:
+            return 0
+        cutoff = time.monotonic() - self.window
+        while failures and failures[0] < cutoff:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return 0
+        return len(failures)
@@ -0,0 +1,120 @@
+# how many users have favourited each recipe, and the most popular recipes shown on the search page
+# FAVOURITE_COUNT holds one row per favourited recipe with its number of favourites. triggers on FAVOURITE keep it
+# up to date inside the same transaction as the change, so adding or removing a favourite, deleting a recipe
+# and deleting a user (whose favourites go with them) all move the count with no extra work in the routes.
+# recipes without favourites have no row, and the index on the count serves the top of the list.
+# the popular list itself is read by a background thread every REFRESH_SECONDS, never by a request
+import threading
+from collections import namedtuple
+
+import logs
+import repository
+from concurrency import offload
+
+log = logs.get_logger('popular')
+
+# recipes on the popular list
+POPULAR_COUNT = 10
+# seconds between reads of the popular list
+REFRESH_SECONDS = 300
+
+# the counts are not kept on RECIPE itself - every favourite would then change RECIPE, and with it the change count
+# the result page ETags are built from (see migrations.create_change_counters)
+CREATE_TABLE = """CREATE TABLE IF NOT EXISTS FAVOURITE_COUNT (
+    RecipeID INTEGER PRIMARY KEY REFERENCES RECIPE(ID) ON DELETE CASCADE,
+    Favourites INTEGER NOT NULL
+)"""
+# most favourited first, the newest recipe first among equals
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS FAVOURITE_COUNT_Favourites ON FAVOURITE_COUNT(Favourites, RecipeID)"
+
+CREATE_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS FAVOURITE_count_insert AFTER INSERT ON FAVOURITE BEGIN
+        INSERT INTO FAVOURITE_COUNT (RecipeID, Favourites) VALUES (new.RecipeID, 1)
+        ON CONFLICT (RecipeID) DO UPDATE SET Favourites = Favourites + 1;
+    END""",
+    # also fired for the favourites removed with their user or recipe (ON DELETE CASCADE)
+    """CREATE TRIGGER IF NOT EXISTS FAVOURITE_count_delete AFTER DELETE ON FAVOURITE BEGIN
+        UPDATE FAVOURITE_COUNT SET Favourites = Favourites - 1 WHERE RecipeID = old.RecipeID;
+        DELETE FROM FAVOURITE_COUNT WHERE RecipeID = old.RecipeID AND Favourites <= 0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS FAVOURITE_count_update AFTER UPDATE OF RecipeID ON FAVOURITE BEGIN
+        UPDATE FAVOURITE_COUNT SET Favourites = Favourites - 1 WHERE RecipeID = old.RecipeID;
+        DELETE FROM FAVOURITE_COUNT WHERE RecipeID = old.RecipeID AND Favourites <= 0;
+        INSERT INTO FAVOURITE_COUNT (RecipeID, Favourites) VALUES (new.RecipeID, 1)
+        ON CONFLICT (RecipeID) DO UPDATE SET Favourites = Favourites + 1;
+    END""",
+)
+
+# the counts as they should be, from FAVOURITE itself
+SOURCE_COUNTS = "SELECT RecipeID, count(*) FROM FAVOURITE GROUP BY RecipeID"
+
+# recipe ID, count kept in FAVOURITE_COUNT and count in FAVOURITE, for a recipe where the two differ
+Mismatch = namedtuple('Mismatch', ['recipe_id', 'stored', 'actual'])
+
+
+# Create the counts table, its index and triggers, filling the table if it is new
+def ensure_favourite_counts(conn):
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'FAVOURITE_COUNT'").fetchone()
+    conn.execute(CREATE_TABLE)
+    conn.execute(CREATE_INDEX)
+    for trigger in CREATE_TRIGGERS:
+        conn.execute(trigger)
+    if not exists:
+        rebuild_favourite_counts(conn)
+
+
+# Backfill - recount every recipe's favourites from FAVOURITE
+def rebuild_favourite_counts(conn):
+    conn.execute("DELETE FROM FAVOURITE_COUNT")
+    conn.execute("INSERT INTO FAVOURITE_COUNT (RecipeID, Favourites) " + SOURCE_COUNTS)
+
+
+# Recipes whose kept count is not the number of rows in FAVOURITE, as Mismatch records
+def check_favourite_counts(conn):
+    stored = dict(conn.execute("SELECT RecipeID, Favourites FROM FAVOURITE_COUNT"))
+    actual = dict(conn.execute(SOURCE_COUNTS))
+    return [Mismatch(recipe_id, stored.get(recipe_id, 0), actual.get(recipe_id, 0))
+            for recipe_id in sorted(set(stored) | set(actual)) if stored.get(recipe_id) != actual.get(recipe_id)]
+
+
+# The most favourited recipes, read from the database every interval seconds by a background thread
+# requests only ever read the last list, so however many of them show it the query runs once per interval
+class PopularRecipes():
+    def __init__(self, pool, count=POPULAR_COUNT, interval=REFRESH_SECONDS):
+        self.pool = pool
+        self.count = count
+        self.interval = interval
+        self._recipes = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # The list as last read - empty until the first read
+    def get(self):
+        return self._recipes
+
+    # Read the list now
+    def refresh(self):
+        conn = self.pool.acquire()
+        try:
+            self._recipes = offload(repository.popular_recipes, conn, self.count)
+        finally:
+            self.pool.release(conn)
+
+    # Read the list, then again every interval seconds until stop()
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='popular', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                # keep showing the last list, and try again next time
+                log.exception("Could not read the popular recipes")
+            self._stopped.wait(self.interval)
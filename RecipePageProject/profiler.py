@@ -0,0 +1,116 @@
+# opt-in sampling profiler (PROFILE=True) - where each route spends its time, as input for a flamegraph
+# a background thread looks at the stack of every thread that is handling a request, every few milliseconds,
+# and counts each distinct stack under the request's endpoint. the counts are written to
+# <PROFILE_DIR>/<endpoint>.<pid>.folded in the "folded stacks" format read by flamegraph.pl and speedscope.
+# nothing is patched or traced, so the requests run at full speed - the cost is the sampling thread.
+# it needs a thread per request (the development server or the gthread workers); under gevent every request
+# shares one thread, so the profiler stays off in the async mode
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import request
+
+import concurrency
+import logs
+
+log = logs.get_logger('profiler')
+
+# seconds between samples, and between writing the counts out
+INTERVAL = 0.005
+DUMP_EVERY = 10.0
+
+
+class StackSampler():
+    def __init__(self, out_dir, interval=INTERVAL, dump_every=DUMP_EVERY):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.dump_every = dump_every
+        # thread ident -> endpoint of the request it is handling
+        self._active = {}
+        # endpoint -> folded stack -> samples
+        self._counts = defaultdict(Counter)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    # Stop sampling and write out what was counted
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.dump()
+
+    def begin(self, endpoint):
+        self._active[threading.get_ident()] = endpoint
+
+    def end(self):
+        self._active.pop(threading.get_ident(), None)
+
+    # Write the counts of each endpoint, replacing the files of the last dump
+    def dump(self):
+        with self._lock:
+            snapshot = {endpoint: dict(counts) for endpoint, counts in self._counts.items()}
+        for endpoint, counts in snapshot.items():
+            path = os.path.join(self.out_dir, '%s.%d.folded' % (endpoint, os.getpid()))
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as out:
+                for stack, count in sorted(counts.items()):
+                    out.write('%s %d\n' % (stack, count))
+            os.replace(tmp_path, path)
+
+    def _run(self):
+        last_dump = time.monotonic()
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if time.monotonic() - last_dump >= self.dump_every:
+                self.dump()
+                last_dump = time.monotonic()
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, endpoint in list(self._active.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self._counts[endpoint][fold(frame)] += 1
+
+
+# One stack as "outermost;...;innermost", each frame as function (file:line of the function)
+def fold(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+# Profile every request of app - returns the sampler, or None in the async mode
+def init_app(app, out_dir, interval=INTERVAL):
+    if concurrency.async_mode():
+        log.warning("The sampling profiler needs a thread per request and is off in the async mode")
+        return None
+    sampler = StackSampler(out_dir, interval)
+    app.extensions['profiler'] = sampler
+
+    @app.before_request
+    def begin_sampling():
+        sampler.begin(request.endpoint or 'none')
+
+    @app.teardown_request
+    def end_sampling(exception=None):
+        sampler.end()
+
+    sampler.start()
+    log.info("Sampling profiler on", extra={'dir': out_dir, 'interval_ms': interval * 1000})
+    return sampler
@@ -0,0 +1,284 @@
+# data access for the routes - every query the app runs against USER, RECIPE and FAVOURITE is here, by name
+# recipes come back as Recipe records (recipe.name rather than recipe[2]), and every named query is timed
+# so query_stats() shows which ones are worth optimising.
+# the SQL text of each query is fixed, so sqlite3's statement cache (database.STATEMENT_CACHE_SIZE)
+# compiles each one once per connection and reuses it after that
+import threading
+import time
+from collections import defaultdict, deque, namedtuple
+
+import cooktime
+import search
+from pagination import CARD_COLUMNS, PAGE_SIZE, keyset_page
+
+# one recipe as shown on a card or a page - fields in the same order as CARD_COLUMNS
+Recipe = namedtuple('Recipe', ['id', 'username', 'name', 'info', 'time', 'image_path', 'steps', 'steps_truncated'])
+# a search result also carries its minutes and its BM25 score (None without a keyword), the next page continues from
+# whichever the results are sorted by
+SearchResult = namedtuple('SearchResult', Recipe._fields + ('minutes', 'score'))
+# a recipe on the popular list, with how many users have it as a favourite and its thumbnail (None until it is made)
+PopularRecipe = namedtuple('PopularRecipe', ['id', 'username', 'name', 'time', 'favourites', 'thumb_path'])
+UserRecord = namedtuple('UserRecord', ['username', 'email', 'fname', 'lname'])
+
+
+# sqlite3 row factory turning each row into a record as it is fetched
+def record_factory(record):
+    return lambda cursor, row: record._make(row)
+
+
+ROW_FACTORIES = {record: record_factory(record) for record in (Recipe, SearchResult, PopularRecipe, UserRecord)}
+
+# name -> SQL
+QUERIES = {
+    'user': "SELECT Username, Email, First_Name, Last_Name FROM USER WHERE Username = ?",
+    'user_password': "SELECT Password FROM USER WHERE Username = ?",
+    'add_user': "INSERT INTO USER (Username, Password, Email, First_Name, Last_Name) VALUES (?, ?, ?, ?, ?)",
+    'update_password': "UPDATE USER SET Password = ? WHERE Username = ?",
+    # in the order they were added, the card sized image once it has been made and the original until then
+    'favourite_recipes': ("SELECT RECIPE.ID, RECIPE.Username, RECIPE.RecipeName, RECIPE.Info, RECIPE.Time, "
+                          "coalesce(RECIPE.ImageCard, RECIPE.ImagePath), RECIPE.Steps, 0 "
+                          "FROM FAVOURITE JOIN RECIPE ON RECIPE.ID = FAVOURITE.RecipeID "
+                          "WHERE FAVOURITE.Username = ? ORDER BY FAVOURITE.rowid"),
+    # only inserts if the recipe exists, and is ignored if it is already a favourite (primary key)
+    'add_favourite': "INSERT OR IGNORE INTO FAVOURITE (Username, RecipeID) SELECT ?, ID FROM RECIPE WHERE ID = ?",
+    'remove_favourite': "DELETE FROM FAVOURITE WHERE Username = ? AND RecipeID = ?",
+    # most favourited first, read from the top of the FAVOURITE_COUNT_Favourites index
+    'popular_recipes': ("SELECT RECIPE.ID, RECIPE.Username, RECIPE.RecipeName, RECIPE.Time, "
+                        "FAVOURITE_COUNT.Favourites, RECIPE.ImageThumb FROM FAVOURITE_COUNT JOIN RECIPE ON RECIPE.ID = FAVOURITE_COUNT.RecipeID "
+                        "ORDER BY FAVOURITE_COUNT.Favourites DESC, FAVOURITE_COUNT.RecipeID DESC LIMIT ?"),
+    # uses the FAVOURITE_RecipeID index - ON DELETE CASCADE would remove these with the recipe,
+    # deleting them first returns the users whose cached pages are out of date
+    'remove_favourite_everywhere': "DELETE FROM FAVOURITE WHERE RecipeID = ? RETURNING Username",
+    'recipe': ("SELECT ID, Username, RecipeName, Info, Time, coalesce(ImageFull, ImagePath), Steps, 0 "
+               "FROM RECIPE WHERE ID = ?"),
+    'recipe_exists': "SELECT 1 FROM RECIPE WHERE ID = ?",
+    # the unique index RECIPE_Username_RecipeName turns a second recipe with the same name into no row at all,
+    # so checking the name and adding the recipe is one statement and two requests cannot both pass the check
+    'add_recipe': ("INSERT INTO RECIPE (Username, RecipeName, Info, Time, Minutes, Steps, ImagePath) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (Username, RecipeName) DO NOTHING RETURNING ID"),
+    'delete_recipe': "DELETE FROM RECIPE WHERE ID = ? RETURNING ID, Username",
+    # bulk import (catalogue.py) - run with executemany, recipes whose name the user already has are skipped
+    'import_recipes': ("INSERT INTO RECIPE (Username, RecipeName, Info, Time, Minutes, Steps, ImagePath) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (Username, RecipeName) DO NOTHING"),
+    # any recipe using an uploaded image, asked before its file is removed
+    'image_in_use': "SELECT 1 FROM RECIPE WHERE ImagePath = ? LIMIT 1",
+    # bulk export - the whole table, a page at a time in ID order
+    'export_recipes': ("SELECT ID, Username, RecipeName, Info, Time, Steps, ImagePath FROM RECIPE "
+                       "WHERE ID > ? ORDER BY ID LIMIT ?"),
+    # oldest first - paged by pagination.keyset_page
+    'user_recipes': "SELECT " + CARD_COLUMNS + " FROM RECIPE WHERE Username = ?",
+    'table_version': "SELECT Version FROM CHANGE_COUNTER WHERE TableName = ?",
+    # keyword search and browsing, with or without a time limit, in each order - paged by search.search_recipes
+    **search.QUERIES,
+}
+
+# timings kept per query for the percentiles - the most recent ones
+SAMPLES = 1024
+
+
+# Count, rows returned and recent durations of each named query
+class QueryStats():
+    def __init__(self, samples=SAMPLES):
+        self.samples = samples
+        self._count = defaultdict(int)
+        self._rows = defaultdict(int)
+        self._durations = defaultdict(lambda: deque(maxlen=self.samples))
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, rows):
+        with self._lock:
+            self._count[name] += 1
+            self._rows[name] += rows
+            self._durations[name].append(seconds)
+
+    # name -> count, rows, rows per call, p50 and p99 (milliseconds)
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for name, count in self._count.items():
+                durations = sorted(self._durations[name])
+                result[name] = {
+                    'count': count,
+                    'rows': self._rows[name],
+                    'rows_avg': self._rows[name] / count,
+                    'p50_ms': _percentile(durations, 50) * 1000,
+                    'p99_ms': _percentile(durations, 99) * 1000,
+                }
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._count.clear()
+            self._rows.clear()
+            self._durations.clear()
+
+
+stats = QueryStats()
+
+
+# Snapshot of the timings of every query run so far
+def query_stats():
+    return stats.snapshot()
+
+
+# users
+
+def get_user(conn, username):
+    rows = _query(conn, 'user', (username,), UserRecord)
+    return rows[0] if rows else None
+
+
+# Stored password hash of a user, None if there is no such user
+def password_hash(conn, username):
+    rows = _query(conn, 'user_password', (username,))
+    return rows[0][0] if rows else None
+
+
+def add_user(conn, username, password, email, fname, lname):
+    _execute(conn, 'add_user', (username, password, email, fname, lname))
+
+
+def update_password(conn, username, password):
+    _execute(conn, 'update_password', (password, username))
+
+
+# favourites
+
+def favourite_recipes(conn, username):
+    return _query(conn, 'favourite_recipes', (username,), Recipe)
+
+
+# True if the favourite was added, False if the recipe does not exist or is already a favourite
+def add_favourite(conn, username, recipe_id):
+    return _execute(conn, 'add_favourite', (username, recipe_id)).rowcount > 0
+
+
+# True if the recipe was a favourite of the user
+def remove_favourite(conn, username, recipe_id):
+    return _execute(conn, 'remove_favourite', (username, recipe_id)).rowcount > 0
+
+
+# The limit most favourited recipes, as PopularRecipe records
+def popular_recipes(conn, limit):
+    return _query(conn, 'popular_recipes', (limit,), PopularRecipe)
+
+
+# recipes
+
+def get_recipe(conn, recipe_id):
+    rows = _query(conn, 'recipe', (recipe_id,), Recipe)
+    return rows[0] if rows else None
+
+
+def recipe_exists(conn, recipe_id):
+    return bool(_query(conn, 'recipe_exists', (recipe_id,)))
+
+
+# Insert a recipe and return its ID, None if the user already has a recipe with that name
+# the minutes it takes are read from recipe_time and stored with it, for filtering and sorting by time
+def add_recipe(conn, username, name, info, recipe_time, steps, image_path):
+    rows = _query(conn, 'add_recipe', (username, name, info, recipe_time, cooktime.parse_minutes(recipe_time), steps,
+                                       image_path))
+    return rows[0][0] if rows else None
+
+
+# Delete a recipe and remove it from every user's favourites
+# returns (ID of the deleted recipe, its owner, users who had it as a favourite), or None if there was no such recipe
+# the ID is the one stored, whichever way recipe_id was written ('07' deletes recipe 7)
+def delete_recipe(conn, recipe_id):
+    favourited_by = [row[0] for row in _query(conn, 'remove_favourite_everywhere', (recipe_id,))]
+    deleted = _query(conn, 'delete_recipe', (recipe_id,))
+    if not deleted:
+        return None
+    deleted_id, owner = deleted[0]
+    return deleted_id, owner, favourited_by
+
+
+# Insert many recipes, rows as (username, name, info, time, steps, image_path), and return how many were added
+def import_recipes(conn, rows):
+    rows = ((username, name, info, recipe_time, cooktime.parse_minutes(recipe_time), steps, image_path)
+            for username, name, info, recipe_time, steps, image_path in rows)
+    return _execute_many(conn, 'import_recipes', rows).rowcount
+
+
+def image_in_use(conn, image_path):
+    return bool(_query(conn, 'image_in_use', (image_path,)))
+
+
+# Up to limit recipes with an ID above after_id, as (id, username, name, info, time, steps, image_path)
+def export_recipes(conn, after_id, limit):
+    return _query(conn, 'export_recipes', (after_id, limit))
+
+
+# One page of the recipes added by a user, oldest first
+def user_recipes_page(conn, username, after=None, before=None, page_size=PAGE_SIZE):
+    return _paged(conn, 'user_recipes', Recipe, keyset_page, QUERIES['user_recipes'], (username,), ('ID',), (int,),
+                  after=after, before=before, page_size=page_size)
+
+
+# One page of the recipes matching keyword that take at most max_time minutes, best match first unless sort says
+# otherwise - without a keyword, one page of all recipes (see search.search_recipes)
+def search_page(conn, keyword, after=None, before=None, page_size=PAGE_SIZE, max_time=None, sort=None):
+    name = search.query_name(keyword, max_time is not None, search.default_sort(keyword, sort))
+    return _paged(conn, name, SearchResult, search.search_recipes, keyword, after, before, page_size=page_size,
+                  max_time=max_time, sort=sort)
+
+
+# Change count of a table - the same number means the table has not changed (see migrations.create_change_counters)
+def table_version(conn, table):
+    rows = _query(conn, 'table_version', (table,))
+    return rows[0][0] if rows else 0
+
+
+# Run a named query and return all its rows, as record if given
+def _query(conn, name, params=(), record=None):
+    cursor = conn.cursor()
+    if record is not None:
+        cursor.row_factory = ROW_FACTORIES[record]
+    start = time.perf_counter()
+    cursor.execute(QUERIES[name], params)
+    rows = cursor.fetchall()
+    _record(conn, name, time.perf_counter() - start, len(rows))
+    return rows
+
+
+# Run a named statement that returns no rows and return its cursor (for rowcount and lastrowid)
+def _execute(conn, name, params=()):
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    cursor.execute(QUERIES[name], params)
+    _record(conn, name, time.perf_counter() - start, max(cursor.rowcount, 0))
+    return cursor
+
+
+# Run a named statement once for each set of params in seq_of_params
+def _execute_many(conn, name, seq_of_params):
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    cursor.executemany(QUERIES[name], seq_of_params)
+    _record(conn, name, time.perf_counter() - start, max(cursor.rowcount, 0))
+    return cursor
+
+
+# Fetch a page with fn (keyset_page or a function built on it), timed under name
+def _paged(conn, name, record, fn, *args, **kwargs):
+    cursor = conn.cursor()
+    cursor.row_factory = ROW_FACTORIES[record]
+    start = time.perf_counter()
+    page = fn(cursor, *args, **kwargs)
+    _record(conn, name, time.perf_counter() - start, len(page.rows))
+    return page
+
+
+# Add a query's time to its totals, and to the connection's count for the request using it (database.Connection)
+def _record(conn, name, seconds, rows):
+    stats.record(name, seconds, rows)
+    record_query = getattr(conn, 'record_query', None)
+    if record_query is not None:
+        record_query(seconds)
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
@@ -0,0 +1,177 @@
+# full-text recipe search using an SQLite FTS5 index over RECIPE
+import math
+import re
+from pagination import CARD_COLUMNS, PAGE_SIZE, Page, keyset_page, text
+
+# column weights for BM25 ranking - a match in the name counts more than one in the info or steps
+NAME_WEIGHT = 10.0
+INFO_WEIGHT = 2.0
+STEPS_WEIGHT = 1.0
+
+# the index stores no text of its own (content='RECIPE'), only the tokens pointing at RECIPE rows
+# prefix='2 3' keeps extra prefix indexes so short prefix searches do not scan the whole term list
+CREATE_INDEX = """CREATE VIRTUAL TABLE RECIPE_FTS USING fts5(
+    RecipeName, Info, Steps,
+    content='RECIPE', content_rowid='ID',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+)"""
+
+# triggers keep the index in step with every insert, delete and update on RECIPE
+CREATE_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS RECIPE_FTS_insert AFTER INSERT ON RECIPE BEGIN
+        INSERT INTO RECIPE_FTS (rowid, RecipeName, Info, Steps) VALUES (new.ID, new.RecipeName, new.Info, new.Steps);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS RECIPE_FTS_delete AFTER DELETE ON RECIPE BEGIN
+        INSERT INTO RECIPE_FTS (RECIPE_FTS, rowid, RecipeName, Info, Steps)
+        VALUES ('delete', old.ID, old.RecipeName, old.Info, old.Steps);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS RECIPE_FTS_update AFTER UPDATE OF RecipeName, Info, Steps ON RECIPE BEGIN
+        INSERT INTO RECIPE_FTS (RECIPE_FTS, rowid, RecipeName, Info, Steps)
+        VALUES ('delete', old.ID, old.RecipeName, old.Info, old.Steps);
+        INSERT INTO RECIPE_FTS (rowid, RecipeName, Info, Steps) VALUES (new.ID, new.RecipeName, new.Info, new.Steps);
+    END""",
+)
+
+# ways to order the results: sort -> (key columns, their cursor types, largest first)
+# every order is served by an index - the full-text index for relevance, RECIPE_Minutes for time,
+# RECIPE_RecipeName for name and the primary key for newest (with a time limit, see CHOSEN_BY_SELECTIVITY)
+SORTS = {
+    # best match first, only for a keyword search
+    'relevance': (('Score', 'ID'), (float, int), False),
+    # quickest first - recipes with no time that could be read (Minutes is NULL) are left out
+    'time': (('Minutes', 'ID'), (int, int), False),
+    'name': (('RecipeName', 'ID'), (text, int), False),
+    'newest': (('ID',), (int,), True),
+}
+
+# the orders of a browse with a time limit that RECIPE_Minutes cannot read in page order. a page of one is read either
+# by walking the index of the order and skipping the recipes over the limit - about page_size * recipes / within rows
+# - or by finding the recipes within the limit in RECIPE_Minutes and sorting them - `within` rows. sqlite cannot tell
+# how many recipes a limit lets through, so search_recipes finds out (see few_within) and tells the planner with
+# likelihood() how likely a recipe is to be within it, and the planner picks the index to read from that
+CHOSEN_BY_SELECTIVITY = ('name', 'newest')
+# likelihood() of a recipe being within the limit when few of them are, and when many are
+FEW_WITHIN = 0.001
+MANY_WITHIN = 0.9
+
+
+# Name of the query for a search with or without a keyword and a time limit, in the given order
+# selective - the form for a time limit few recipes are within (see CHOSEN_BY_SELECTIVITY)
+def query_name(keyword, max_time, sort, selective=False):
+    name = 'search_recipes' if keyword else 'browse_recipes'
+    if sort != 'relevance':
+        name += '_by_' + sort
+    if max_time:
+        name += '_max_time'
+    if selective:
+        name += '_selective'
+    return name
+
+
+# True if the query for this search has a form for a time limit few recipes are within
+def chosen_by_selectivity(keyword, max_time, sort):
+    return not keyword and max_time and sort in CHOSEN_BY_SELECTIVITY
+
+
+# SQL of that query - its parameters are the column weights and the match expression for a keyword search,
+# then the most minutes when there is a time limit
+def build_query(keyword, max_time, sort, selective=False):
+    # bm25 scores are negative, the lower the score the better the match
+    score = "bm25(RECIPE_FTS, ?, ?, ?)" if keyword else "NULL"
+    query = "SELECT " + CARD_COLUMNS + ", RECIPE.Minutes AS Minutes, " + score + " AS Score "
+    conditions = []
+    if keyword:
+        query += "FROM RECIPE_FTS JOIN RECIPE ON RECIPE.ID = RECIPE_FTS.rowid"
+        conditions.append("RECIPE_FTS MATCH ?")
+    else:
+        query += "FROM RECIPE"
+    if chosen_by_selectivity(keyword, max_time, sort):
+        conditions.append("likelihood(RECIPE.Minutes <= ?, %s)" % (FEW_WITHIN if selective else MANY_WITHIN))
+    elif max_time:
+        conditions.append("RECIPE.Minutes <= ?")
+    elif sort == 'time':
+        conditions.append("RECIPE.Minutes IS NOT NULL")
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query
+
+
+# every form of the search: name -> SQL (a browse has no keyword, so no best match order)
+QUERIES = {query_name(keyword, max_time, sort, selective): build_query(keyword, max_time, sort, selective)
+           for keyword in (True, False) for max_time in (False, True) for sort in SORTS
+           for selective in (False, True)
+           if (keyword or sort != 'relevance') and (not selective or chosen_by_selectivity(keyword, max_time, sort))}
+# the minutes of the recipe at a position in RECIPE_Minutes, read from the index alone (see few_within)
+QUERIES['nth_quickest_minutes'] = ("SELECT Minutes FROM RECIPE WHERE Minutes IS NOT NULL "
+                                   "ORDER BY Minutes LIMIT 1 OFFSET ?")
+QUERIES['last_recipe_id'] = "SELECT max(ID) FROM RECIPE"
+
+
+# Create the search index and its triggers, filling the index if it is new
+def ensure_search_index(conn):
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'RECIPE_FTS'").fetchone()
+    if not exists:
+        conn.execute(CREATE_INDEX)
+    for trigger in CREATE_TRIGGERS:
+        conn.execute(trigger)
+    if not exists:
+        rebuild_search_index(conn)
+
+
+# Backfill - rebuild the whole index from the current contents of RECIPE
+def rebuild_search_index(conn):
+    conn.execute("INSERT INTO RECIPE_FTS (RECIPE_FTS) VALUES ('rebuild')")
+
+
+# Turn what the user typed into an FTS5 query
+# every word must appear somewhere in the recipe, and the last word may be the start of a longer word
+# words are quoted so characters such as " * - ( ) : can never change the meaning of the query
+def match_expression(keyword):
+    words = re.findall(r"\w+", keyword)
+    if not words:
+        return None
+    terms = ['"%s"' % word for word in words]
+    terms[-1] += '*'
+    return ' AND '.join(terms)
+
+
+# The words of keyword in the form the index compares them - 'Chocolate  cake!' and 'chocolate cake' are the same search
+def normalize_keyword(keyword):
+    return ' '.join(word.lower() for word in re.findall(r"\w+", keyword))
+
+
+# Return one page of the recipes matching keyword (all recipes if it is empty) that take at most max_time minutes
+# (any time if None), in the order given by sort - best match first by default, newest first without a keyword
+# pages are keyed on the sort column and ID so recipes with the same score, time or name keep a stable order
+def search_recipes(cursor, keyword, after=None, before=None, page_size=PAGE_SIZE, max_time=None, sort=None):
+    sort = default_sort(keyword, sort)
+    params = []
+    if keyword:
+        expression = match_expression(keyword)
+        if expression is None:
+            return Page([], None, None)
+        params += [NAME_WEIGHT, INFO_WEIGHT, STEPS_WEIGHT, expression]
+    if max_time is not None:
+        params.append(max_time)
+    selective = (chosen_by_selectivity(keyword, max_time is not None, sort)
+                 and few_within(cursor.connection, max_time, page_size))
+    keys, types, descending = SORTS[sort]
+    return keyset_page(cursor, QUERIES[query_name(keyword, max_time is not None, sort, selective)], params, keys, types,
+                       after=after, before=before, page_size=page_size, descending=descending)
+
+
+# True if sorting the recipes that take at most max_time minutes reads fewer rows than walking an order to fill a page
+# - if fewer than sqrt(page_size * recipes) are within it, taking the last ID as the number of recipes.
+# only that many entries of RECIPE_Minutes are read to tell, however many recipes there are
+def few_within(conn, max_time, page_size):
+    recipes = conn.execute(QUERIES['last_recipe_id']).fetchone()[0] or 0
+    enough = math.isqrt((page_size + 1) * recipes) + 1
+    row = conn.execute(QUERIES['nth_quickest_minutes'], (enough - 1,)).fetchone()
+    return row is None or row[0] > max_time
+
+
+# The order to use - relevance needs a keyword to be relevant to
+def default_sort(keyword, sort):
+    if sort not in SORTS or (sort == 'relevance' and not keyword):
+        return 'relevance' if keyword else 'newest'
+    return sort
@@ -0,0 +1,49 @@
+# configuration from environment variables
+# any setting in app.config can be overridden by an environment variable named RECIPE_<SETTING>,
+# e.g. RECIPE_PAGE_SIZE=50 or RECIPE_SECRET_KEY=... - values are converted to the type of the default.
+# variables for settings the app does not have (such as the server's RECIPE_WORKERS) are left alone
+import os
+
+PREFIX = 'RECIPE_'
+
+# words accepted for True and False
+TRUE_WORDS = ('1', 'true', 'yes', 'on')
+FALSE_WORDS = ('0', 'false', 'no', 'off', '')
+
+
+# Convert the text of an environment variable to the type of default
+def convert(text, default):
+    if isinstance(default, bool):
+        word = text.strip().lower()
+        if word in TRUE_WORDS:
+            return True
+        if word in FALSE_WORDS:
+            return False
+        raise ValueError("expected one of %s" % ', '.join(TRUE_WORDS + FALSE_WORDS[:-1]))
+    if isinstance(default, int):
+        return int(text)
+    if isinstance(default, float):
+        return float(text)
+    # strings, and settings that default to None, are used as they are - an empty value means None
+    if default is None and text == '':
+        return None
+    return text
+
+
+# Override settings in config with any RECIPE_<SETTING> environment variables
+# returns the names of the settings that were changed
+def load_environment(config, environ=os.environ, prefix=PREFIX):
+    changed = []
+    for name, text in environ.items():
+        if not name.startswith(prefix):
+            continue
+        setting = name[len(prefix):]
+        if setting not in config:
+            continue
+        default = config[setting]
+        try:
+            config[setting] = convert(text, default)
+        except ValueError as e:
+            raise ValueError("Bad value for %s: %s" % (name, e))
+        changed.append(setting)
+    return changed
@@ -0,0 +1,23 @@
+# compiled templates kept on disk, so a new worker process starts with every template ready
+# Jinja turns each template into Python code the first time it is used. with a bytecode cache the compiled code is
+# written to cache_dir and the next process loads it instead, compiling again only templates that changed.
+# every template is loaded when the app starts, so no request pays for it
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+
+# Keep the compiled templates of app in cache_dir (None for no cache) and load them all
+def init_app(app, cache_dir=None):
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    return preload(app)
+
+
+# Load every template of app into its Jinja environment and return how many there are
+def preload(app):
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
@@ -0,0 +1,32 @@
+# production entry point
+# run with: gunicorn -c gunicorn.conf.py "wsgi:create_app()"
+# or any other WSGI server pointed at wsgi:application
+# settings come from RECIPE_<SETTING> environment variables, e.g. RECIPE_SECRET_KEY and RECIPE_DATABASE
+import atexit
+
+# the app once create_app() has set it up in this process
+_app = None
+
+
+# Build the app for one server worker process
+# main.create_app() sets it up in the worker, so each worker gets its own connection pool and background workers
+# later calls in the same process return the same app without setting it up again
+def create_app():
+    global _app
+    if _app is not None:
+        return _app
+    import main
+    app = main.create_app()
+    if app.config['SECRET_KEY'] == 'super secret key':
+        main.log.warning("RECIPE_SECRET_KEY is not set, sessions are signed with the development key")
+    # servers that do not call main.shutdown() themselves still drain the pool when the process exits
+    atexit.register(main.shutdown)
+    _app = app
+    return _app
+
+
+# wsgi:application is built when a server first asks for it, so importing this module sets nothing up
+def __getattr__(name):
+    if name == 'application':
+        return create_app()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))